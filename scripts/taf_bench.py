@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+#Copyright 2015 Sebastian Hagen
+# This file is part of taf.
+#
+# taf is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# taf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# End-to-end benchmark: runs logs2stdout.py (FileGazer + EventStreamServer) as a child on local pipes against
+# synthetic logs in a temp directory, and measures write-to-notify latency, throughput and server CPU cost.
+# Results are written as one JSON object per run, for comparing between versions.
+#
+# Usage: scripts/taf_bench.py --files 1,100 --watches 10,200 --rates 1000,10000 --patterns simple,complex -o out.jsonl
+#
+# With --matcher, it instead times LineMatcher against searching each watch's pattern on its own, in-process, over
+# the same kind of lines:
+#   scripts/taf_bench.py --matcher --watches 20,50,100 --patterns simple,complex,alternation
+
+import json
+import logging
+import os
+import random
+import selectors
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(BASE_DIR, 'src'))
+
+from taf.event_proto import Config, EventStreamClient, LineMatcher, Watch
+
+logger = logging.getLogger('taf_bench')
+log = logger.log
+
+SERVER_PATH = os.path.join(BASE_DIR, 'src', 'bin', 'logs2stdout.py')
+
+# Line patterns by complexity; %d is replaced by the watch index.
+PATTERNS = {
+  'simple': b'hl%d:',
+  'complex': b'(^|[^A-z0-9\\.])hl%d([^A-z0-9:]|:|$)',
+  'alternation': b'(foo|bar|baz)[0-9]+ .*hl%d:|^ERROR .* hl%d:|<[^>]*> [0-9]+ hl%d:',
+}
+
+FILLER = b'the quick brown fox jumps over the lazy dog 0123456789 '
+
+
+class PipeStream:
+  # Minimal stand-in for gonium's AsyncDataStream, over a pipe fd driven by our selector loop.
+  def __init__(self, fd):
+    self.fd = fd
+    self.buf = bytearray()
+    self.size_need = 0
+    self.closed = False
+    self._disc = 0
+
+  def process_input(self, data):
+    pass
+
+  def discard_inbuf_data(self, n):
+    self._disc += n
+
+  def send_bytes(self, bufs):
+    for b in bufs:
+      mv = memoryview(b)
+      while mv:
+        n = os.write(self.fd, mv)
+        mv = mv[n:]
+
+  def read(self):
+    data = os.read(self.fd, 1 << 16)
+    if not data:
+      self.closed = True
+      return
+    self.buf += data
+    if (len(self.buf) < self.size_need):
+      return
+    self._disc = 0
+    self.process_input(memoryview(bytes(self.buf)))
+    del(self.buf[:self._disc])
+
+
+def get_cpu(pid):
+  # (user + system) CPU seconds used by pid so far.
+  with open('/proc/{}/stat'.format(pid), 'rb') as f:
+    fields = f.read().rsplit(b')', 1)[1].split()
+  return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def percentile(vals, p):
+  if not vals:
+    return None
+  return vals[min(len(vals) - 1, int(len(vals) * p / 100))]
+
+
+class BenchRun:
+  def __init__(self, files, watches, rate, pattern, duration, match_ratio, server_args):
+    self.files = files
+    self.watches = watches
+    self.rate = rate
+    self.pattern = pattern
+    self.duration = duration
+    self.match_ratio = match_ratio
+    self.server_args = server_args
+
+    self.t_write = {}
+    self.latencies = []
+    self.notifies = 0
+    self.acks = 0
+    self.t_end = None
+
+  def setup(self):
+    self.dir = tempfile.mkdtemp(prefix='taf_bench.')
+    os.mkdir(os.path.join(self.dir, 'net'))
+    self.fds = []
+    for i in range(self.files):
+      fd = os.open(os.path.join(self.dir, 'net', 'chan{}'.format(i)), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+      self.fds.append(fd)
+    self.fd_sentinel = os.open(os.path.join(self.dir, 'sentinel'), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (os.path.join(BASE_DIR, 'src'), env.get('PYTHONPATH')) if p)
+    args = [sys.executable, SERVER_PATH, '--cd', self.dir, '--scan-threads', '0'] + self.server_args
+    self.p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+    self.fl_in = PipeStream(self.p.stdout.fileno())
+    self.fl_out = PipeStream(self.p.stdin.fileno())
+    self.esc = c = EventStreamClient(self.fl_in, self.fl_out)
+    c.process_notify = self.process_notify
+    c.process_notify_context = self.process_notify_context
+    c.process_ack = self.process_ack
+
+    conf = Config()
+    conf.auto_reset = True
+    conf.notify_batch = True
+    conf.notify_context = 64
+    conf.notify_context_lines = 1 << 16
+    c.send_config(conf)
+
+    # Watch i looks at file i % files; the last one is the sentinel marking the end of the run.
+    lp = PATTERNS[self.pattern]
+    for i in range(self.watches):
+      c.add_watch('^net/chan{}$'.format(i % self.files).encode('ascii'), lp.replace(b'%d', str(i).encode('ascii')))
+    c.add_watch(b'^sentinel$', b'END')
+    c.watch_set(((1 << (self.watches + 1)) - 1).to_bytes((self.watches + 8) // 8, 'little'))
+    c.reset()
+
+    self.sel = selectors.DefaultSelector()
+    self.sel.register(self.fl_in.fd, selectors.EVENT_READ)
+    while (self.acks < self.watches + 1):
+      self.poll(1)
+    self.cpu_start = get_cpu(self.p.pid)
+
+  def process_ack(self):
+    self.acks += 1
+
+  def process_notify(self, idx):
+    self.notifies += 1
+
+  def process_notify_context(self, idx, lines):
+    now = time.monotonic()
+    if (idx == self.watches):
+      self.t_end = now
+      return
+    for line in lines:
+      self.notifies += 1
+      seq = int(bytes(line).split(b' ', 2)[1])
+      t = self.t_write.pop(seq, None)
+      if not (t is None):
+        self.latencies.append(now - t)
+
+  def poll(self, timeout):
+    for (key, ev) in self.sel.select(timeout):
+      self.fl_in.read()
+      if self.fl_in.closed:
+        raise EOFError('Server went away.')
+
+  def write_loop(self):
+    rnd = random.Random(0)
+    seq = 0
+    self.lines = 0
+    self.bytes = 0
+    self.matching = 0
+    t0 = self.t_start = time.monotonic()
+    tick = 0.005
+    while True:
+      now = time.monotonic()
+      if (now - t0 >= self.duration):
+        break
+      due = int((now - t0) * self.rate)
+      while (self.lines < due):
+        seq += 1
+        w = None
+        if (rnd.random() < self.match_ratio):
+          w = rnd.randrange(self.watches)
+          fi = w % self.files
+          line = b'<nick> ' + str(seq).encode('ascii') + b' hl' + str(w).encode('ascii') + b': ' + FILLER + b'\n'
+        else:
+          fi = rnd.randrange(self.files)
+          line = b'<nick> ' + str(seq).encode('ascii') + b' ' + FILLER + b'\n'
+        if not (w is None):
+          self.t_write[seq] = time.monotonic()
+          self.matching += 1
+        os.write(self.fds[fi], line)
+        self.lines += 1
+        self.bytes += len(line)
+      self.poll(tick)
+
+    os.write(self.fd_sentinel, b'END\n')
+    t_limit = time.monotonic() + 30
+    while (self.t_end is None) and (time.monotonic() < t_limit):
+      self.poll(0.1)
+
+  def teardown(self):
+    try:
+      self.cpu_end = get_cpu(self.p.pid)
+    except OSError:
+      self.cpu_end = self.cpu_start
+    self.p.stdin.close()
+    self.p.terminate()
+    self.p.wait()
+    for fd in self.fds:
+      os.close(fd)
+    os.close(self.fd_sentinel)
+    self.sel.close()
+    shutil.rmtree(self.dir)
+
+  def run(self):
+    self.setup()
+    try:
+      self.write_loop()
+    finally:
+      self.teardown()
+    return self.get_result()
+
+  def get_result(self):
+    lat = sorted(self.latencies)
+    elapsed = ((self.t_end or time.monotonic()) - self.t_start)
+    cpu = self.cpu_end - self.cpu_start
+    rv = {
+      'files': self.files,
+      'watches': self.watches,
+      'rate': self.rate,
+      'pattern': self.pattern,
+      'duration': self.duration,
+      'server_args': self.server_args,
+      'lines': self.lines,
+      'bytes': self.bytes,
+      'matching_lines': self.matching,
+      'notified_lines': self.notifies,
+      'completed': self.t_end is not None,
+      'elapsed': elapsed,
+      'lines_per_sec': self.lines / elapsed,
+      'bytes_per_sec': self.bytes / elapsed,
+      'cpu_seconds': cpu,
+      'cpu_per_line_us': 1e6 * cpu / max(self.lines, 1),
+      'cpu_per_matched_line_us': 1e6 * cpu / max(self.matching, 1),
+    }
+    for p in (50, 90, 99):
+      v = percentile(lat, p)
+      rv['latency_p{}_ms'.format(p)] = None if (v is None) else 1000 * v
+    rv['latency_max_ms'] = 1000 * lat[-1] if lat else None
+    return rv
+
+
+def bench_matcher(watches, pattern, lines, match_ratio):
+  import re
+  rnd = random.Random(0)
+  lp = PATTERNS[pattern]
+  ws = []
+  for i in range(watches):
+    w = Watch(None, re.compile(lp.replace(b'%d', str(i).encode('ascii'))))
+    w.idx = i
+    ws.append(w)
+  data = []
+  matching = 0
+  for seq in range(lines):
+    if (rnd.random() < match_ratio):
+      matching += 1
+      hl = b' hl' + str(rnd.randrange(watches)).encode('ascii') + b':'
+    else:
+      hl = b''
+    data.append(b'<nick> ' + str(seq).encode('ascii') + hl + b' ' + FILLER)
+
+  # Per batch of 100 lines, as the server would see them with files being appended to steadily.
+  batches = [data[i:i+100] for i in range(0, lines, 100)]
+  t0 = time.perf_counter()
+  fired_m = 0
+  for b in batches:
+    fired_m += len(LineMatcher(ws).match(b))
+  t_matcher = time.perf_counter() - t0
+
+  t0 = time.perf_counter()
+  fired_n = 0
+  for b in batches:
+    left = ws
+    for line in b:
+      left_next = []
+      for w in left:
+        if (w.line_p.search(line) is None):
+          left_next.append(w)
+        else:
+          fired_n += 1
+      left = left_next
+  t_naive = time.perf_counter() - t0
+  if (fired_m != fired_n):
+    raise ValueError('Matcher disagrees with per-watch search: {} != {} fires.'.format(fired_m, fired_n))
+
+  return {
+    'mode': 'matcher',
+    'watches': watches,
+    'pattern': pattern,
+    'lines': lines,
+    'matching_lines': matching,
+    'matcher_seconds': t_matcher,
+    'naive_seconds': t_naive,
+    'speedup': t_naive / t_matcher,
+  }
+
+
+def get_version():
+  try:
+    return subprocess.check_output(['git', '-C', BASE_DIR, 'describe', '--always', '--dirty'],
+      stderr=subprocess.DEVNULL).decode('ascii').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main():
+  import argparse
+  import itertools
+  import platform
+
+  def int_list(s):
+    return [int(x) for x in s.split(',')]
+
+  p = argparse.ArgumentParser()
+  p.add_argument('--files', default=[10], type=int_list, help='Comma-separated logfile counts to run with.')
+  p.add_argument('--watches', default=[10], type=int_list, help='Comma-separated watch counts to run with.')
+  p.add_argument('--rates', default=[1000], type=int_list, help='Comma-separated total line rates (lines/s).')
+  p.add_argument('--patterns', default=['simple'], type=lambda s: s.split(','),
+    help='Comma-separated line pattern complexities: {}.'.format(', '.join(sorted(PATTERNS))))
+  p.add_argument('--duration', default=5, type=float, help='Seconds of writing per run.')
+  p.add_argument('--match-ratio', default=0.01, type=float, help='Fraction of lines hitting a watch.')
+  p.add_argument('--server-arg', default=[], action='append', dest='server_args',
+    help='Extra argument for logs2stdout.py; may be repeated.')
+  p.add_argument('--matcher', default=False, action='store_true',
+    help='Time LineMatcher against per-watch searching in-process, instead of running the server.')
+  p.add_argument('--lines', default=5000, type=int, help='Lines to match per --matcher run.')
+  p.add_argument('--label', help='Free-form label stored with the results.')
+  p.add_argument('--output', '-o', help='File to append JSON results to; stdout by default.')
+  p.add_argument('--loglevel', '-L', default=20, type=int)
+  args = p.parse_args()
+  logging.basicConfig(format='%(asctime)s %(levelno)s %(message)s', stream=sys.stderr, level=args.loglevel)
+
+  meta = {
+    'version': get_version(),
+    'label': args.label,
+    'time': time.time(),
+    'host': platform.node(),
+    'python': platform.python_version(),
+  }
+
+  out = sys.stdout
+  if args.output:
+    out = open(args.output, 'a')
+
+  if args.matcher:
+    for (watches, pattern) in itertools.product(args.watches, args.patterns):
+      r = bench_matcher(watches, pattern, args.lines, args.match_ratio)
+      r.update(meta)
+      out.write(json.dumps(r, sort_keys=True) + '\n')
+      out.flush()
+      log(20, 'Matcher, {} watches, {}: {:.3f}s vs {:.3f}s per-watch.'.format(watches, pattern, r['matcher_seconds'],
+        r['naive_seconds']))
+  else:
+    for (files, watches, rate, pattern) in itertools.product(args.files, args.watches, args.rates, args.patterns):
+      log(20, 'Running: files={} watches={} rate={} pattern={}'.format(files, watches, rate, pattern))
+      r = BenchRun(files, watches, rate, pattern, args.duration, args.match_ratio, args.server_args).run()
+      r.update(meta)
+      out.write(json.dumps(r, sort_keys=True) + '\n')
+      out.flush()
+      log(20, 'Latency p50/p99: {} / {} ms; {:.0f} lines/s; {:.1f} us CPU per line.'.format(
+        *('{:.3f}'.format(v) if (v is not None) else '-' for v in (r['latency_p50_ms'], r['latency_p99_ms'])),
+        r['lines_per_sec'], r['cpu_per_line_us']))
+
+  if args.output:
+    out.close()
+
+
+if (__name__ == '__main__'):
+  main()
@@ -15,127 +15,71 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 import os
-import sys
 
-from gonium.fdm import AsyncDataStream
-from taf.event_proto import EventStreamServer
+from taf.gazer import FileGazer, get_backend
 
-
-def ed_shutdown(ed):
-  def shutdown(*args, **kwargs):
-    ed.shutdown()
-  return shutdown
-
-# Usage: start_stdio(), (scan_dir()*, watch_all())
-class FileGazer:
-  def __init__(self, ed, *args, **kwargs):
-    self.ed = ed
-    self.stream = None
-    self.wd2pn = []
-    self.fp2sz = {}
-
-  def _start_watch(self):
-    from gonium.linux import inotify
-
-    self.iw = inotify.InotifyWatch(self.ed)
-    self.iw.process_event = self._process_inotify_event
-
-  def _process_inotify_event(self, wd, mask, cookie, name):
-    from os import stat
-
-    pn = self.wd2pn[wd]
-    # TODO: Match line patterns
-    sz = stat(pn).st_size
-    sz_prev = self.fp2sz.get(pn)
-
-    if (sz != sz_prev):
-      self.fp2sz[pn] = sz
-      lines = None
-
-      def get_lines():
-        nonlocal lines
-        if (lines is None):
-          f = open(pn, 'rb')
-          f.seek(sz_prev)
-          data = f.read()
-          f.close()
-          lines = data.split(b'\n')
-          if (lines and lines[-1] == b''):
-            del(lines[-1])
-        #sys.stderr.write('L: {!r}\n'.format(lines)); sys.stderr.flush()
-        return lines
-
-      self.stream.notify(pn, get_lines)
-
-  def start_stdio(self):
-    fl_in = AsyncDataStream(self.ed, os.fdopen(sys.stdin.fileno(), 'rb', 0, closefd=False))
-    fl_out = AsyncDataStream(self.ed, os.fdopen(sys.stdout.fileno(), 'wb', 0, closefd=False), read_r=False)
-
-    sd = ed_shutdown(self.ed)
-    fl_in.process_close = sd
-    fl_out.process_close = sd
-
-    self.stream = EventStreamServer(fl_in, fl_out)
-    self.stream.watch_files = self._watch_files
-    self._start_watch()
-
-  def update_file_size(self, path):
-    from os import stat
-    sz_prev = self.fp2sz.get(path)
-    self.fp2sz[path] = stat(path).st_size
-    return sz_prev
-
-  def scan_dir(self, path):
-    from os import walk
-    from os.path import join
-
-    for (p, dns, fns) in walk(path):
-      for fn in fns:
-        fp = join(p, fn)
-        if fp.startswith(b'./'):
-          fp = fp[2:]
-        self.stream.add_file(fp)
-        self.update_file_size(fp)
-
-  def watch_all(self):
-    self._watch_files(self.stream.get_watched_files())
-
-  def _add_watch_descriptor(self, wd, pn):
-    off = wd - len(self.wd2pn) + 1
-    if (off > 0):
-      from itertools import repeat
-      self.wd2pn.extend(repeat(None, off))
-
-    self.wd2pn[wd] = pn
-
-  def _watch_files(self, pns):
-    from gonium.linux.inotify import IN_MODIFY
-
-    for pn in pns:
-      wd = self.iw.add_watch(pn, IN_MODIFY)
-      self._add_watch_descriptor(wd, pn)
+logger = logging.getLogger('logs2stdout')
+log = logger.log
 
 
 def main():
-  from gonium.fdm import ED_get
   import argparse
 
   p = argparse.ArgumentParser()
   p.add_argument('--cd')
+  p.add_argument('--backend', default='gonium', choices=('gonium', 'asyncio'), help='Event loop implementation to use.')
+  p.add_argument('--max-fds', default=256, type=int, help='Maximum number of logfiles to keep open.')
+  p.add_argument('--watch-dirs', default=False, action='store_true',
+    help='Watch directories instead of individual files, picking up files created later on.')
+  p.add_argument('--scan-threads', default=4, type=int,
+    help='Number of threads to scan the logfile tree with at startup; 0 to scan synchronously.')
+  p.add_argument('--checkpoint', help='File to keep read offsets in, for resuming after restarts.')
+  p.add_argument('--checkpoint-interval', default=5, type=float, help='Seconds between checkpoint writes.')
+  p.add_argument('--max-backlog', default=1<<20, type=int,
+    help='Maximum number of octets per file to replay from a checkpoint.')
+  p.add_argument('--mmap-threshold', default=1<<22, type=int,
+    help='Scan new data of at least this many octets through memory maps; 0 to always read it in.')
+  p.add_argument('--mmap-window', default=1<<24, type=int, help='Octets to map at a time when doing so.')
+  p.add_argument('--match-workers', default=0, type=int,
+    help='Number of worker processes to match large amounts of new data on; 0 to match inline only.')
+  p.add_argument('--match-worker-threshold', default=1<<16, type=int,
+    help='Octets of new data in a file to hand matching it off to a worker at.')
+  p.add_argument('--debounce-ms', default=0, type=float,
+    help='Process modified files once they have been quiet for this long; 0 to do so once per event loop iteration.')
+  p.add_argument('--max-latency-ms', default=100, type=float,
+    help='Process modified files no later than this long after the first event, even if they keep changing.')
 
   args = p.parse_args()
 
   if (args.cd):
     os.chdir(args.cd)
 
-  ed = ED_get()()
+  ed = get_backend(args.backend)[0]()
+
+  ckpt = None
+  if (args.checkpoint):
+    from taf.checkpoint import CheckpointStore
+    ckpt_path = os.path.abspath(os.path.expanduser(args.checkpoint))
+    os.makedirs(os.path.dirname(ckpt_path), exist_ok=True)
+    ckpt = CheckpointStore(ckpt_path)
 
-  fg = FileGazer(ed)
+  fg = FileGazer(ed, max_fds=args.max_fds, watch_dirs=args.watch_dirs, ckpt=ckpt,
+    ckpt_interval=args.checkpoint_interval, max_backlog=args.max_backlog, mmap_threshold=args.mmap_threshold,
+    mmap_window=args.mmap_window, match_workers=args.match_workers,
+    match_worker_threshold=args.match_worker_threshold, debounce=args.debounce_ms / 1000,
+    max_latency=args.max_latency_ms / 1000, backend=args.backend)
   fg.start_stdio()
-  fg.scan_dir(b'.')
+  if (args.match_workers > 0):
+    fg.start_pool()
+  if (args.scan_threads > 0):
+    fg.scan_dir_async(b'.', args.scan_threads)
+  else:
+    fg.scan_dir(b'.')
   
   ed.event_loop()
+  fg.close()
 
 
 if (__name__ == '__main__'):
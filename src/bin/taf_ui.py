@@ -16,10 +16,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import random
+import time
 from subprocess import PIPE
 
-from gonium.fdm import AsyncDataStream, AsyncPopen
-from taf.event_proto import EventStreamClient, encode_vint
+from taf.event_proto import STATS_GAUGES, EventStreamClient, encode_vint
 
 logger = logging.getLogger('taf_ui')
 log = logger.log
@@ -29,34 +30,438 @@ def ed_shutdown(ed):
     ed.shutdown()
   return shutdown
 
-class Notifier:
-  def __init__(self, conf):
+class Remote:
+  # One forward connection: an ssh child running logs2stdout.py, and the event stream to it. Remote watch IDs are
+  # local to the connection; they're mapped back to the global pattern indices for notifiers.
+  # When the connection drops, it's re-established with exponential backoff, replaying our side of the session.
+  def __init__(self, notifier, fwd):
+    self.notifier = notifier
+    self.fwd = fwd
+    self.patterns = fwd.patterns
+    # {<remote watch ID>: <Pattern>}
+    self.watches = {}
     self._esc = None
     self._p = None
+    self._conn_gen = 0
+    self.stopped = False
+    # Whether we've got a stream to talk to at all; connected is only set once the remote side has answered.
+    self.up = False
+    # Reconnect bookkeeping, for monitoring.
+    self.connected = False
+    self.attempts = 0
+    self.reconnects = 0
+    self.t_lost = None
+    self.reconnect_latency = None
+    # Latest STATS reply from the remote side.
+    self.stats = None
+    self._dump_stats = False
+
+  def get_args(self):
+    conf = self.notifier._conf
+    fwd = self.fwd
+    args = [b'ssh']
+    if not (conf.ssh_control_path is None):
+      # Share one master connection per host between remotes, and across restarts.
+      args += [b'-o', b'ControlMaster=auto', b'-o', b'ControlPath=' + conf.ssh_control_path,
+        b'-o', 'ControlPersist={}'.format(conf.ssh_control_persist).encode('ascii')]
+    args += [fwd.tspec, b'~/.local/bin/logs2stdout.py', b'--cd', fwd.dir_]
+    if conf.resume:
+      # Have the remote side pick up where the last instance for this tree left off.
+      from hashlib import sha1
+      args += [b'--checkpoint', b'~/.taf/ckpt-' + sha1(fwd.dir_).hexdigest()[:16].encode('ascii')]
+    args += fwd.server_args
+    return args
+
+  def _connect(self):
+    # Sets up the other side, and returns a client stream talking to it.
+    args = self.get_args()
+    log(10, 'Calling out: %s', ' '.join((repr(a.decode('utf-8')) for a in args)))
+    self._p = p = self.notifier.popen(self.notifier._ed, args, bufsize=0, stdin=PIPE, stdout=PIPE)
+    return EventStreamClient(p.stdout_async, p.stdin_async)
+
+  def _disconnect(self):
+    for fl in (self._esc.fl_in, self._esc.fl_out):
+      try:
+        fl.close()
+      except Exception:
+        pass
+    try:
+      self._p.kill()
+      self._p.wait()
+    except OSError:
+      pass
+
+  def start(self):
+    if self.stopped:
+      return
+    ed = self.notifier._ed
+    self._esc = c = self._connect()
+    self._conn_gen += 1
+    self.up = True
+
+    c.cork()
+    c.send_config(self.notifier._conf.get_proto_config())
+    self.watches = {}
+    for pat in self.patterns:
+      w = c.add_watch(pat.sp, pat.fn_p)
+      self.watches[w.idx] = pat
+
+    if self.notifier._conf.reconnect:
+      lost = self._get_lost_handler(self._conn_gen)
+    else:
+      lost = ed_shutdown(ed)
+    if not (c.fl_in is None):
+      c.fl_in.process_close = lost
+      c.fl_out.process_close = lost
+    c.process_notify = self.process_notify
+    c.process_notify_context = self.process_notify_context
+    c.process_ack = self._process_ack
+    c.process_stats = self._process_stats
+    c.process_watch_warn = self.process_watch_warn
+    ws = self.notifier.get_ws()
+    if not (ws is None):
+      self.pick_ws(ws)
+    c.uncork()
+
+  def _process_ack(self):
+    if self.connected:
+      return
+    # First reply on this connection; the remote side is up.
+    self.connected = True
+    self.attempts = 0
+    if not (self.t_lost is None):
+      self.reconnect_latency = time.monotonic() - self.t_lost
+      self.t_lost = None
+      self.reconnects += 1
+      log(20, 'Reconnected to {!a} after {:.3f}s.'.format(self.get_name(), self.reconnect_latency))
+
+  def _get_lost_handler(self, gen):
+    def lost(*args, **kwargs):
+      if (gen != self._conn_gen):
+        # Already handled the other direction of this connection.
+        return
+      self._conn_gen += 1
+      self._lost()
+    return lost
+
+  def _close(self):
+    self.connected = False
+    self.up = False
+    self._disconnect()
+
+  def stop(self):
+    # For forwards dropped from the config; stays down.
+    self.stopped = True
+    self._conn_gen += 1
+    if self.up:
+      self._close()
+
+  def _lost(self):
+    if (self.t_lost is None):
+      self.t_lost = time.monotonic()
+    self._close()
+
+    conf = self.notifier._conf
+    delay = min(conf.reconnect_max_delay, conf.reconnect_delay * 2**self.attempts)
+    delay *= random.uniform(0.5, 1)
+    self.attempts += 1
+    log(30, 'Lost connection to {!a}; reconnect attempt {} in {:.1f}s.'.format(self.get_name(), self.attempts,
+      delay))
+    self.notifier._ed.set_timer(delay, self.start)
+
+  def get_stats(self):
+    return {
+      'connected': int(self.connected),
+      'reconnect_attempts': self.attempts,
+      'reconnects': self.reconnects,
+      'reconnect_latency_seconds': self.reconnect_latency or 0,
+    }
+
+  def request_stats(self, dump=False):
+    if not self.up:
+      return
+    self._dump_stats |= dump
+    self._esc.request_stats()
+
+  def _process_stats(self, stats):
+    self.stats = stats
+    if self._dump_stats:
+      self._dump_stats = False
+      log(20, 'Stats for {!a}: {}'.format(self.fwd, ' '.join('{}={}'.format(k, v) for (k, v) in sorted(stats.items()))))
+    self.notifier.write_metrics()
+
+  def get_name(self):
+    tspec = self.fwd.tspec
+    if (tspec is None):
+      host = 'local'
+    else:
+      host = tspec.decode('utf-8', 'replace')
+    return '{}:{}'.format(host, self.fwd.dir_.decode('utf-8', 'replace'))
+
+  def get_mask(self, ws):
+    mask = 0
+    for (i, p) in self.watches.items():
+      if (p in ws.patterns):
+        mask |= 1 << i
+    return encode_vint(mask, 'little')
+
+  def update(self, fwd, proto_config_changed=False):
+    # Bring a running connection in line with a reloaded config: unchanged patterns keep their watches (and set
+    # state), watches of dropped patterns are reused for new ones where possible, and everything else on the remote
+    # side stays as it is.
+    self.fwd = fwd
+    self.patterns = fwd.patterns
+    if not self.up:
+      # start() sets everything up from scratch anyway.
+      return
+
+    free = {}
+    for (i, p) in sorted(self.watches.items()):
+      free.setdefault((p.sp, p.fn_p), []).append(i)
+    watches = {}
+    new = []
+    for p in self.patterns:
+      ids = free.get((p.sp, p.fn_p))
+      if ids:
+        watches[ids.pop(0)] = p
+      else:
+        new.append(p)
+    stale = sorted(i for ids in free.values() for i in ids)
+
+    c = self._esc
+    c.cork()
+    if proto_config_changed:
+      c.send_config(self.notifier._conf.get_proto_config())
+    for p in new:
+      if stale:
+        w = c.replace_watch(stale.pop(0), p.sp, p.fn_p)
+      else:
+        w = c.add_watch(p.sp, p.fn_p)
+      watches[w.idx] = p
+    for i in stale:
+      c.remove_watch(i)
+    self.watches = watches
+    ws = self.notifier.get_ws()
+    if not (ws is None):
+      c.watch_set(self.get_mask(ws))
+    c.uncork()
+    log(20, 'Updated watches on {!a}: {} kept, {} new, {} removed.'.format(self.get_name(), len(watches) - len(new),
+      len(new), len(stale)))
+
+  def pick_ws(self, ws):
+    c = self._esc
+    c.cork()
+    c.watch_set(self.get_mask(ws))
+    c.reset()
+    c.uncork()
+
+  def reset(self):
+    self._esc.reset()
+
+  def process_notify(self, idx):
+    p = self.watches.get(idx)
+    if not (p is None):
+      self.notifier.process_notify(p.idx)
+
+  def process_notify_context(self, idx, lines):
+    p = self.watches.get(idx)
+    if not (p is None):
+      self.notifier.process_notify(p.idx, lines)
+
+  def process_watch_warn(self, idx, text):
+    p = self.watches.get(idx)
+    if (p is None):
+      return
+    log(30, 'Pattern {} ({!a} on {!a}) on {!a}: {}'.format(p.idx, p.sp, p.fn_p, self.fwd, text))
+
+
+class LocalRemote(Remote):
+  # A forward on this machine: FileGazer and its server stream run in our process, on our event loop, instead of
+  # logs2stdout.py behind ssh. With link='direct', the streams are linked and pass message objects to each other
+  # without encoding them; with link='socketpair', they talk over a socket pair like a remote would.
+  def __init__(self, notifier, fwd):
+    super().__init__(notifier, fwd)
+    self._fg = None
+
+  def _connect(self):
+    import os
+    from taf.gazer import FileGazer
+    conf = self.notifier._conf
+    ed = self.notifier._ed
+    fwd = self.fwd
+    gazer_args = dict(fwd.local_args)
+    link = gazer_args.pop('link')
+    scan_threads = gazer_args.pop('scan_threads')
+
+    ckpt = None
+    if conf.resume:
+      from hashlib import sha1
+      from taf.checkpoint import CheckpointStore
+      ckpt_path = os.path.expanduser('~/.taf/ckpt-' + sha1(fwd.dir_).hexdigest()[:16])
+      os.makedirs(os.path.dirname(ckpt_path), exist_ok=True)
+      ckpt = CheckpointStore(ckpt_path)
+
+    log(10, 'Watching {!a} in-process.'.format(self.get_name()))
+    self._fg = fg = FileGazer(ed, ckpt=ckpt, root=fwd.dir_, backend=getattr(conf.sa, 'backend', 'gonium'),
+      **gazer_args)
+    if (link == 'direct'):
+      fg.start_stream(None, None)
+      c = EventStreamClient(None, None)
+      c.link(fg.stream)
+    else:
+      # One socket pair per direction: write streams take their socket becoming readable to mean the other end went
+      # away.
+      import socket
+      fls = []
+      for _ in range(2):
+        (s_r, s_w) = socket.socketpair()
+        fls.append(fg.DataStream(ed, os.fdopen(os.dup(s_r.fileno()), 'rb', 0)))
+        fls.append(fg.DataStream(ed, os.fdopen(os.dup(s_w.fileno()), 'wb', 0), read_r=False))
+        s_r.close()
+        s_w.close()
+      fg.start_stream(fls[0], fls[3])
+      c = EventStreamClient(fls[2], fls[1])
+
+    if (scan_threads > 0):
+      fg.scan_dir_async(b'.', scan_threads)
+    else:
+      fg.scan_dir(b'.')
+    return c
+
+  def _disconnect(self):
+    c = self._esc
+    s = self._fg.stream
+    if (c.fl_in is None):
+      c.unlink()
+    else:
+      for fl in (c.fl_in, c.fl_out, s.fl_in, s.fl_out):
+        try:
+          fl.close()
+        except Exception:
+          pass
+    self._fg.close()
+    self._fg = None
+
+
+class Notifier:
+  def __init__(self, conf):
+    self._remotes = []
     self._watch_sets = None
+    self._ws_idx = None
+    self._stats_polling = False
     self._conf = conf
     self._ed = conf.sa.ed
     self.n = conf.notify_proxy()
-
-  def start_forward(self, tspec, dir_):
-    args = [b'ssh', tspec, b'~/.local/bin/logs2stdout.py', b'--cd', dir_]
-    log(10, 'Calling out: %s', ' '.join((repr(a.decode('utf-8')) for a in args)))
-    self._p = p = AsyncPopen(self._ed, args, bufsize=0, stdin=PIPE, stdout=PIPE)
-    self._esc = c = EventStreamClient(p.stdout_async, p.stdin_async)
-
-    c.send_config(self._conf.get_proto_config())
+    # Child process launcher matching our event loop.
+    self.popen = getattr(conf.sa, 'popen', None)
+    if (self.popen is None):
+      from gonium.fdm import AsyncPopen
+      self.popen = AsyncPopen
+
+  def start_forwards(self):
+    # All remotes share our event loop, and feed the same notifiers.
     self._set_config()
+    self._ws_idx = 0
+    for fwd in self._conf.get_forwards():
+      r = self._build_remote(fwd)
+      self._remotes.append(r)
+      r.start()
+    self._start_stats()
+
+  def _build_remote(self, fwd):
+    if (fwd.local_args is None):
+      return Remote(self, fwd)
+    return LocalRemote(self, fwd)
+
+  def reload(self, fn):
+    # Switch over to a new version of the config file, keeping connections to unchanged forwards and sending them just
+    # the differences.
+    old = self._conf
+    try:
+      conf = Config(old.sa, prev=old)
+      conf.load_config_by_fn(fn)
+      fwds = conf.get_forwards()
+    except Exception as exc:
+      log(40, 'Failed to reload config from {!a}, keeping the old one: {!r}'.format(fn, exc))
+      return
+    log(20, 'Reloading config from {!a}.'.format(fn))
 
-    sd = ed_shutdown(self._ed)
-    c.fl_in.process_close = sd
-    c.fl_out.process_close = sd
-    c.process_notify = self.process_notify
+    ws = self.get_ws()
+    self._conf = conf
+    self.n = conf.notify_proxy()
+    conf.run_inits(old)
+    old.run_finis(conf)
+    self.n.clear_menu()
+    self._set_config()
+    self._ws_idx = 0
+    for (i, ws_new) in enumerate(self._watch_sets):
+      if not (ws is None) and (ws_new.desc == ws.desc):
+        self._ws_idx = i
+        break
 
-    self.pick_ws(0)
+    proto_config_changed = (conf.get_proto_config().to_msg() != old.get_proto_config().to_msg())
+    remotes = {r.fwd.get_key(): r for r in self._remotes}
+    keep = [remotes.pop(fwd.get_key(), None) for fwd in fwds]
+    # Dropped ones go first, so that local forwards have written out their checkpoints before replacements load them.
+    for r in remotes.values():
+      log(20, 'Dropping forward {!a}.'.format(r.fwd))
+      r.stop()
+    self._remotes = []
+    for (fwd, r) in zip(fwds, keep):
+      if (r is None):
+        r = self._build_remote(fwd)
+        r.start()
+      else:
+        r.update(fwd, proto_config_changed)
+      self._remotes.append(r)
+    self._start_stats()
+
+  def _start_stats(self):
+    if (self._conf.stats_interval > 0) and not self._stats_polling:
+      self._stats_polling = True
+      self._ed.set_timer(self._conf.stats_interval, self._poll_stats)
+
+  def _poll_stats(self):
+    self._stats_polling = False
+    if (self._conf.stats_interval <= 0):
+      return
+    self.request_stats()
+    self._start_stats()
+
+  def request_stats(self, dump=False):
+    for r in self._remotes:
+      r.request_stats(dump)
+
+  def dump_stats(self):
+    # Log stats for all remotes, once the replies come in.
+    for (fwd, stats) in self.get_stats():
+      log(20, 'Connection stats for {!a}: {}'.format(fwd, stats))
+    self.request_stats(dump=True)
+
+  def write_metrics(self):
+    path = self._conf.metrics_path
+    if (path is None):
+      return
+    import os
+    tmp = path + '.tmp'
+    try:
+      with open(tmp, 'w') as f:
+        f.write(format_metrics(self._remotes))
+      os.rename(tmp, path)
+    except OSError as exc:
+      log(30, 'Failed to write metrics to {!a}: {!r}'.format(path, exc))
+
+  def get_ws(self):
+    if (self._ws_idx is None) or not self._watch_sets:
+      return None
+    return self._watch_sets[self._ws_idx]
 
   def pick_ws(self, idx):
-    self._esc.watch_set(self._watch_sets[idx].mask)
-    self._esc.reset()
+    self._ws_idx = idx
+    ws = self._watch_sets[idx]
+    for r in self._remotes:
+      if r.up:
+        r.pick_ws(ws)
 
   def get_ws_picker(self, idx):
     return self.wrap_bump_ml(self.pick_ws, idx)
@@ -69,23 +474,29 @@ class Notifier:
     return wrap
 
   def reset_remote(self):
-    self.wrap_bump_ml(self._esc.reset)()
+    self.wrap_bump_ml(self._reset_remotes)()
+
+  def _reset_remotes(self):
+    for r in self._remotes:
+      if r.up:
+        r.reset()
+
+  def get_stats(self):
+    return [(r.fwd, r.get_stats()) for r in self._remotes]
 
   def reset(self, *_):
     self.reset_remote()
     self.n.reset()
 
-  def process_notify(self, idx):
+  def process_notify(self, idx, lines=None):
     log(10, 'Notify: {}'.format(idx))
-    self.n.notify(idx)
+    if (lines is None):
+      self.n.notify(idx)
+      return
+    text = [bytes(l).decode('utf-8', 'replace') for l in lines]
+    self.n.notify_context(idx, text)
 
   def _set_config(self):
-    self._p = self._conf.patterns
-    for (i, p) in enumerate(self._p):
-      w = self._esc.add_watch(p.sp, p.fn_p)
-      if (w.idx != i):
-        raise ValueError('Watch setup idx mismatch: {} != {}'.format(w.idx, i))
-
     self._watch_sets = wss = self._conf.watch_sets
     for (i, ws) in enumerate(wss):
       self.n.add_menu_item(ws.desc, self.get_ws_picker(i))
@@ -94,19 +505,82 @@ class Notifier:
     self.n.add_menu_item('Reset', self.reset)
 
 
+def _metric_label(v):
+  return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_metrics(remotes):
+  # Prometheus text exposition format. Counters get the conventional _total suffix; per-watch values are labeled with
+  # the global pattern index.
+  samples = {}
+  for r in remotes:
+    rl = 'remote="{}"'.format(_metric_label(r.get_name()))
+    for (k, v) in r.get_stats().items():
+      if (k == 'reconnects'):
+        key = ('remote_reconnects_total', 'counter')
+      else:
+        key = ('remote_' + k, 'gauge')
+      samples.setdefault(key, []).append((rl, v))
+    for (k, v) in sorted((r.stats or {}).items()):
+      if (k in STATS_GAUGES):
+        (name, mtype) = (k, 'gauge')
+      else:
+        (name, mtype) = (k + '_total', 'counter')
+      ss = samples.setdefault((name, mtype), [])
+      if isinstance(v, list):
+        for (i, vi) in enumerate(v):
+          p = r.watches.get(i)
+          if not (p is None):
+            ss.append(('{},watch="{}"'.format(rl, p.idx), vi))
+      else:
+        ss.append((rl, v))
+
+  out = []
+  for ((name, mtype), ss) in sorted(samples.items()):
+    out.append('# TYPE taf_{} {}\n'.format(name, mtype))
+    for (labels, v) in ss:
+      out.append('taf_{}{{{}}} {}\n'.format(name, labels, v))
+  return ''.join(out)
+
+
 class Pattern:
-  def __init__(self, sp, fn_p, idx):
+  def __init__(self, sp, fn_p, idx, forward=None):
     self.sp = sp
     self.fn_p = fn_p
     self.idx = idx
+    self.forward = forward
 
   def __repr__(self):
     return '{}{}'.format(type(self).__name__, (self.sp, self.fn_p, self.idx))
     
 class WatchSet:
-  def __init__(self, mask, desc):
+  def __init__(self, mask, desc, patterns=()):
     self.mask = mask
     self.desc = desc
+    self.patterns = patterns
+
+class Forward:
+  # A remote logfile tree to watch, with the patterns to watch it for. Local ones have no tspec, and FileGazer
+  # arguments (local_args) instead of server_args.
+  def __init__(self, conf, tspec, dir_, server_args=(), local_args=None):
+    self.conf = conf
+    self.tspec = tspec
+    self.dir_ = dir_
+    self.server_args = list(server_args)
+    self.local_args = local_args
+    self.patterns = []
+
+  def add_pattern(self, sp, fn_p):
+    return self.conf.add_pattern(sp, fn_p, forward=self)
+
+  def get_key(self):
+    # Forwards with the same key can share a connection across config reloads.
+    la = self.local_args
+    if not (la is None):
+      la = tuple(sorted(la.items()))
+    return (self.tspec, self.dir_, tuple(self.server_args), la)
+
+  def __repr__(self):
+    return '{}{}'.format(type(self).__name__, (self.tspec, self.dir_))
 
 class ConfigError(Exception):
   pass
@@ -125,14 +599,39 @@ class NotifyProxy:
         m(*args, **kwargs)
     return proxy
 
+  def clear_menu(self):
+    for t in self.t:
+      cm = getattr(t, 'clear_menu', None)
+      if not (cm is None):
+        cm()
+
 
 class Config:
-  def __init__(self, sa):
+  def __init__(self, sa, prev=None):
+    # When reloading, prev is the running config; notifiers are carried over from it where possible.
     self.sa = sa
     self.patterns = []
     self.watch_sets = []
+    self.forwards = []
+    self.default_forward = None
+    self.ssh_control_path = None
+    self.ssh_control_persist = 600
     self.pid_path = None
     self.auto_reset = False
+    self.notify_batch_ms = 0
+    self.notify_batch = True
+    self.notify_context = 0
+    self.notify_context_lines = 5
+    self.max_line_len = 16384
+    self.watch_budget_ms = 0
+    self.watch_budget_strikes = 3
+    self.reconnect = True
+    self.reconnect_delay = 1
+    self.reconnect_max_delay = 300
+    self.resume = False
+    self.notify_timeout = 5
+    self.stats_interval = 0
+    self.metrics_path = None
 
     ns = {}
     for name in dir(self):
@@ -144,17 +643,79 @@ class Config:
     self.inits = {}
     self.finis = {}
     self.notifiers = []
+    self._prev_notifiers = [] if (prev is None) else list(prev.notifiers)
+    # {id(notifier): Dispatcher}; shared with the previous config, for the notifiers taken over from it.
+    self._dispatchers = {} if (prev is None) else prev._dispatchers
 
   def notify_proxy(self):
-    return NotifyProxy(self.notifiers)
+    return NotifyProxy([self._get_dispatcher(n) for n in self.notifiers])
+
+  def _get_dispatcher(self, n):
+    from taf.dispatch import Dispatcher
+    d = self._dispatchers.get(id(n))
+    if (d is None):
+      d = self._dispatchers[id(n)] = Dispatcher(n, self.sa.ed)
+    d.timeout = self.notify_timeout
+    return d
 
   def set_autoreset(self, v):
     self.auto_reset = bool(v)
 
+  def set_notify_batch(self, ms):
+    # Coalesce notifications fired within this many ms into one message; None to disable.
+    self.notify_batch = not (ms is None)
+    if self.notify_batch:
+      self.notify_batch_ms = int(ms)
+
+  def set_reconnect(self, enabled=True, delay=1, max_delay=300, resume=False):
+    # Reconnect to remotes after losing them, waiting delay*2**n seconds (capped at max_delay, with jitter) before
+    # attempt n. With resume, remotes keep checkpoints and replay what was logged while disconnected; this needs a
+    # logs2stdout.py on the remote side that knows --checkpoint, which older ones fail to start on.
+    self.reconnect = bool(enabled)
+    self.reconnect_delay = delay
+    self.reconnect_max_delay = max_delay
+    self.resume = bool(resume)
+
+  def set_notify_timeout(self, seconds=5):
+    # Notifiers run off the event loop; this is how long a call to one may take before we mark it dead (holding its
+    # updates until the call returns), and how long to wait for outstanding ones on exit.
+    self.notify_timeout = seconds
+
+  def set_stats(self, interval=60, metrics_path=None):
+    # Poll remotes for STATS every interval seconds (0 to only do so on SIGUSR2), and write the results to
+    # metrics_path in Prometheus text format, if given.
+    from os.path import expanduser
+    self.stats_interval = interval
+    if not (metrics_path is None):
+      metrics_path = expanduser(metrics_path)
+    self.metrics_path = metrics_path
+
+  def set_notify_context(self, max_len=200, max_lines=5):
+    # Have the remote send up to max_lines matched lines per notify, truncated to max_len octets; 0 to disable.
+    self.notify_context = int(max_len)
+    self.notify_context_lines = int(max_lines)
+
+  def set_match_limits(self, max_line_len=16384, budget_ms=100, strikes=3):
+    # Only match against the first max_line_len octets of each line, and have the remote side disable patterns that
+    # take longer than budget_ms on a single line strikes times. 0 disables either limit; the budget is off unless set
+    # here, since keeping track of it costs some matching throughput. A search can't be cut short, so the budget only
+    # catches patterns after they've blown it; with it on, patterns with nested repeats (like (a+)+), which can
+    # backtrack for seconds on a short line, are disabled up front.
+    self.max_line_len = int(max_line_len)
+    self.watch_budget_ms = budget_ms
+    self.watch_budget_strikes = int(strikes)
+
   def get_proto_config(self):
     from taf.event_proto import Config
     c = Config()
     c.auto_reset = self.auto_reset
+    c.notify_batch = self.notify_batch
+    c.notify_batch_ms = self.notify_batch_ms
+    c.notify_context = self.notify_context
+    c.notify_context_lines = self.notify_context_lines
+    c.max_line_len = self.max_line_len
+    c.watch_budget_us = int(self.watch_budget_ms * 1000)
+    c.watch_budget_strikes = self.watch_budget_strikes
     return c
   
   def load_config_by_fn(self, fn):
@@ -165,10 +726,13 @@ class Config:
     if (not self.notifiers):
       raise ConfigError('No notifier configured.')
 
-  def add_pattern(self, sp, fn_p):
+  def add_pattern(self, sp, fn_p, forward=None):
+    # Patterns not tied to a specific forward go to the one set up by set_forward_args().
     idx = len(self.patterns)
-    p = Pattern(sp, fn_p, idx)
+    p = Pattern(sp, fn_p, idx, forward)
     self.patterns.append(p)
+    if not (forward is None):
+      forward.patterns.append(p)
     return p
 
   def add_watchset(self, patterns, desc):
@@ -177,12 +741,59 @@ class Config:
       mask += 1<<p.idx
 
     mask = encode_vint(mask, 'little')
-    ws = WatchSet(mask, desc)
+    ws = WatchSet(mask, desc, tuple(patterns))
     self.watch_sets.append(ws)
     return ws
 
-  def set_forward_args(self, *args):
-    self.forward_args = args
+  def set_forward_args(self, tspec, dir_, *server_args):
+    self.forward_args = (tspec, dir_) + server_args
+    fwd = Forward(self, tspec, dir_, server_args)
+    if not (self.default_forward is None):
+      self.forwards.remove(self.default_forward)
+    self.default_forward = fwd
+    self.forwards.insert(0, fwd)
+
+  def add_forward(self, tspec, dir_, *server_args):
+    fwd = Forward(self, tspec, dir_, server_args)
+    self.forwards.append(fwd)
+    return fwd
+
+  def add_local_forward(self, dir_, link='direct', scan_threads=4, **gazer_args):
+    # A logfile tree on this machine, watched from within our process rather than through ssh. gazer_args are passed
+    # on to FileGazer (e.g. watch_dirs=True).
+    from os.path import abspath, expanduser
+    if not (link in ('direct', 'socketpair')):
+      raise ConfigError('Unknown local link type {!a}.'.format(link))
+    if (gazer_args.get('match_workers', 0) > 0):
+      # The pool forks its workers, and by the time a forward connects we may well have threads running (GTK,
+      # notifier dispatchers, directory scanners); children forked from those can deadlock on locks held elsewhere.
+      raise ConfigError('match_workers is not supported for local forwards; use an ssh forward to localhost instead.')
+    if isinstance(dir_, str):
+      dir_ = dir_.encode('utf-8')
+    fwd = Forward(self, None, abspath(expanduser(dir_)), local_args=dict(gazer_args, link=link,
+      scan_threads=scan_threads))
+    self.forwards.append(fwd)
+    return fwd
+
+  def set_ssh_control(self, path='~/.taf/run/ssh-%C', persist=600):
+    # Reuse (or set up) a shared ssh master connection per host; None to disable.
+    from os.path import expanduser
+    if not (path is None):
+      if isinstance(path, str):
+        path = path.encode('utf-8')
+      path = expanduser(path)
+    self.ssh_control_path = path
+    self.ssh_control_persist = persist
+
+  def get_forwards(self):
+    if not self.forwards:
+      raise ConfigError('No forward configured.')
+    default = self.default_forward or self.forwards[0]
+    for p in self.patterns:
+      if (p.forward is None):
+        p.forward = default
+        default.patterns.append(p)
+    return self.forwards
 
   def set_pid_file(self, path):
     from os.path import expanduser
@@ -192,20 +803,35 @@ class Config:
     self.notifiers.append(n)
     return n
 
+  def _reuse_notifier(self, cls):
+    # On reload, notifiers holding on to outside state (tray icons, USB devices) are taken over from the running
+    # config by type, in order.
+    for n in self._prev_notifiers:
+      if (type(n) is cls):
+        self._prev_notifiers.remove(n)
+        return self.add_notifier(n)
+    return None
+
   def build_notifier_ti_gtk(self):
     from taf.ti_gtk import GtkTrayIcon, init
     self.inits['gtk'] = init
-    return self.add_notifier(GtkTrayIcon(self.sa))
+    return self._reuse_notifier(GtkTrayIcon) or self.add_notifier(GtkTrayIcon(self.sa))
 
-  def build_notifier_py(self, notify, reset=do_nothing):
+  def build_notifier_py(self, notify, reset=do_nothing, notify_context=None):
     from taf.notify_py import PyNotifier
-    return self.add_notifier(PyNotifier(notify, reset))
+    return self.add_notifier(PyNotifier(notify, reset, notify_context))
   
   def build_notifier_blink1(self):
     from taf.notify_blink1 import BlinkNotifier
-    n = BlinkNotifier()
-    self.finis[id(n)] = n.reset
-    return self.add_notifier(n)
+    n = self._reuse_notifier(BlinkNotifier)
+    if (n is None):
+      n = self.add_notifier(BlinkNotifier())
+    else:
+      # Watch indices may have moved; the config sets them up again.
+      n.clear_looks()
+    # Through the dispatcher, so it's not racing a call still in progress there.
+    self.finis[id(n)] = lambda: self._get_dispatcher(n).reset()
+    return n
 
   def file_pid(self):
     if (self.pid_path is None):
@@ -214,13 +840,22 @@ class Config:
     self.pid_file = f = PidFile(self.pid_path)
     f.lock()
 
-  def run_inits(self):
-    for init in self.inits.values():
-      init()
-
-  def run_finis(self):
-    for fini in self.finis.values():
-      fini()
+  def run_inits(self, prev=None):
+    # With prev, only runs the ones prev didn't already.
+    for (k, init) in self.inits.items():
+      if (prev is None) or not (k in prev.inits):
+        init()
+
+  def run_finis(self, next_=None):
+    # With next_, only runs the ones for things next_ doesn't take over.
+    for (k, fini) in self.finis.items():
+      if (next_ is None) or not (k in next_.finis):
+        fini()
+    keep = set() if (next_ is None) else set(id(n) for n in next_.notifiers)
+    for n in self.notifiers:
+      d = None if (id(n) in keep) else self._dispatchers.pop(id(n), None)
+      if not (d is None):
+        d.close()
 
 def main():
   import argparse
@@ -228,18 +863,21 @@ def main():
   import signal
   import sys
 
-  from gonium.service_aggregation import ServiceAggregate
-
   p = argparse.ArgumentParser()
   p.add_argument('--config', '-c', default='~/.taf/config')
   p.add_argument('--loglevel', '-L', default=20, type=int)
+  p.add_argument('--backend', default='gonium', choices=('gonium', 'asyncio'), help='Event loop implementation to use.')
 
   args = p.parse_args()
   logging.basicConfig(format='%(asctime)s %(levelno)s %(message)s', stream=sys.stderr, level=args.loglevel)
 
-  sa = ServiceAggregate()
-
-  sa.bump_ml = lambda: os.write(sa.sc._pipe_w, b'\x00')
+  if (args.backend == 'asyncio'):
+    from taf.aio import AioServiceAggregate
+    sa = AioServiceAggregate()
+  else:
+    from gonium.service_aggregation import ServiceAggregate
+    sa = ServiceAggregate()
+    sa.bump_ml = lambda: os.write(sa.sc._pipe_w, b'\x00')
 
   config_fn = os.path.expanduser(args.config)
   config = Config(sa)
@@ -248,27 +886,42 @@ def main():
   config.file_pid()
 
   n = Notifier(config)
-  n.start_forward(*config.forward_args)
+  n.start_forwards()
 
   # Signal handling
-  def handle_signals(si_l):
-    for si in si_l:
-      if (si.signo in (signal.SIGTERM, signal.SIGINT)):
-        sa.ed.shutdown()
-        log(50, 'Shutting down on signal {}.'.format(si.signo))
-        break
-      if (si.signo == signal.SIGUSR1):
-        n.reset()
-        break
-
-  sa.sc.handle_signals.new_listener(handle_signals)
-  for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1):
-    sa.sc.sighandler_install(sig, sa.sc.SA_RESTART)
+  def handle_signal(signo):
+    if (signo in (signal.SIGTERM, signal.SIGINT)):
+      sa.ed.shutdown()
+      log(50, 'Shutting down on signal {}.'.format(signo))
+    elif (signo == signal.SIGUSR1):
+      n.reset()
+    elif (signo == signal.SIGUSR2):
+      n.dump_stats()
+    elif (signo == signal.SIGHUP):
+      n.reload(config_fn)
+    else:
+      return False
+    return True
+
+  sigs = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2)
+  if (args.backend == 'asyncio'):
+    for sig in sigs:
+      sa.add_signal_handler(sig, handle_signal, sig)
+  else:
+    def handle_signals(si_l):
+      for si in si_l:
+        if handle_signal(si.signo):
+          break
+
+    sa.sc.handle_signals.new_listener(handle_signals)
+    for sig in sigs:
+      sa.sc.sighandler_install(sig, sa.sc.SA_RESTART)
 
   config.run_inits()
   log(20, 'Starting operation.')
   sa.ed.event_loop()
-  config.run_finis()
+  # The config may have been reloaded in the meantime.
+  n._conf.run_finis()
   log(20, 'Terminating.')
 
 if (__name__ == '__main__'):
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+#Copyright 2015 Sebastian Hagen
+# This file is part of taf.
+#
+# taf is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# taf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# asyncio backend: stand-ins for the parts of gonium we use (ED timers and loop control, AsyncDataStream,
+# AsyncPopen, InotifyWatch, and the bits of ServiceAggregate taf_ui needs), on top of an asyncio event loop.
+# EventStreams work with these unchanged.
+
+import asyncio
+import ctypes
+import functools
+import logging
+import os
+import struct
+import subprocess
+import threading
+
+logger = logging.getLogger('aio')
+log = logger.log
+
+
+class AioED:
+  def __init__(self, loop=None):
+    if (loop is None):
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+    self.loop = loop
+    self._thread = threading.get_ident()
+
+  def set_timer(self, interval, f, args=(), kwargs={}, interval_relative=True):
+    # One-shot timers, as with gonium; returns something with a cancel() method. May be called from other threads
+    # (e.g. GUI callbacks), in which case the returned handle can't cancel the timer anymore.
+    cb = functools.partial(f, *args, **kwargs)
+    if (threading.get_ident() != self._thread):
+      return self.loop.call_soon_threadsafe(self.loop.call_later, interval, cb)
+    return self.loop.call_later(interval, cb)
+
+  def shutdown(self):
+    if (threading.get_ident() != self._thread):
+      self.loop.call_soon_threadsafe(self.loop.stop)
+    else:
+      self.loop.stop()
+
+  def event_loop(self):
+    self.loop.run_forever()
+
+
+class AioStream(asyncio.Protocol):
+  # One direction of a pipe, with AsyncDataStream's interface: input is buffered until at least size_need octets are
+  # available, then passed to process_input(), which says how much of it it's done with by calling
+  # discard_inbuf_data(). Output written before the pipe is connected is held back until then.
+  # When the transport's write buffer fills up, process_pause(True) is called, and process_pause(False) once it has
+  # drained again; users that keep producing output should hold off in between.
+  def __init__(self, ed, f, read_r=True):
+    self.ed = ed
+    self.f = f
+    self.size_need = 0
+    self.transport = None
+    self.paused = False
+    self._buf = bytearray()
+    self._out = []
+    self._disc = 0
+    self._closed = False
+    loop = ed.loop
+    if read_r:
+      coro = loop.connect_read_pipe(lambda: self, f)
+    else:
+      coro = loop.connect_write_pipe(lambda: self, f)
+    self._connecting = loop.create_task(coro)
+
+  def process_input(self, data):
+    pass
+
+  def process_close(self):
+    pass
+
+  def process_pause(self, paused):
+    pass
+
+  def connection_made(self, transport):
+    self.transport = transport
+    if self._out:
+      transport.writelines(self._out)
+      self._out = []
+
+  def data_received(self, data):
+    buf = self._buf
+    buf += data
+    if (len(buf) < self.size_need):
+      return
+    self._disc = 0
+    mv = memoryview(buf)
+    try:
+      self.process_input(mv)
+    finally:
+      mv.release()
+    if self._disc:
+      del(buf[:self._disc])
+
+  def discard_inbuf_data(self, n):
+    self._disc += n
+
+  def eof_received(self):
+    return False
+
+  def connection_lost(self, exc):
+    if self._closed:
+      return
+    self._closed = True
+    self.process_close()
+
+  def pause_writing(self):
+    self.paused = True
+    self.process_pause(True)
+
+  def resume_writing(self):
+    self.paused = False
+    self.process_pause(False)
+
+  def pause_reading(self):
+    if not (self.transport is None):
+      self.transport.pause_reading()
+
+  def resume_reading(self):
+    if not (self.transport is None):
+      self.transport.resume_reading()
+
+  def send_bytes(self, bufs):
+    if (self.transport is None):
+      self._out.extend(bufs)
+      return
+    self.transport.writelines(bufs)
+
+  def close(self):
+    self._closed = True
+    if (self.transport is None):
+      self._connecting.cancel()
+      return
+    self.transport.close()
+
+
+class AioPopen(subprocess.Popen):
+  # A child process with its stdin/stdout (as far as they're pipes) hooked up to our loop, like gonium's AsyncPopen.
+  def __init__(self, ed, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    if not (self.stdout is None):
+      self.stdout_async = AioStream(ed, self.stdout)
+    if not (self.stdin is None):
+      self.stdin_async = AioStream(ed, self.stdin, read_r=False)
+
+
+_inotify_event = struct.Struct('=iIII')
+
+class InotifyWatch:
+  # Reads all pending events each time the inotify fd becomes readable, calling process_event(wd, mask, cookie, name)
+  # for each; names come NUL-padded, as from gonium.
+  def __init__(self, ed):
+    self._libc = libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if (fd < 0):
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e))
+    self.fd = fd
+    self.ed = ed
+    ed.loop.add_reader(fd, self._read)
+
+  def add_watch(self, pn, mask):
+    wd = self._libc.inotify_add_watch(self.fd, pn, mask)
+    if (wd < 0):
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e), pn)
+    return wd
+
+  def process_event(self, wd, mask, cookie, name):
+    pass
+
+  def _read(self):
+    while True:
+      try:
+        data = os.read(self.fd, 1 << 16)
+      except BlockingIOError:
+        return
+      off = 0
+      while (off < len(data)):
+        (wd, mask, cookie, l) = _inotify_event.unpack_from(data, off)
+        off += _inotify_event.size
+        name = data[off:off+l]
+        off += l
+        self.process_event(wd, mask, cookie, name)
+
+  def close(self):
+    self.ed.loop.remove_reader(self.fd)
+    os.close(self.fd)
+
+
+class AioServiceAggregate:
+  # The parts of gonium's ServiceAggregate taf_ui uses: ed, bump_ml() and signal handling.
+  popen = AioPopen
+  backend = 'asyncio'
+
+  def __init__(self):
+    self.ed = AioED()
+
+  def bump_ml(self):
+    # Timers set from other threads wake up the loop by themselves.
+    pass
+
+  def add_signal_handler(self, signo, f, *args):
+    self.ed.loop.add_signal_handler(signo, f, *args)
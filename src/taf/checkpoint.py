@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+#Copyright 2015 Sebastian Hagen
+# This file is part of taf.
+#
+# taf is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# taf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Durable per-file read offsets.
+#
+# The store is an append-only file: an 8-octet magic, followed by fixed-size records of
+#   <device (uint64)>, <inode (uint64)>, <offset (uint64)>, <size (uint64)>, <mtime in ns (uint64)>
+# with later records for the same (device, inode) superseding earlier ones. Size and mtime are the file's as of the
+# checkpoint, to tell whether the file still is the one the offset was taken on (see fits()). Records with an offset
+# of TOMBSTONE mark files that went away; without them, a file later created on the same inode would inherit the old
+# offset. The store is rewritten in compacted form once superseded records make up most of it.
+#
+# Stores written by older versions (magic TAFCKPT1; records without size and mtime) are read, and rewritten in the
+# current format on the next flush.
+
+import logging
+import os
+import struct
+
+logger = logging.getLogger('checkpoint')
+log = logger.log
+
+MAGIC = b'TAFCKPT2'
+MAGIC_V1 = b'TAFCKPT1'
+_rec = struct.Struct('>QQQQQ')
+_rec_v1 = struct.Struct('>QQQ')
+TOMBSTONE = (1 << 64) - 1
+
+
+def fits(rec, st):
+  # Whether checkpoint record rec, an (offset, size, mtime_ns) tuple, can still be applied to the file stat()ed as
+  # st: files may have been appended to since, but not shrunk, or modified without growing.
+  (off, size, mtime_ns) = rec
+  if (st.st_size < max(off, size)):
+    return False
+  if (size == 0) and (mtime_ns == 0):
+    # Old record; offset is all we know.
+    return True
+  if (st.st_size == size):
+    return (st.st_mtime_ns == mtime_ns)
+  return (st.st_mtime_ns >= mtime_ns)
+
+
+class CheckpointStore:
+  def __init__(self, path):
+    self.path = path
+    # {(device, inode): (offset, size, mtime_ns)}, as on disk.
+    self.offs = {}
+    # Changes not written out yet; None values are pending tombstones.
+    self.dirty = {}
+    self.records = 0
+    self.t_flush = None
+    self._rewrite = False
+    self._load()
+
+  def _load(self):
+    try:
+      f = open(self.path, 'rb')
+    except FileNotFoundError:
+      return
+
+    with f:
+      self.t_flush = os.fstat(f.fileno()).st_mtime
+      data = f.read()
+
+    if data.startswith(MAGIC):
+      rec = _rec
+    elif data.startswith(MAGIC_V1):
+      rec = _rec_v1
+      self._rewrite = True
+    else:
+      log(30, 'Ignoring checkpoint file {!a} with bad magic.'.format(self.path))
+      self.t_flush = None
+      self._rewrite = True
+      return
+
+    off = len(MAGIC)
+    end = len(data) - (len(data) - off) % rec.size
+    if (end < len(data)):
+      # Torn final write; cut it off so later appends stay aligned.
+      os.truncate(self.path, end)
+    offs = self.offs
+    for vals in rec.iter_unpack(memoryview(data)[off:end]):
+      key = vals[:2]
+      if (vals[2] == TOMBSTONE):
+        offs.pop(key, None)
+      elif (rec is _rec_v1):
+        offs[key] = (vals[2], 0, 0)
+      else:
+        offs[key] = vals[2:]
+    self.records = (end - off) // rec.size
+    log(20, 'Loaded {} checkpoints from {!a}.'.format(len(offs), self.path))
+
+  def get(self, key):
+    # Returns the (offset, size, mtime_ns) record for key, or None.
+    if (key in self.dirty):
+      return self.dirty[key]
+    return self.offs.get(key)
+
+  def set(self, key, off, size, mtime_ns):
+    rec = (off, size, mtime_ns)
+    if (self.get(key) != rec):
+      self.dirty[key] = rec
+
+  def discard(self, key):
+    if (key in self.offs):
+      self.dirty[key] = None
+    else:
+      self.dirty.pop(key, None)
+
+  def flush(self):
+    if not self.dirty:
+      return
+    offs = self.offs
+    for (key, rec) in self.dirty.items():
+      if (rec is None):
+        offs.pop(key, None)
+      else:
+        offs[key] = rec
+    if self._rewrite or (self.records + len(self.dirty) > 2*len(offs) + 1024):
+      self._compact()
+    else:
+      data = b''.join(_rec.pack(*key, *(rec or (TOMBSTONE, 0, 0))) for (key, rec) in self.dirty.items())
+      fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o600)
+      try:
+        if (os.fstat(fd).st_size == 0):
+          data = MAGIC + data
+        os.write(fd, data)
+      finally:
+        os.close(fd)
+      self.records += len(self.dirty)
+    self.dirty.clear()
+
+  def _compact(self):
+    tmp = self.path + (b'.tmp' if isinstance(self.path, bytes) else '.tmp')
+    with open(tmp, 'wb') as f:
+      f.write(MAGIC)
+      f.write(b''.join(_rec.pack(*key, *rec) for (key, rec) in self.offs.items()))
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp, self.path)
+    self.records = len(self.offs)
+    self._rewrite = False
+
+
+def _test_checkpoint():
+  import shutil
+  import tempfile
+  from types import SimpleNamespace
+  d = tempfile.mkdtemp()
+  try:
+    # Paths may be bytes, as they are for local forwards.
+    path = os.path.join(os.fsencode(d), b'ckpt')
+    cs = CheckpointStore(path)
+    cs.set((1, 2), 10, 20, 30)
+    cs.set((1, 3), 5, 6, 7)
+    cs.flush()
+    cs.set((1, 2), 15, 20, 31)
+    cs.discard((1, 3))
+    # Discarding something that never got written out leaves no trace.
+    cs.set((1, 4), 1, 1, 1)
+    cs.discard((1, 4))
+    cs.flush()
+    if (os.path.getsize(path) != len(MAGIC) + 4 * _rec.size):
+      raise ValueError('Bad record count: {}'.format(os.path.getsize(path)))
+    # Tombstones keep discarded records from coming back.
+    if (CheckpointStore(path).offs != {(1, 2): (15, 20, 31)}):
+      raise ValueError('Bad reload: {!r}'.format(CheckpointStore(path).offs))
+
+    # A torn final write is cut off, and later appends stay aligned.
+    with open(path, 'ab') as f:
+      f.write(b'\x00' * 7)
+    cs = CheckpointStore(path)
+    cs.set((1, 5), 2, 3, 4)
+    cs.flush()
+    if (CheckpointStore(path).offs != {(1, 2): (15, 20, 31), (1, 5): (2, 3, 4)}):
+      raise ValueError('Bad reload after torn write: {!r}'.format(CheckpointStore(path).offs))
+
+    # Compaction.
+    for i in range(1100):
+      cs.set((1, 2), i, 20, 31)
+      cs.flush()
+    if (os.path.getsize(path) > len(MAGIC) + 1200 * _rec.size) or os.path.exists(path + b'.tmp'):
+      raise ValueError('Not compacted: {}'.format(os.path.getsize(path)))
+    if (CheckpointStore(path).offs != {(1, 2): (1099, 20, 31), (1, 5): (2, 3, 4)}):
+      raise ValueError('Bad reload after compaction: {!r}'.format(CheckpointStore(path).offs))
+
+    # Old stores are read, and rewritten in the current format on the next flush.
+    path = os.path.join(d, 'ckpt1')
+    with open(path, 'wb') as f:
+      f.write(MAGIC_V1 + _rec_v1.pack(1, 2, 10) + _rec_v1.pack(1, 3, 11) + _rec_v1.pack(1, 3, TOMBSTONE))
+    cs = CheckpointStore(path)
+    if (cs.get((1, 2)) != (10, 0, 0)) or not (cs.get((1, 3)) is None):
+      raise ValueError('Bad v1 load: {!r}'.format(cs.offs))
+    cs.set((1, 4), 1, 2, 3)
+    cs.flush()
+    with open(path, 'rb') as f:
+      data = f.read()
+    if not data.startswith(MAGIC) or (CheckpointStore(path).offs != {(1, 2): (10, 0, 0), (1, 4): (1, 2, 3)}):
+      raise ValueError('Bad v1 rewrite: {!r}'.format(data))
+  finally:
+    shutil.rmtree(d)
+
+  def st(size, mtime_ns):
+    return SimpleNamespace(st_size=size, st_mtime_ns=mtime_ns)
+  for (rec, s, want) in (((10, 20, 30), st(20, 30), True), ((10, 20, 30), st(20, 31), False),
+      ((10, 20, 30), st(25, 31), True), ((10, 20, 30), st(25, 29), False), ((10, 20, 30), st(15, 30), False),
+      ((10, 0, 0), st(10, 5), True), ((10, 0, 0), st(9, 5), False)):
+    if (fits(rec, s) != want):
+      raise ValueError('Bad fit for {!r} on {!r}: {!r}'.format(rec, s, not want))
+
+
+if (__name__ == '__main__'):
+  _test_checkpoint()
+  print('Tests done.')
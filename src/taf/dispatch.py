@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#Copyright 2015 Sebastian Hagen
+# This file is part of taf.
+#
+# taf is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# taf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Notifier dispatch, off the event loop.
+#
+# Notifiers talk to output devices (USB LEDs, tray icons) that can be slow or hang outright; calls to them are handed
+# to a worker thread per notifier, or to the notifier's own main loop if it has one (run_soon(); e.g. GTK's). Calls
+# still pending when new ones come in are coalesced into the latest state: a reset supersedes everything queued
+# before it, and a notify supersedes an earlier one for the same watch. A notifier that stays stuck in one call for
+# longer than the timeout is marked dead: its updates are still merged, but not run (or waited for on close()) until
+# that call returns, at which point whatever is pending is.
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger('dispatch')
+log = logger.log
+
+
+class Dispatcher:
+  def __init__(self, n, ed, timeout=5):
+    self.n = n
+    self.ed = ed
+    # Seconds a call may take before we mark the notifier dead, and to wait for pending calls on close().
+    self.timeout = timeout
+    self.name = type(n).__name__
+    # {('notify', idx) or 'reset': (method name, args)}, in the order they're to be made.
+    self._ops = {}
+    self._cond = threading.Condition()
+    self._idle = threading.Event()
+    self._idle.set()
+    self._closed = False
+    self._busy_since = None
+    self.dead = False
+    self._watching = False
+    self._scheduled = False
+    self._run_soon = getattr(n, 'run_soon', None)
+    if (self._run_soon is None):
+      self._thread = threading.Thread(target=self._work, name='notify-' + self.name, daemon=True)
+      self._thread.start()
+
+  def __getattr__(self, name):
+    # Menu setup and such go straight through; notifiers marshal those themselves.
+    return getattr(self.n, name)
+
+  def notify(self, idx):
+    self._put(('notify', idx), 'notify', (idx,))
+
+  def notify_context(self, idx, lines):
+    # Notifiers that don't know about matched lines just get a plain notify.
+    if hasattr(self.n, 'notify_context'):
+      self._put(('notify', idx), 'notify_context', (idx, lines))
+    else:
+      self.notify(idx)
+
+  def reset(self):
+    self._put('reset', 'reset', ())
+
+  def _put(self, key, name, args):
+    with self._cond:
+      if self._closed:
+        return
+      if (key == 'reset'):
+        self._ops.clear()
+      self._ops[key] = (name, args)
+      self._idle.clear()
+      if not self.dead:
+        self._wake()
+    if not self._watching:
+      self._watching = True
+      self.ed.set_timer(self.timeout, self._watch)
+
+  def _wake(self):
+    # Call with _cond held.
+    if (self._run_soon is None):
+      self._cond.notify()
+    elif not self._scheduled:
+      self._scheduled = True
+      self._run_soon(self._run)
+
+  def _watch(self):
+    # Runs on the event loop while calls are outstanding.
+    self._watching = False
+    with self._cond:
+      t = self._busy_since
+      died = not ((t is None) or self.dead) and (time.monotonic() - t >= self.timeout)
+      if died:
+        self.dead = True
+    if died:
+      log(30, 'Notifier {} has been stuck for over {}s; marking it dead, and holding its updates until it returns.'
+        .format(self.name, self.timeout))
+    if not self._idle.is_set():
+      self._watching = True
+      self.ed.set_timer(self.timeout, self._watch)
+
+  def _take(self):
+    ops = list(self._ops.values())
+    self._ops.clear()
+    return ops
+
+  def _call(self, ops):
+    for (name, args) in ops:
+      self._busy_since = time.monotonic()
+      try:
+        getattr(self.n, name)(*args)
+      except Exception as exc:
+        log(40, 'Notifier {} failed on {}(): {!r}'.format(self.name, name, exc))
+      with self._cond:
+        dt = time.monotonic() - self._busy_since
+        self._busy_since = None
+        revived = self.dead
+        if revived:
+          self.dead = False
+          pending = len(self._ops)
+          if pending:
+            self._wake()
+      if revived:
+        log(30, 'Notifier {} is back after {:.1f}s; replaying {} pending updates.'.format(self.name, dt, pending))
+
+  def _work(self):
+    # Worker thread.
+    while True:
+      with self._cond:
+        while not (self._ops or self._closed):
+          self._idle.set()
+          self._cond.wait()
+        if not self._ops:
+          self._idle.set()
+          return
+        ops = self._take()
+      self._call(ops)
+
+  def _run(self):
+    # Called on the notifier's own main loop.
+    with self._cond:
+      self._scheduled = False
+      ops = self._take()
+    self._call(ops)
+    with self._cond:
+      if not (self._ops or self._scheduled):
+        self._idle.set()
+
+  def close(self):
+    # Stops taking calls, and waits for the pending ones for up to timeout seconds.
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    if self.dead:
+      log(30, 'Not waiting for dead notifier {}.'.format(self.name))
+      return
+    if not self._idle.wait(self.timeout):
+      log(30, 'Gave up waiting for notifier {} to finish.'.format(self.name))
+
+
+def _test_dispatcher():
+  class ED:
+    def __init__(self):
+      self.timers = []
+    def set_timer(self, dt, f):
+      self.timers.append(f)
+    def run_timers(self):
+      (fs, self.timers) = (self.timers, [])
+      for f in fs:
+        f()
+
+  calls = []
+  release = threading.Event()
+  class N:
+    def notify(self, idx):
+      calls.append(('notify', idx))
+      if (idx == 0):
+        release.wait(5)
+    def reset(self):
+      calls.append(('reset',))
+
+  ed = ED()
+  d = Dispatcher(N(), ed, timeout=0.05)
+  d.notify(0)
+  time.sleep(0.1)
+  ed.run_timers()
+  if not d.dead:
+    raise ValueError('Stuck notifier not marked dead.')
+  # Updates to a dead notifier are merged, not run; and close() doesn't wait for it.
+  d.notify(1)
+  d.reset()
+  d.notify(2)
+  d.notify(2)
+  time.sleep(0.05)
+  if (calls != [('notify', 0)]):
+    raise ValueError('Dead notifier got calls: {!r}'.format(calls))
+  t = time.monotonic()
+  d.close()
+  if (time.monotonic() - t > 1):
+    raise ValueError('close() waited for dead notifier.')
+  # Once back, it gets the latest state.
+  release.set()
+  if not d._idle.wait(5) or d.dead or (calls != [('notify', 0), ('reset',), ('notify', 2)]):
+    raise ValueError('Bad replay after recovery: {!r}'.format(calls))
+
+
+if (__name__ == '__main__'):
+  _test_dispatcher()
+  print('Tests done.')
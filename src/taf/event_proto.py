@@ -24,21 +24,47 @@
 #   0x03: Lists (<uint32 object count>, <object...>)
 #   0x04: UTF-8 encoded text
 # All integers are encoded big-endian.
+#
+# That is protocol version 1. Version 2 replaces the header with
+#   <object type (uint8)>, <recursive total object length (varint)>,
+# and list counts with varints, varints being LEB128 (7 bits per octet, least significant group first, high bit set
+# on all octets but the last). Type codes 0x80-0xff are uints 0-127 inlined into the type octet, with no length or
+# payload. Version 2 adds:
+#   0x05: Uint vector (<varint>...); used for messages made up of uints only.
+# Peers start out on version 1; see the VERSION message for switching.
 
 # A TAF protocol /message/ is a [Uint, ...] list, where the initial uint element specifies the message type:
 #   0x00: Ping.
 #   0x01: Pong.
 #   0x02: Ack.
-#   0x03: Watch setup: <string filename pattern>,<string line pattern>
+#   0x03: Watch setup: <string filename pattern>,<string line pattern>; watches get IDs (the indices used by all other
+#         messages) counting up from 0, which stay the same for the whole session.
 #   0x04: Watch set: <string bitmask>
 #   0x05: Reset.
-#   0x06: Notify
-#   0x07: Config
-
+#   0x06: Notify: <uint watch index>
+#   0x07: Config: [<text key>, <value>]...
+#   0x08: Notify batch: <string bitmask of fired watch indices>; only sent to clients that enable notify_batch.
+#   0x09: Notify with context: <string zlib-compressed [[<uint watch index>, [<string line>...]]...] object>; only
+#         sent to clients that enable notify_context. Replaces NOTIFY and NOTIFY_BATCH for the watches listed.
+#   0x0a: Stats request.
+#   0x0b: Stats: [<text name>, <uint value, or list of per-watch uint values>]...; see STATS_GAUGES.
+#   0x0c: Watch warning: <uint watch index>, <text description>; sent when a watch is disabled for blowing its time
+#         budget.
+#   0x0d: Version: <uint protocol version>; everything the sender sends after this is in that version. Clients offer
+#         their highest version as the 'proto_version' CONFIG key; servers that know the key answer with VERSION
+#         for the version picked, and clients echo it back. Peers that don't stay on version 1.
+#   0x0e: Watch remove: <uint watch ID>; the ID isn't reused.
+#   0x0f: Watch replace: <uint watch ID>, <string filename pattern>, <string line pattern>; swaps in new patterns for
+#         an existing watch, keeping its ID and activation state.
+
+import functools
 import logging
 import re
 import struct
 import sys
+import time
+import zlib
+from collections import deque
 
 logger = logging.getLogger('event_proto')
 log = logger.log
@@ -46,69 +72,226 @@ log = logger.log
 class TafProtocolError(Exception):
   pass
 
+# ================================ Wire formats
+# Everything that differs between protocol versions is in the WireFormat objects: object headers, list counts, and
+# which type codes are understood. Payload parsers and encoders below are shared between versions, and go through
+# the format for the rest.
+_hdr = struct.Struct('>LB')
+_u32 = struct.Struct('>L')
+
+def encode_varint(i):
+  rv = bytearray()
+  while (i > 0x7f):
+    rv.append(0x80 | (i & 0x7f))
+    i >>= 7
+  rv.append(i)
+  return rv
+
+def decode_varint(data, off, end):
+  # Returns (<value>, <offset past it>).
+  rv = 0
+  shift = 0
+  while (off < end):
+    b = data[off]
+    off += 1
+    rv |= (b & 0x7f) << shift
+    if (b < 0x80):
+      return (rv, off)
+    shift += 7
+  raise TafProtocolError('Varint at {} overruns its object.'.format(off))
+
+class WireFormat1:
+  version = 1
+  # uints below this are inlined into the type code.
+  inline_uint_max = 0
+
+  def __init__(self):
+    self.parsers = {tc: p for (tc, (p, v)) in object_parsers.items() if (v <= self.version)}
+    self.msg_cache = {}
+
+  def get_size(self, data, off):
+    # Returns the total size of the object at off, header included. If the header isn't complete yet, returns
+    # something past the end of data instead.
+    if (len(data) - off < 5):
+      return 5
+    (v,) = _u32.unpack_from(data, off)
+    return v + 5
+
+  def read_hdr(self, data, off):
+    # Returns (<type code>, <payload offset>, <payload end>).
+    (sz, tc) = _hdr.unpack_from(data, off)
+    off += 5
+    return (tc, off, off + sz)
+
+  def read_count(self, data, off, end):
+    (v,) = _u32.unpack_from(data, off)
+    return (v, off + 4)
+
+  def write_hdr(self, buf, tc, sz):
+    buf += _hdr.pack(sz, tc)
+
+  def write_count(self, buf, n):
+    buf += _u32.pack(n)
+
+  def encode_uint_msg(self, msg):
+    # Messages made up of uints only (NOTIFY, ACK, PING/PONG, RESET, ...) are encoded through precompiled structs.
+    bs = [encode_vint(v) for v in msg]
+    lengths = tuple(len(b) for b in bs)
+    args = [sum(lengths) + 5*len(msg) + 4, 0x03, len(msg)]
+    for b in bs:
+      args += (len(b), 0x01, b)
+    return _get_uint_msg_struct(lengths).pack(*args)
+
+class WireFormat2(WireFormat1):
+  version = 2
+  inline_uint_max = 0x80
+
+  def __init__(self):
+    super().__init__()
+    for i in range(self.inline_uint_max):
+      self.parsers[0x80 | i] = functools.partial(parse_inline_uint, i)
+
+  def get_size(self, data, off):
+    l = len(data)
+    if (off >= l):
+      return 1
+    if (data[off] & 0x80):
+      return 1
+    for i in range(off + 1, min(l, off + 11)):
+      if (data[i] < 0x80):
+        (sz, p) = decode_varint(data, off + 1, i + 1)
+        return p - off + sz
+    if (l - off >= 11):
+      raise TafProtocolError('Overlong object length at {}.'.format(off))
+    return l - off + 1
+
+  def read_hdr(self, data, off):
+    tc = data[off]
+    if (tc & 0x80):
+      return (tc, off + 1, off + 1)
+    (sz, off) = decode_varint(data, off + 1, len(data))
+    return (tc, off, off + sz)
+
+  def read_count(self, data, off, end):
+    return decode_varint(data, off, end)
+
+  def write_hdr(self, buf, tc, sz):
+    buf.append(tc)
+    buf += encode_varint(sz)
+
+  def write_count(self, buf, n):
+    buf += encode_varint(n)
+
+  def encode_uint_msg(self, msg):
+    payload = b''.join([encode_varint(v) for v in msg])
+    return b'\x05' + encode_varint(len(payload)) + payload
+
+
 # ================================ Decoder structures
-def get_size(data):
-  (v,) = struct.unpack('>L', data[:4])
-  return v + 5
+# Parsers work on any buffer (typically a memoryview of the input buffer) with explicit offsets, so decoding a
+# message never copies the data following it.
 
+# {<type code>: (<parser>, <first protocol version that has it>)}
 object_parsers = {
 }
-def reg_parser(tc):
+def reg_parser(tc, version=1):
   def reg(p):
-    object_parsers[tc] = p
+    object_parsers[tc] = (p, version)
     return p
   return reg
 
+# Parsers are called with the object payload bounds, and return the decoded value.
 @reg_parser(0x01)
-def parse_uint(data):
-  size_total = get_size(data)
-  rv = int.from_bytes(data[5:size_total], 'big')
-  return (rv, size_total)
+def parse_uint(data, off, end, copy, fmt):
+  return int.from_bytes(data[off:end], 'big')
 
 @reg_parser(0x02)
-def parse_string(data):
-  size_total = get_size(data)
-  return (data[5:size_total], size_total)
+def parse_string(data, off, end, copy, fmt):
+  rv = data[off:end]
+  if copy:
+    rv = bytes(rv)
+  return rv
 
 @reg_parser(0x03)
-def parse_list(data):
-  size_total = get_size(data)
-  (el_count,) = struct.unpack('>L', data[5:9])
-  off = 9
+def parse_list(data, off, end, copy, fmt):
+  (el_count, off) = fmt.read_count(data, off, end)
   rv = [None]*el_count
   for i in range(el_count):
-    (rv[i], sz) = parse_object(data[off:])
-    off += sz
+    (rv[i], off) = decode_object(data, off, copy, fmt)
 
-  if (off != size_total):
-    raise TafProtocolError('List depth contents mismatch in {!r}: {} != {}'.format(data, size_total, off))
-
-  return (rv, size_total)
+  if (off != end):
+    raise TafProtocolError('List depth contents mismatch in {!a}: {} != {}'.format(bytes(data), end, off))
+  return rv
 
 @reg_parser(0x04)
-def parse_text(data):
-  (b, sz) = parse_string(data)
-  return (bytes(b).decode('utf-8'), sz)
-
-def parse_object(data):
-  tc = data[4]
-  if isinstance(tc, bytes):
-    # Work around python3.2 memoryview interface oddities.
-    tc = tc[0]
+def parse_text(data, off, end, copy, fmt):
+  return str(data[off:end], 'utf-8')
+
+@reg_parser(0x05, 2)
+def parse_uint_vector(data, off, end, copy, fmt):
+  rv = []
+  while (off < end):
+    (v, off) = decode_varint(data, off, end)
+    rv.append(v)
+  return rv
+
+def parse_inline_uint(v, data, off, end, copy, fmt):
+  return v
+
+WIRE_FORMATS = {fmt.version: fmt for fmt in (WireFormat1(), WireFormat2())}
+PROTO_VERSION = max(WIRE_FORMATS)
+WF1 = WIRE_FORMATS[1]
+
+def decode_object(data, off=0, copy=True, fmt=WF1):
+  # Returns (<object>, <offset past object>). With copy=False, strings are returned as slices of data instead of
+  # bytes copies.
+  (tc, p_off, end) = fmt.read_hdr(data, off)
+  if (end > len(data)):
+    raise TafProtocolError('Object at {} overruns buffer: {} > {}.'.format(off, end, len(data)))
   try:
-    p = object_parsers[tc]
+    p = fmt.parsers[tc]
   except KeyError:
     raise TafProtocolError('Unknown type code {!r}.'.format(tc))
-  return p(data)
-
-def parse_message(data):
-  (rv, _) = parse_object(data)
+  return (p(data, p_off, end, copy, fmt), end)
+
+def parse_object(data, fmt=WF1):
+  (rv, end) = decode_object(data, fmt=fmt)
+  return (rv, end)
+
+_hdr_msg2 = struct.Struct('>LBLLB')
+
+def decode_message(data, off=0, copy=True, fmt=WF1):
+  # Returns (<message>, <offset past message>).
+  # Fast path for the flat two-element [uint, uint] and [uint, bytes] v1 messages that make up most traffic; v2 has
+  # a compact encoding for the former instead.
+  if (fmt is WF1) and (len(data) - off >= 19):
+    (sz, tc, count, sz0, tc0) = _hdr_msg2.unpack_from(data, off)
+    end = off + sz + 5
+    p0 = off + 14
+    p1 = p0 + sz0
+    if (tc == 0x03) and (count == 2) and (tc0 == 0x01) and (p1 + 5 <= end <= len(data)):
+      (sz1, tc1) = _hdr.unpack_from(data, p1)
+      p1 += 5
+      if (p1 + sz1 == end) and ((tc1 == 0x01) or (tc1 == 0x02)):
+        mtype = int.from_bytes(data[p0:p1-5], 'big')
+        if (tc1 == 0x01):
+          return ([mtype, int.from_bytes(data[p1:end], 'big')], end)
+        v = data[p1:end]
+        if copy:
+          v = bytes(v)
+        return ([mtype, v], end)
+
+  (rv, end) = decode_object(data, off, copy, fmt)
   if (type(rv) != list):
-    raise TafProtocolError('Got non-list message: {!r}'.format(msg))  
+    raise TafProtocolError('Got non-list message: {!r}'.format(rv))
   if (len(rv) < 1):
     raise TafProtocolError('Got empty list message.')
   if (type(rv[0]) != int):
-    raise TafProtocolError('Got message with invalid payload types: {!r}'.format(msg))
+    raise TafProtocolError('Got message with invalid payload types: {!r}'.format(rv))
+  return (rv, end)
+
+def parse_message(data, fmt=WF1):
+  (rv, _) = decode_message(data, fmt=fmt)
   return rv
 
 # ================================ Encoder structures
@@ -130,70 +313,120 @@ def encode_vint(i, bo='big'):
    return b
 
 class Encoder:
-  def __init__(self):
+  def __init__(self, fmt=WF1):
+    self.fmt = fmt
     self.data = bytearray()
 
-  def drop_size(self):
-    self.data.extend(b'\x00\x00\x00\x00')
-
-  def set_size(self, sz, off):
-    b = struct.pack('>L', sz)
-    self.data[off:off+4] = b
-    
   @reg_encoder(int)
   def encode_uint(self, val):
+    if (val < self.fmt.inline_uint_max):
+      self.data.append(0x80 | val)
+      return
     b = encode_vint(val)
-    self.set_size(len(b), len(self.data))
-    self.data.append(0x01)
-    
+    self.fmt.write_hdr(self.data, 0x01, len(b))
     self.data.extend(b)
 
   @reg_encoder(bytes)
   def encode_string(self, val, tc=0x02):
-    length = len(val)
-    self.set_size(length, len(self.data))
-    self.data.append(tc)
+    self.fmt.write_hdr(self.data, tc, len(val))
     self.data.extend(val)
 
   @reg_encoder(str)
   def encode_text(self, val):
     self.encode_string(val.encode('utf-8'), tc=0x04)
-  
+
   @reg_encoder(list)
   def encode_list(self, val):
-    b = len(self.data)
-    self.drop_size()
-    self.data.append(0x03)
-    self.set_size(len(val), len(self.data))
-    
+    # The header holds the payload size, so the elements are encoded first.
+    e = Encoder(self.fmt)
+    self.fmt.write_count(e.data, len(val))
     for el in val:
-      self.encode_any(el)
-    sz = len(self.data) - b - 5
-    self.set_size(sz, b)
-    
+      e.encode_any(el)
+    self.fmt.write_hdr(self.data, 0x03, len(e.data))
+    self.data.extend(e.data)
+
   def encode_any(self, val):
     return object_encoders[type(val)](self, val)
 
-def encode_msg(msg):
-  e = Encoder()
+# Fast path for messages made up of uints only: encoded by the format directly, and the exact output for short ones
+# cached.
+_uint_msg_structs = {}
+MSG_CACHE_SIZE = 4096
+
+def _get_uint_msg_struct(lengths):
+  rv = _uint_msg_structs.get(lengths)
+  if (rv is None):
+    rv = _uint_msg_structs[lengths] = struct.Struct('>LBL' + ''.join('LB{}s'.format(l) for l in lengths))
+  return rv
+
+def encode_uint_msg(msg, fmt=WF1):
+  return fmt.encode_uint_msg(msg)
+
+def encode_msg(msg, fmt=WF1):
+  for v in msg:
+    if (type(v) != int):
+      break
+  else:
+    if (len(msg) > 2):
+      return fmt.encode_uint_msg(msg)
+    cache = fmt.msg_cache
+    key = tuple(msg)
+    rv = cache.get(key)
+    if (rv is None):
+      if (len(cache) >= MSG_CACHE_SIZE):
+        cache.clear()
+      rv = cache[key] = fmt.encode_uint_msg(msg)
+    return rv
+
+  e = Encoder(fmt)
   e.encode_list(msg)
   return e.data
 
-def _test_serialization():
-  for v in (0, 42, 127, 128, b'', b'foo', [], [42], [b'foo'], [b'', 0, 3, b'bar'], [[[], b'foo']]):
-    e = Encoder()
-    e.encode_any(v)
-    (v2, _) = parse_object(e.data)
-    if (v != v2):
-      raise ValueError('Serial mismatch: {!r} != {!r}'.format(v, v2))
-    if (type(v) == list):
-      msg = v
-    else:
-      msg = [v]
+def encode_msgs(msgs, fmt=WF1):
+  # Encode a sequence of messages into one buffer; join() sizes its output once from the encoded parts.
+  return b''.join([encode_msg(msg, fmt) for msg in msgs])
 
-    (msg2, _) = parse_object(encode_msg(msg))
-    if (msg != msg2):
-      raise ValueError('Serial mismatch: {!r} != {!r}'.format(msg, msg2))
+def _test_serialization():
+  for fmt in WIRE_FORMATS.values():
+    for v in (0, 42, 127, 128, 1 << 70, b'', b'foo', b'x' * 300, [], [42], [b'foo'], [b'', 0, 3, b'bar'],
+        [[[], b'foo']], ['t\xe4xt', [0] * 200]):
+      e = Encoder(fmt)
+      e.encode_any(v)
+      (v2, end) = parse_object(e.data, fmt)
+      if (v != v2) or (end != len(e.data)) or (fmt.get_size(e.data, 0) != end):
+        raise ValueError('Serial mismatch (v{}): {!r} != {!r}'.format(fmt.version, v, v2))
+      if (type(v) == list):
+        msg = v
+      else:
+        msg = [v]
+
+      (msg2, _) = parse_object(encode_msg(msg, fmt), fmt)
+      if (msg != msg2):
+        raise ValueError('Serial mismatch (v{}): {!r} != {!r}'.format(fmt.version, msg, msg2))
+
+      if (fmt is WF1):
+        e = Encoder(fmt)
+        e.encode_list(msg)
+        if (bytes(e.data) != bytes(encode_msg(msg, fmt))):
+          raise ValueError('Encoder fast path mismatch on {!r}.'.format(msg))
+
+    msgs = [[0, 1], [6, 300], [3, b'foo', b'bar'], [4, b'\x05'], [7, ['auto_reset', 0]], [2], [5, b''], [6, 1 << 40]]
+    data = encode_msgs(msgs, fmt)
+    mv = memoryview(data)
+    off = 0
+    for msg in msgs:
+      # Every prefix of a message must be recognized as incomplete.
+      for i in range(off, off + fmt.get_size(data, off)):
+        if (fmt.get_size(data[:i], off) <= i - off):
+          raise ValueError('Size mismatch (v{}) on {!r}[:{}].'.format(fmt.version, msg, i - off))
+      (msg2, off) = decode_message(mv, off, fmt=fmt)
+      if (msg != msg2):
+        raise ValueError('Serial mismatch (v{}): {!r} != {!r}'.format(fmt.version, msg, msg2))
+    if (off != len(data)):
+      raise ValueError('Offset mismatch (v{}): {} != {}'.format(fmt.version, off, len(data)))
+
+  if (len(encode_msg([MSG_ID_NOTIFY, 3], WIRE_FORMATS[2])) != 4):
+    raise ValueError('Unexpected v2 NOTIFY size.')
 
 
 # ================================ Stream interface
@@ -206,7 +439,15 @@ MSG_NAMES = {
   'WATCH_SET': 0x04,
   'RESET': 0x05,
   'NOTIFY': 0x06,
-  'CONFIG': 0x07
+  'CONFIG': 0x07,
+  'NOTIFY_BATCH': 0x08,
+  'NOTIFY_CONTEXT': 0x09,
+  'STATS_REQUEST': 0x0a,
+  'STATS': 0x0b,
+  'WATCH_WARN': 0x0c,
+  'VERSION': 0x0d,
+  'WATCH_REMOVE': 0x0e,
+  'WATCH_REPLACE': 0x0f
 }
 
 for (k,v) in MSG_NAMES.items():
@@ -229,9 +470,38 @@ def reg_es_parsers(cls):
   return cls
 
 
+# STATS values that are point-in-time readings; everything else is a counter since server startup. Times are
+# reported in microseconds.
+STATS_GAUGES = frozenset(('files_known', 'files_watched', 'watches', 'inbuf_depth', 'inbuf_depth_max', 'loop_lag_us',
+  'loop_lag_max_us', 'fds_open', 'watch_time_max_us', 'watches_disabled', 'watches_armed',
+  'dirty_batch_max'))
+
+def mask_to_idxs(v):
+  # Yields the indices of bits set in int v, lowest first.
+  while v:
+    low = v & -v
+    yield low.bit_length() - 1
+    v ^= low
+
 class Config:
   def __init__(self):
     self.auto_reset = False
+    # Coalesce fired watches into NOTIFY_BATCH messages, sent notify_batch_ms after the first fire (0: at the end of
+    # the current event loop iteration).
+    self.notify_batch = False
+    self.notify_batch_ms = 0
+    # If > 0, send up to notify_context_lines matched lines per watch along with notifies, each truncated to this many
+    # octets.
+    self.notify_context = 0
+    self.notify_context_lines = 5
+    # If > 0, only match against the first max_line_len octets of each line.
+    self.max_line_len = 0
+    # If > 0, time line pattern evaluations, and disable watches that take longer than this on a single line
+    # watch_budget_strikes times.
+    self.watch_budget_us = 0
+    self.watch_budget_strikes = 3
+    # Highest protocol version the client can speak.
+    self.proto_version = PROTO_VERSION
 
   def to_msg(self):
     def map(v):
@@ -249,48 +519,165 @@ class Config:
     return rv
 
 
+class _Unlinked:
+  # Peer of streams that have been unlink()ed: what's still sent their way goes nowhere.
+  def receive_msgs(self, msgs):
+    pass
+
 @reg_es_parsers
 class EventStream:
+  # fl_in and fl_out may be None for streams that get link()ed to a peer in the same process instead.
   def __init__(self, fl_in, fl_out):
     self.fl_in = fl_in
-    fl_in.process_input = self.process_input
     self.fl_out = fl_out
-    self.fl_in.size_need = 4
+    if not (fl_in is None):
+      fl_in.process_input = self.process_input
+      fl_in.size_need = 4
+    self._peer = None
+    self._in_q = deque()
+    self._receiving = False
+    self.fmt_in = WF1
+    self.fmt_out = WF1
+    self._out_q = None
+    self._cork_depth = 0
+    self.msgs_sent = 0
+    self.bytes_sent = 0
+    self.msgs_recv = 0
+    self.bytes_recv = 0
+    self.inbuf_depth = 0
+    self.inbuf_depth_max = 0
 
   def process_input(self, data):
-    disc = 0
-    while len(data) > 4:
-      sz = get_size(data)
-      if (len(data) < sz):
-        self.fl_in.size_need = sz + 5
-        break
-
-      log(8, 'Parsing: {!a}'.format(bytes(data)))
-      msg = parse_message(data)
-      log(8, 'Parsed: {!a}'.format(msg))
-      mtype = msg[0]
-
-      #sys.stderr.write('DO1: {}\n'.format(msg)); sys.stderr.flush()
-      p = self.msg_handlers.get(mtype)
-      if (p is None):
-        raise TafProtocolError('Unknown mtype in {}.'.format(msg))
-      p(self, msg)
-
-      data = data[sz:]
-      disc += sz
-    else:
-      self.fl_in.size_need = 4
-
-    if (disc > 0):
-      self.fl_in.discard_inbuf_data(disc)
+    off = 0
+    l = len(data)
+    trace = logger.isEnabledFor(8)
+    if (l > self.inbuf_depth_max):
+      self.inbuf_depth_max = l
+    # Replies to all messages in this chunk of input go out in one write.
+    self.cork()
+    try:
+      while (l > off):
+        sz = self.fmt_in.get_size(data, off)
+        if (l - off < sz):
+          self.fl_in.size_need = sz
+          break
+
+        if trace:
+          log(8, 'Parsing: {!a}'.format(bytes(data[off:off+sz])))
+        (msg, off) = decode_message(data, off, fmt=self.fmt_in)
+        self.msgs_recv += 1
+        if trace:
+          log(8, 'Parsed: {!a}'.format(msg))
+        mtype = msg[0]
+
+        #sys.stderr.write('DO1: {}\n'.format(msg)); sys.stderr.flush()
+        p = self.msg_handlers.get(mtype)
+        if (p is None):
+          raise TafProtocolError('Unknown mtype in {}.'.format(msg))
+        p(self, msg)
+      else:
+        self.fl_in.size_need = 1
+    finally:
+      self.uncork()
+
+    self.bytes_recv += off
+    self.inbuf_depth = l - off
+    if (off > 0):
+      self.fl_in.discard_inbuf_data(off)
+
+  def link(self, peer):
+    # Connect to another EventStream in this process: messages are handed over as they are, skipping encoding.
+    self._peer = peer
+    peer._peer = self
+
+  def unlink(self):
+    # Undoes link() for both sides; messages sent by either of them from then on are dropped.
+    peer = self._peer
+    self._peer = peer._peer = _Unlinked()
+
+  def receive_msgs(self, msgs):
+    # Called by a linked peer. Messages sent to us while we're handling one are queued up behind it, so handlers
+    # don't nest and ordering is the same as over a real stream.
+    q = self._in_q
+    q.extend(msgs)
+    if self._receiving:
+      return
+    self._receiving = True
+    self.cork()
+    try:
+      while q:
+        msg = q.popleft()
+        self.msgs_recv += 1
+        p = self.msg_handlers.get(msg[0])
+        if (p is None):
+          raise TafProtocolError('Unknown mtype in {}.'.format(msg))
+        p(self, msg)
+    finally:
+      self._receiving = False
+      self.uncork()
 
   def send_msg(self, msg):
     #sys.stderr.write('DO0: {}\n'.format(msg)); sys.stderr.flush()
     log(8, 'Sending: {!a}'.format(msg))
-    data = encode_msg(msg)
+    if not (self._peer is None):
+      self.msgs_sent += 1
+      if (self._out_q is None):
+        self._peer.receive_msgs((msg,))
+      else:
+        self._out_q.append(msg)
+      return
+    data = encode_msg(msg, self.fmt_out)
+    self.msgs_sent += 1
+    self.bytes_sent += len(data)
+    if not (self._out_q is None):
+      self._out_q.append(data)
+      return
     self.fl_out.send_bytes((data,))
     log(8, 'Sent: {!a}'.format(data))
 
+  def send_msgs(self, msgs):
+    if not msgs:
+      return
+    log(8, 'Sending: {!a}'.format(msgs))
+    self.msgs_sent += len(msgs)
+    if not (self._peer is None):
+      if (self._out_q is None):
+        self._peer.receive_msgs(msgs)
+      else:
+        self._out_q.extend(msgs)
+      return
+    if not (self._out_q is None):
+      for msg in msgs:
+        data = encode_msg(msg, self.fmt_out)
+        self.bytes_sent += len(data)
+        self._out_q.append(data)
+      return
+    data = encode_msgs(msgs, self.fmt_out)
+    self.bytes_sent += len(data)
+    self.fl_out.send_bytes((data,))
+
+  def cork(self):
+    # Hold back outgoing messages until uncork(), and then write them out in one go.
+    self._cork_depth += 1
+    if (self._out_q is None):
+      self._out_q = []
+
+  def uncork(self):
+    self._cork_depth -= 1
+    if (self._cork_depth > 0):
+      return
+    q = self._out_q
+    self._out_q = None
+    if not (self._peer is None):
+      # Holds messages rather than their encoding in this case.
+      if q:
+        self._peer.receive_msgs(q)
+      return
+    if q:
+      data = b''.join(q)
+      self.fl_out.send_bytes((data,))
+      log(8, 'Sent: {!a}'.format(data))
+
   def send_ping(self, arg):
     self.send_msg([MSG_ID_PING, arg])
 
@@ -298,17 +685,614 @@ class EventStream:
     arg = msg[1]
     self.send_msg([MSG_ID_PONG, arg])
 
+  def set_version_out(self, version):
+    self.send_msg([MSG_ID_VERSION, version])
+    self.fmt_out = WIRE_FORMATS[version]
+
+  def process_msg_VERSION(self, msg):
+    (_, version) = msg
+    fmt = WIRE_FORMATS.get(version)
+    if (fmt is None):
+      raise TafProtocolError('Peer switched to unknown protocol version {!r}.'.format(version))
+    self.fmt_in = fmt
+
 
 class Watch:
   def __init__(self, fn_p, line_p):
     self.fn_p = fn_p
     self.line_p = line_p
-    self.set = False
     self.idx = None
+    self.fn_prefix = None
+    self.disabled = False
 
   def __repr__(self):
     return '{}<**{}>'.format(type(self).__name__, self.__dict__)
 
+
+# Pattern constructs that don't survive being embedded into a combined alternation: inline global flags, group
+# references (numbering shifts) and user-named groups (names may collide).
+_re_uncombinable = re.compile(br'\(\?[aiLmsux]+\)|\\[1-9]|\(\?P[<=]|\(\?\(')
+_re_inline_flags = re.compile(br'\(\?[aiLmsux]+[:)-]')
+
+# Constructs that can behave differently on a line embedded in a larger buffer than on the line by itself: buffer-
+# boundary anchors, \B, and lookarounds (which get to see neighbouring lines).
+_re_region_unsafe = re.compile(br'\\[AZBz]|\(\?<?[=!]')
+# Constructs that can match at the end of a line cut short by max_line_len where they wouldn't within the whole line.
+_re_cap_unsafe = re.compile(br'\$|\\b')
+
+def iter_window_lines(windows):
+  # Splits (buffer, start, end) windows as yielded by TailReader.read_windows() into lines.
+  for (buf, start, end) in windows:
+    i = buf.find(b'\n', start, end)
+    while (i >= 0):
+      yield buf[start:i]
+      start = i + 1
+      i = buf.find(b'\n', start, end)
+    yield buf[start:end]
+
+def count_newlines(buf, start, end, chunk=1<<20):
+  # mmap objects don't do count(); go through them in slices, to keep memory use bounded.
+  if not isinstance(buf, bytes):
+    return sum(buf[i:min(i + chunk, end)].count(b'\n') for i in range(start, end, chunk))
+  return buf.count(b'\n', start, end)
+
+def _skip_class(p, i):
+  # Returns the index just past the character class starting at p[i] ('[').
+  i += 1
+  if (i < len(p)) and (p[i] == 0x5e): # '^'
+    i += 1
+  if (i < len(p)) and (p[i] == 0x5d): # ']'
+    i += 1
+  while (i < len(p)):
+    c = p[i]
+    if (c == 0x5c):
+      i += 2
+      continue
+    i += 1
+    if (c == 0x5d):
+      break
+  return i
+
+def _skip_escape(p, i):
+  # Returns (index just past the escape sequence starting at p[i] (a backslash), its literal value or None).
+  if (i + 1 >= len(p)):
+    return (len(p), None)
+  c = p[i+1]
+  i += 2
+  if not chr(c).isalnum():
+    return (i, c)
+  if (c == 0x78): # \xhh
+    return (i + 2, None)
+  if (0x30 <= c <= 0x39):
+    # Octal escapes and group references take up to two more digits.
+    for _ in range(2):
+      if (i < len(p)) and (0x30 <= p[i] <= 0x39):
+        i += 1
+  return (i, None)
+
+def nested_repeat(p):
+  # Whether compiled pattern p repeats something that itself contains an unbounded repeat, as in (a+)+ or (.*x){20};
+  # the usual way for a pattern to backtrack exponentially. Python's re can't be interrupted once a search is under
+  # way, so timing such patterns only ever finds out after the fact.
+  try:
+    from re import _parser as sre_parse
+  except ImportError:
+    import sre_parse
+  unbounded = sre_parse.MAXREPEAT
+  repeats = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+
+  def walk(items, in_repeat):
+    for (op, av) in items:
+      if (op in repeats):
+        (lo, hi, sub) = av
+        if in_repeat and (hi == unbounded):
+          return True
+        if walk(sub, in_repeat or (hi == unbounded) or (hi >= 10)):
+          return True
+        continue
+      # Descend into groups, branches, lookarounds and conditionals.
+      for v in (av if isinstance(av, (tuple, list)) else (av,)):
+        if isinstance(v, sre_parse.SubPattern):
+          if walk(v, in_repeat):
+            return True
+        elif isinstance(v, list) and v and isinstance(v[0], sre_parse.SubPattern):
+          if any(walk(b, in_repeat) for b in v):
+            return True
+    return False
+
+  return walk(sre_parse.parse(p.pattern, p.flags), False)
+
+def required_literal(p):
+  # Returns the longest run of literal text that any match of compiled bytes pattern p has to contain, or None if
+  # that can't be determined. Groups, classes and anything optional are skipped over rather than analysed; so is
+  # everything when there's an alternation at the top level, or flags that change what literal text matches.
+  if not isinstance(p.pattern, bytes) or (p.flags & ~re.U) or _re_inline_flags.search(p.pattern):
+    return None
+  s = p.pattern
+  l = len(s)
+  best = b''
+  run = bytearray()
+  i = 0
+  while (i < l):
+    c = s[i]
+    lit = None
+    if (c == 0x5c):
+      (i, lit) = _skip_escape(s, i)
+    elif (c == 0x5b): # '['
+      i = _skip_class(s, i)
+    elif (c == 0x28): # '('
+      depth = 0
+      while (i < l):
+        c = s[i]
+        if (c == 0x5c):
+          i += 2
+          continue
+        if (c == 0x5b):
+          i = _skip_class(s, i)
+          continue
+        i += 1
+        if (c == 0x28):
+          depth += 1
+        elif (c == 0x29):
+          depth -= 1
+          if (depth == 0):
+            break
+    elif (c in b'|)'):
+      return None
+    else:
+      i += 1
+      if not (c in _re_meta):
+        lit = c
+
+    q = s[i] if (i < l) else None
+    if (q is not None) and (q in b'*?{+'):
+      if (q == 0x7b): # '{'
+        i = s.find(b'}', i)
+        i = l if (i < 0) else i + 1
+      else:
+        i += 1
+      if (i < l) and (s[i] in b'?+'):
+        i += 1
+      if (q == 0x2b) and not (lit is None):
+        # At least one of it, but what follows needn't be adjacent.
+        run.append(lit)
+      lit = None
+
+    if (lit is None):
+      if (len(run) > len(best)):
+        best = bytes(run)
+      run = bytearray()
+    else:
+      run.append(lit)
+
+  if (len(run) > len(best)):
+    best = bytes(run)
+  return best or None
+
+
+class LineMatcher:
+  # Matches lines against a set of watches. Most line patterns require some literal text to be present (see
+  # required_literal()). All of those literals are looked for in one pass of a literal-only alternation, which re
+  # runs far faster than the patterns themselves; only on the (rare) lines that contain one are the watches for the
+  # literals actually there searched. Watches sharing a literal share the test, and patterns that are nothing but
+  # their literal don't need their regex at all.
+  TIME_SAMPLE_INTERVAL = 16
+
+  def __init__(self, watchs):
+    self.watchs = watchs
+    # [[literal, [watch...]]...]
+    self.groups = []
+    # Watches without a usable literal; searched on every line.
+    self.rest = []
+    self.exact = set()
+    by_lit = {}
+    for w in watchs:
+      lit = required_literal(w.line_p)
+      if (lit is None):
+        self.rest.append(w)
+        continue
+      if (lit == w.line_p.pattern):
+        self.exact.add(w.idx)
+      g = by_lit.get(lit)
+      if (g is None):
+        g = by_lit[lit] = [lit, []]
+        self.groups.append(g)
+      g[1].append(w)
+
+    self.lit_r = None
+    if self.groups:
+      try:
+        self.lit_r = re.compile(b'|'.join(re.escape(lit) for (lit, _) in self.groups))
+      except (re.error, OverflowError, RecursionError) as exc:
+        log(30, 'Failed to combine line pattern literals, testing them one by one: {!r}'.format(exc))
+    self.lines_scanned = 0
+
+  def match(self, lines, evals=None):
+    # Returns a list of (watch, line) tuples, one for each watch that matched any of the lines. The number of lines
+    # looked at is left in self.lines_scanned; if evals is given, the number of lines each watch was evaluated against
+    # is added to evals[watch.idx].
+    rv = []
+    groups = [[lit, ws] for (lit, ws) in self.groups]
+    rest = self.rest
+    exact = self.exact
+    lit_r = self.lit_r
+    n = 0
+    fired_n = {}
+    for line in lines:
+      n += 1
+      fired = False
+      groups_l = groups
+      if groups and not (lit_r is None) and (lit_r.search(line) is None):
+        groups_l = ()
+      for g in groups_l:
+        if not (g[0] in line):
+          continue
+        left = []
+        for w in g[1]:
+          if (w.idx in exact) or (w.line_p.search(line) is not None):
+            rv.append((w, line))
+            fired_n[w.idx] = n
+            fired = True
+          else:
+            left.append(w)
+        g[1] = left
+
+      if rest:
+        left = []
+        for w in rest:
+          if (w.line_p.search(line) is None):
+            left.append(w)
+          else:
+            rv.append((w, line))
+            fired_n[w.idx] = n
+        rest = left
+
+      if fired:
+        groups = [g for g in groups if g[1]]
+      if not (groups or rest):
+        break
+
+    self.lines_scanned = n
+    if not (evals is None):
+      # Watches aren't evaluated past the line they fire on.
+      for w in self.watchs:
+        evals[w.idx] += fired_n.get(w.idx, n)
+    return rv
+
+  def match_timed(self, lines, evals, times, budget):
+    # Like match(), but keeping track of what the watches cost. Each line is timed as a whole; every
+    # TIME_SAMPLE_INTERVAL-th line, and any line that took longer than budget, is then rerun through its candidate
+    # watches one at a time, timed individually, to attribute cost (and find culprits). times is a list of per-watch
+    # [total seconds, max seconds] pairs to add to; totals are extrapolated from the sampled lines. Returns (matches,
+    # [(watch, seconds)...] of evaluations over budget).
+    clock = time.perf_counter
+    sample = self.TIME_SAMPLE_INTERVAL
+    rv = []
+    over = []
+    groups = [[lit, ws] for (lit, ws) in self.groups]
+    rest = self.rest
+    exact = self.exact
+    lit_r = self.lit_r
+    n = 0
+    fired_n = {}
+    t_sampled = {}
+
+    for line in lines:
+      n += 1
+      t0 = clock()
+      cands = []
+      if groups and ((lit_r is None) or (lit_r.search(line) is not None)):
+        for (lit, ws) in groups:
+          if (lit in line):
+            cands.extend(ws)
+      cands.extend(rest)
+      hits = [w for w in cands if (w.idx in exact) or (w.line_p.search(line) is not None)]
+      dt = clock() - t0
+
+      sampled = ((n - 1) % sample == 0)
+      if sampled or (dt > budget):
+        for w in cands:
+          if (w.idx in exact):
+            continue
+          t0 = clock()
+          w.line_p.search(line)
+          dt = clock() - t0
+          t = times[w.idx]
+          if (dt > t[1]):
+            t[1] = dt
+          if (dt > budget):
+            over.append((w, dt))
+          if sampled:
+            t_sampled[w.idx] = t_sampled.get(w.idx, 0) + dt
+
+      if hits:
+        for w in hits:
+          rv.append((w, line))
+          fired_n[w.idx] = n
+        groups = [[lit, ws_l] for (lit, ws_l) in ((lit, [w for w in ws if not (w.idx in fired_n)])
+          for (lit, ws) in groups) if ws_l]
+        rest = [w for w in rest if not (w.idx in fired_n)]
+        if not (groups or rest):
+          break
+
+    self.lines_scanned = n
+    for w in self.watchs:
+      live = fired_n.get(w.idx, n)
+      evals[w.idx] += live
+      t = t_sampled.get(w.idx)
+      if not (t is None):
+        # Sampled on lines 1, 1 + sample, ... of the ones it was live for.
+        times[w.idx][0] += t * live / ((live - 1) // sample + 1)
+    return (rv, over)
+
+  def _get_region_groups(self, capped=False):
+    # Splits our watches into those that can be run over whole buffers with re.MULTILINE (as one combined pattern,
+    # plus one per pattern that doesn't combine), and those that need to see individual lines.
+    groups = []
+    line_ws = []
+    safe = []
+    for w in self.watchs:
+      if ((w.line_p.flags & re.S) or _re_region_unsafe.search(w.line_p.pattern) or
+          (capped and _re_cap_unsafe.search(w.line_p.pattern))):
+        line_ws.append(w)
+      elif (w.line_p.flags & ~re.U) or _re_uncombinable.search(w.line_p.pattern):
+        groups.append([[w], re.compile(w.line_p.pattern, w.line_p.flags | re.M)])
+      else:
+        safe.append(w)
+    if safe:
+      groups.insert(0, [safe, _compile_region(safe)])
+    return (groups, line_ws)
+
+  def match_region(self, windows, evals=None, max_line_len=0, times=None, budget=0):
+    # Like match(), but over (buffer, start, end) windows as yielded by TailReader.read_windows(), without splitting
+    # them into lines first. Each pattern group is searched for across the window; a hit's lines are then confirmed
+    # against the individual patterns line by line, since in a multi-line buffer a match can span lines (e.g. through
+    # [^x] matching a newline) where none of the lines match on their own.
+    # If max_line_len > 0, only the first max_line_len octets of each line count: hits are confirmed against the
+    # truncated line. If times is passed, it is charged as by match_timed(); a group search that takes longer than
+    # budget has the lines it went through rerun against its watches one at a time, to find the culprits. Evaluations
+    # over budget end up in self.over.
+    (groups, line_ws) = self._get_region_groups(max_line_len > 0)
+    timed = not (times is None)
+    clock = time.perf_counter
+    over = self.over = []
+    rv = []
+    n = 0
+    fired_n = {}
+    for (buf, start, end) in windows:
+      for g in groups:
+        (ws, r) = g
+        pos = start
+        while ws and (pos <= end):
+          if timed:
+            t0 = clock()
+          m = r.search(buf, pos, end)
+          if timed:
+            dt = clock() - t0
+            for w in ws:
+              times[w.idx][0] += dt / len(ws)
+            if (dt > budget):
+              le = end if (m is None) else buf.rfind(b'\n', pos, m.start())
+              if (le >= pos):
+                self._find_over(ws, iter_window_lines(((buf, pos, le),)), max_line_len, times, budget)
+          if (m is None):
+            break
+          ls = buf.rfind(b'\n', start, m.start()) + 1
+          if (ls == 0):
+            ls = start
+          le = buf.find(b'\n', max(m.start(), m.end() - 1), end)
+          if (le < 0):
+            le = end
+          ln = n + count_newlines(buf, start, ls)
+          left = ws
+          for line in buf[ls:le].split(b'\n'):
+            ln += 1
+            if (max_line_len > 0):
+              line = line[:max_line_len]
+            left_next = []
+            for w in left:
+              if timed:
+                t0 = clock()
+                hit = w.line_p.search(line)
+                dt = clock() - t0
+                t = times[w.idx]
+                t[0] += dt
+                if (dt > t[1]):
+                  t[1] = dt
+                if (dt > budget):
+                  over.append((w, dt))
+              else:
+                hit = w.line_p.search(line)
+              if (hit is None):
+                left_next.append(w)
+              else:
+                rv.append((w, line))
+                fired_n[w.idx] = ln
+            left = left_next
+          if (len(left) < len(ws)):
+            ws = g[0] = left
+            if ws:
+              r = g[1] = _compile_region(ws)
+          pos = le + 1
+
+      if line_ws:
+        ev = dict.fromkeys((w.idx for w in line_ws), 0)
+        lines = iter_window_lines(((buf, start, end),))
+        if (max_line_len > 0):
+          lines = (line[:max_line_len] for line in lines)
+        if timed:
+          (rv_l, over_l) = type(self)(line_ws).match_timed(lines, ev, times, budget)
+          over.extend(over_l)
+        else:
+          rv_l = type(self)(line_ws).match(lines, ev)
+        for (w, line) in rv_l:
+          fired_n[w.idx] = n + ev[w.idx]
+        rv.extend(rv_l)
+        line_ws = [w for w in line_ws if not (w.idx in fired_n)]
+
+      n += count_newlines(buf, start, end) + 1
+      groups = [g for g in groups if g[0]]
+      if not (groups or line_ws):
+        break
+
+    self.lines_scanned = n
+    if not (evals is None):
+      for w in self.watchs:
+        evals[w.idx] += fired_n.get(w.idx, n)
+    return rv
+
+  def _find_over(self, ws, lines, max_line_len, times, budget):
+    # Reruns ws on lines (which none of them match) one at a time, recording the evaluations over budget. Their total
+    # cost has already been charged.
+    clock = time.perf_counter
+    for line in lines:
+      if (max_line_len > 0):
+        line = line[:max_line_len]
+      for w in ws:
+        t0 = clock()
+        w.line_p.search(line)
+        dt = clock() - t0
+        t = times[w.idx]
+        if (dt > t[1]):
+          t[1] = dt
+        if (dt > budget):
+          self.over.append((w, dt))
+
+
+def _compile_region(watchs):
+  if (len(watchs) == 1):
+    p = watchs[0].line_p
+    return re.compile(p.pattern, p.flags | re.M)
+  return re.compile(b'|'.join(b'(?:' + w.line_p.pattern + b')' for w in watchs), re.M)
+
+
+_re_meta = frozenset(b'.^$*+?{}[]|()')
+
+def literal_prefix(p):
+  # Returns the literal text any match of anchored bytes pattern source p has to start with, or None if that can't
+  # be determined.
+  if not p.startswith(b'^') or (b'|' in p):
+    return None
+  rv = bytearray()
+  i = 1
+  l = len(p)
+  while (i < l):
+    c = p[i]
+    if (c == 0x5c): # backslash
+      if (i + 1 >= l) or (chr(p[i+1]).isalnum()):
+        break
+      c = p[i+1]
+      i += 2
+    elif (c in _re_meta):
+      break
+    else:
+      i += 1
+
+    n = p[i] if (i < l) else None
+    if (n is not None) and (n in b'*?{'):
+      # Preceding atom is optional.
+      break
+    rv.append(c)
+    if (n == 0x2b): # '+'
+      break
+  return bytes(rv) or None
+
+
+class FilenameIndex:
+  # Index for resolving which files a watch filename pattern can match, and vice versa. Files are kept in a trie
+  # of path components; watches are filed under the literal prefix of their anchored pattern. The index only rules
+  # out candidates; survivors still get checked against the actual pattern.
+  def __init__(self):
+    self.files = {}
+    self.w_comp = {}
+    self.w_short = []
+    self.w_any = []
+
+  @staticmethod
+  def _get_prefix(w):
+    if (w.fn_p.flags & (re.I | re.M)):
+      return None
+    return literal_prefix(w.fn_p.pattern)
+
+  def add_file(self, fn):
+    node = self.files
+    for comp in fn.split(b'/'):
+      node = node.setdefault(comp, {})
+    node[None] = fn
+
+  def remove_file(self, fn):
+    path = []
+    node = self.files
+    for comp in fn.split(b'/'):
+      path.append((node, comp))
+      node = node.get(comp)
+      if (node is None):
+        return
+    node.pop(None, None)
+    for (parent, comp) in reversed(path):
+      if parent[comp]:
+        break
+      del(parent[comp])
+
+  def _iter_files(self, node):
+    stack = [node]
+    while stack:
+      node = stack.pop()
+      for (k, v) in node.items():
+        if (k is None):
+          yield v
+        else:
+          stack.append(v)
+
+  def add_watch(self, w):
+    w.fn_prefix = prefix = self._get_prefix(w)
+    if (prefix is None):
+      self.w_any.append(w)
+    elif (b'/' in prefix):
+      self.w_comp.setdefault(prefix.split(b'/', 1)[0], []).append(w)
+    else:
+      self.w_short.append(w)
+
+  def remove_watch(self, w):
+    prefix = w.fn_prefix
+    if (prefix is None):
+      self.w_any.remove(w)
+    elif (b'/' in prefix):
+      key = prefix.split(b'/', 1)[0]
+      ws = self.w_comp[key]
+      ws.remove(w)
+      if not ws:
+        del(self.w_comp[key])
+    else:
+      self.w_short.remove(w)
+
+  def files_for_watch(self, w):
+    prefix = w.fn_prefix
+    if (prefix is None):
+      cands = self._iter_files(self.files)
+    else:
+      comps = prefix.split(b'/')
+      node = self.files
+      for comp in comps[:-1]:
+        node = node.get(comp)
+        if (node is None):
+          return []
+      partial = comps[-1]
+      cands = []
+      for (k, v) in node.items():
+        if not (k is None) and k.startswith(partial):
+          cands.extend(self._iter_files(v))
+
+    return [fn for fn in cands if w.fn_p.search(fn)]
+
+  def watchs_for_file(self, fn):
+    cands = self.w_comp.get(fn.split(b'/', 1)[0], []) + self.w_short
+    cands = [w for w in cands if fn.startswith(w.fn_prefix)]
+    cands.extend(self.w_any)
+    cands.sort(key=lambda w: w.idx)
+    return [w for w in cands if w.fn_p.search(fn)]
+
+
 @reg_es_parsers
 class EventStreamClient(EventStream):
   def __init__(self, *args, **kwargs):
@@ -319,9 +1303,49 @@ class EventStreamClient(EventStream):
     (_, idx) = msg
     self.process_notify(idx)
 
+  def process_msg_NOTIFY_BATCH(self, msg):
+    (_, mask) = msg
+    for idx in mask_to_idxs(int.from_bytes(mask, 'little')):
+      self.process_notify(idx)
+
+  def process_msg_NOTIFY_CONTEXT(self, msg):
+    (_, data) = msg
+    (entries, _) = decode_object(zlib.decompress(data), fmt=self.fmt_in)
+    for (idx, lines) in entries:
+      self.process_notify_context(idx, lines)
+
+  def process_notify_context(self, idx, lines):
+    # To be overridden by users that want to see the matched lines.
+    self.process_notify(idx)
+
   def process_msg_ACK(self, msg):
+    self.process_ack()
+
+  def process_msg_VERSION(self, msg):
+    super().process_msg_VERSION(msg)
+    if (self.fmt_out is not self.fmt_in):
+      self.set_version_out(self.fmt_in.version)
+
+  def process_ack(self):
+    pass
+
+  def process_msg_STATS(self, msg):
+    self.process_stats(dict(msg[1:]))
+
+  def process_stats(self, stats):
+    # To be overridden by users that poll for stats; gets a {name: value} dict.
     pass
 
+  def request_stats(self):
+    self.send_msg([MSG_ID_STATS_REQUEST])
+
+  def process_msg_WATCH_WARN(self, msg):
+    (_, idx, text) = msg
+    self.process_watch_warn(idx, text)
+
+  def process_watch_warn(self, idx, text):
+    log(30, 'Warning for watch {}: {}'.format(idx, text))
+
   def reset(self):
     self.send_msg([MSG_ID_RESET])
 
@@ -336,17 +1360,50 @@ class EventStreamClient(EventStream):
 
     return w
 
+  def remove_watch(self, idx):
+    self.send_msg([MSG_ID_WATCH_REMOVE, idx])
+
+  def replace_watch(self, idx, fn_p, line_p):
+    w = Watch(fn_p, line_p)
+    w.idx = idx
+    self.send_msg([MSG_ID_WATCH_REPLACE, idx, fn_p, line_p])
+    return w
+
   def send_config(self, config):
     self.send_msg([MSG_ID_CONFIG] + config.to_msg())
 
 
 @reg_es_parsers
 class EventStreamServer(EventStream):
+  MATCHER_CACHE_SIZE = 256
+
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
     self.watchs = []
     self.fn2ws = {}
+    # Watch state as bitmasks over watch indices: the watches mapped to each file, the ones activated by WATCH_SET,
+    # set by a fire (until RESET) and disabled. Armed ones are active and neither set nor disabled, so which watches
+    # need to look at a file comes down to fn2mask[fn] & _armed.
+    self.fn2mask = {}
+    self._active = 0
+    self._set = 0
+    self._disabled = 0
+    self._armed = 0
+    self.fidx = FilenameIndex()
+    self._matchers = {}
+    self._fired = 0
+    self._context = {}
+    self._flush_timer = None
     self.c = Config()
+    self.lines_scanned = 0
+    self.watch_evals = []
+    self.watch_matches = []
+    self.watch_times = []
+    self.watch_strikes = []
+
+  # To be overridden by the driver with a gonium ED.set_timer compatible callable, if available. Otherwise pending
+  # notify batches are flushed at the end of each notify() call.
+  set_timer = None
 
   def send_ACK(self):
     self.send_msg([MSG_ID_ACK])
@@ -354,38 +1411,265 @@ class EventStreamServer(EventStream):
   def watch_files(self, fns):
     pass
 
+  def catch_up(self):
+    # Called once watches are live; to be overridden by drivers with data backlogged from before the connection.
+    pass
+
+  def get_driver_stats(self):
+    # To be overridden by drivers to add their own [name, value] pairs to STATS replies.
+    return []
+
+  def get_stats(self):
+    return [
+      ['files_known', len(self.fn2ws)],
+      ['files_watched', sum(1 for ws in self.fn2ws.values() if ws)],
+      ['watches', sum(1 for w in self.watchs if w)],
+      ['lines_scanned', self.lines_scanned],
+      ['watch_evals', self.watch_evals],
+      ['watch_matches', self.watch_matches],
+      ['watch_time_us', [int(t * 1e6) for (t, _) in self.watch_times]],
+      ['watch_time_max_us', [int(t * 1e6) for (_, t) in self.watch_times]],
+      ['watches_disabled', sum(1 for w in self.watchs if w and w.disabled)],
+      ['watches_armed', bin(self._armed).count('1')],
+      ['msgs_sent', self.msgs_sent],
+      ['bytes_sent', self.bytes_sent],
+      ['msgs_recv', self.msgs_recv],
+      ['bytes_recv', self.bytes_recv],
+      ['inbuf_depth', self.inbuf_depth],
+      ['inbuf_depth_max', self.inbuf_depth_max],
+    ] + self.get_driver_stats()
+
   def get_watched_files(self):
     return [k for (k,v) in self.fn2ws.items() if v]
 
   def add_file(self, fn):
-    self.fn2ws.setdefault(fn, [])
+    # Files showing up after watches were set up need to be matched against them right away.
+    if (fn in self.fn2ws):
+      return
+    self.fidx.add_file(fn)
+    ws = self._map_file(fn)
+    if ws:
+      self.watch_files([fn])
+
+  def _map_file(self, fn):
+    ws = self.fn2ws[fn] = self.fidx.watchs_for_file(fn)
+    mask = 0
+    for w in ws:
+      mask |= 1 << w.idx
+    self.fn2mask[fn] = mask
+    return ws
+
+  def remove_file(self, fn):
+    if (self.fn2ws.pop(fn, None) is not None):
+      del(self.fn2mask[fn])
+      self.fidx.remove_file(fn)
+
+  def _update_armed(self):
+    self._armed = self._active & ~(self._set | self._disabled)
 
   def add_watch(self, w):
+    # New watches stay inactive until the next WATCH_SET.
     w.idx = len(self.watchs)
-    w.__active = False
     self.watchs.append(w)
-    fns = []
-    for (fn, ws) in self.fn2ws.items():
-      if w.fn_p.search(fn):
-        ws.append(w)
-        fns.append(fn)
+    self.watch_evals.append(0)
+    self.watch_matches.append(0)
+    self.watch_times.append([0, 0])
+    self.watch_strikes.append(0)
+    self._index_watch(w)
+
+  def _index_watch(self, w):
+    self.fidx.add_watch(w)
+    fns = self.fidx.files_for_watch(w)
+    bit = 1 << w.idx
+    for fn in fns:
+      ws = self.fn2ws[fn]
+      ws.append(w)
+      if (len(ws) > 1) and (ws[-2].idx > w.idx):
+        ws.sort(key=lambda w: w.idx)
+      self.fn2mask[fn] |= bit
     self.watch_files(fns)
 
-  def notify(self, fn, get_lines):
-    for w in self.get_watchs(fn):
-      if (not w.__active) or w.set:
-        continue
+  def remove_watch(self, w):
+    # The index stays taken (by None in self.watchs), so that watch IDs are stable.
+    bit = 1 << w.idx
+    for fn in self.fidx.files_for_watch(w):
+      self.fn2ws[fn].remove(w)
+      self.fn2mask[fn] &= ~bit
+    self.fidx.remove_watch(w)
+    self.watchs[w.idx] = None
+    self._active &= ~bit
+    self._set &= ~bit
+    self._disabled &= ~bit
+    self._update_armed()
+    # Cached matchers might have the old watch under this index.
+    self._matchers.clear()
+
+  def replace_watch(self, w_old, w):
+    # w takes over w_old's index and activation state; set and disabled state start over.
+    idx = w.idx = w_old.idx
+    active = self._active & (1 << idx)
+    self.remove_watch(w_old)
+    self.watchs[idx] = w
+    self.watch_strikes[idx] = 0
+    self._active |= active
+    self._update_armed()
+    self._index_watch(w)
+
+  def get_matcher(self, mask):
+    # Matchers are keyed by the armed watch mask, so changes in liveness (setup, watch set, reset, fires) only cause
+    # a rebuild for the sets actually seen afterwards, and files sharing a set share the compiled pattern.
+    rv = self._matchers.get(mask)
+    if (rv is None):
+      if (len(self._matchers) >= self.MATCHER_CACHE_SIZE):
+        self._matchers.clear()
+      ws = self.watchs
+      rv = self._matchers[mask] = LineMatcher([ws[i] for i in mask_to_idxs(mask)])
+    return rv
 
-      # See if any of the new lines are matched by our line pattern.
-      for line in get_lines():
-        m = w.line_p.search(line)
-        if (m is None):
-          continue
+  def get_armed_mask(self, fn):
+    # Bitmask of the watches that need to see new lines in fn; drivers can skip reading them if it's 0.
+    mask = self.fn2mask.get(fn)
+    if (mask is None):
+      self.get_watchs(fn)
+      mask = self.fn2mask[fn]
+    return mask & self._armed
 
-        if (not self.c.auto_reset):
-          w.set = True
-        self.send_msg([MSG_ID_NOTIFY, w.idx])
-        break
+  def get_armed(self, fn):
+    ws = self.watchs
+    return [ws[i] for i in mask_to_idxs(self.get_armed_mask(fn))]
+
+  def notify(self, fn, get_lines):
+    mask = self.get_armed_mask(fn)
+    if not mask:
+      return
+
+    # See if any of the new lines are matched by our line patterns.
+    c = self.c
+    m = self.get_matcher(mask)
+    lines = get_lines()
+    if (c.max_line_len > 0):
+      lines = (line[:c.max_line_len] for line in lines)
+    if (c.watch_budget_us > 0):
+      (fired, over) = m.match_timed(lines, self.watch_evals, self.watch_times, c.watch_budget_us / 1e6)
+      if over:
+        self._process_over_budget(over)
+    else:
+      fired = m.match(lines, self.watch_evals)
+    self.lines_scanned += m.lines_scanned
+    self._process_fired(fired)
+
+  def notify_region(self, fn, get_windows):
+    # Like notify(), for drivers that hand us memory-mapped windows (see TailReader.read_windows()) instead of lines.
+    mask = self.get_armed_mask(fn)
+    if not mask:
+      return
+
+    c = self.c
+    m = self.get_matcher(mask)
+    times = self.watch_times if (c.watch_budget_us > 0) else None
+    fired = m.match_region(get_windows(), self.watch_evals, c.max_line_len, times, c.watch_budget_us / 1e6)
+    self.lines_scanned += m.lines_scanned
+    if m.over:
+      self._process_over_budget(m.over)
+    self._process_fired(fired)
+
+  def apply_match_result(self, fired, lines_scanned, evals, times=None, over=()):
+    # For matching done elsewhere (see taf.pool): fired is [(watch idx, line)...]. Fires for watches that got set or
+    # deactivated in the meantime are dropped.
+    self.lines_scanned += lines_scanned
+    we = self.watch_evals
+    for (idx, n) in evals.items():
+      we[idx] += n
+    if times:
+      wt = self.watch_times
+      for (idx, (t, t_max)) in times.items():
+        wt[idx][0] += t
+        if (t_max > wt[idx][1]):
+          wt[idx][1] = t_max
+    ws = self.watchs
+    if over:
+      self._process_over_budget([(ws[idx], dt) for (idx, dt) in over if ws[idx]])
+    armed = self._armed
+    self._process_fired([(ws[idx], line) for (idx, line) in fired if ((armed >> idx) & 1)])
+
+  def _process_fired(self, fired):
+    if not fired:
+      return
+
+    c = self.c
+    wm = self.watch_matches
+    for (w, line) in fired:
+      wm[w.idx] += 1
+    if not c.auto_reset:
+      bits = 0
+      for (w, line) in fired:
+        bits |= 1 << w.idx
+      self._set |= bits
+      self._armed &= ~bits
+
+    if c.notify_context:
+      for (w, line) in fired:
+        lines = self._context.setdefault(w.idx, [])
+        if (len(lines) < c.notify_context_lines):
+          lines.append(line[:c.notify_context])
+
+    if not c.notify_batch:
+      if c.notify_context:
+        self.flush_notifies()
+      else:
+        self.send_msgs([[MSG_ID_NOTIFY, w.idx] for (w, line) in fired])
+      return
+
+    for (w, line) in fired:
+      self._fired |= 1 << w.idx
+    if not (self._flush_timer is None):
+      return
+    if (self.set_timer is None):
+      self.flush_notifies()
+    else:
+      self._flush_timer = self.set_timer(self.c.notify_batch_ms / 1000, self._flush_notifies_timed)
+
+  def _process_over_budget(self, over):
+    strikes = self.watch_strikes
+    for (w, dt) in over:
+      if w.disabled:
+        continue
+      strikes[w.idx] += 1
+      if (strikes[w.idx] < self.c.watch_budget_strikes):
+        log(30, 'Watch {} line pattern {!a} took {:.3f}ms on one line.'.format(w.idx, w.line_p.pattern, dt * 1000))
+        continue
+      self._disable_watch(w, 'Disabled after {} evaluations over the {}us budget; worst took {:.3f}ms.'.format(
+        strikes[w.idx], self.c.watch_budget_us, self.watch_times[w.idx][1] * 1000))
+
+  def _disable_watch(self, w, text):
+    w.disabled = True
+    self._disabled |= 1 << w.idx
+    self._update_armed()
+    log(30, 'Watch {} line pattern {!a}: {}'.format(w.idx, w.line_p.pattern, text))
+    self.send_msg([MSG_ID_WATCH_WARN, w.idx, text])
+
+  def _check_watch(self, w):
+    # The time budget is only checked once a search returns, which for some patterns is too late to matter.
+    if (self.c.watch_budget_us > 0) and nested_repeat(w.line_p):
+      self._disable_watch(w, 'Disabled: nested repeats (like (a+)+) can backtrack for longer than any budget.')
+
+  def _flush_notifies_timed(self):
+    self._flush_timer = None
+    self.flush_notifies()
+
+  def flush_notifies(self):
+    if (self._flush_timer is not None):
+      self._flush_timer.cancel()
+      self._flush_timer = None
+    if self._context:
+      # Every fired watch has an entry here, so this covers the batch too.
+      e = Encoder(self.fmt_out)
+      e.encode_list([[idx, lines] for (idx, lines) in self._context.items()])
+      self.send_msg([MSG_ID_NOTIFY_CONTEXT, zlib.compress(e.data)])
+      self._context.clear()
+    elif self._fired:
+      self.send_msg([MSG_ID_NOTIFY_BATCH, encode_vint(self._fired, 'little')])
+    self._fired = 0
 
   def process_msg_WATCH_SETUP(self, msg):
     (_, fn_p, line_p) = msg
@@ -394,35 +1678,308 @@ class EventStreamServer(EventStream):
     w = Watch(fn_r, line_r)
     self.add_watch(w)
     self.send_msg([MSG_ID_ACK])
+    self._check_watch(w)
+
+  def _get_watch(self, idx):
+    if (idx < len(self.watchs)) and self.watchs[idx]:
+      return self.watchs[idx]
+    raise TafProtocolError('No watch with ID {!r}.'.format(idx))
+
+  def process_msg_WATCH_REMOVE(self, msg):
+    (_, idx) = msg
+    w = self._get_watch(idx)
+    # Anything the watch fired before this goes out first.
+    self.flush_notifies()
+    self.remove_watch(w)
+    self.send_msg([MSG_ID_ACK])
+
+  def process_msg_WATCH_REPLACE(self, msg):
+    (_, idx, fn_p, line_p) = msg
+    w_old = self._get_watch(idx)
+    w = Watch(re.compile(bytes(fn_p)), re.compile(bytes(line_p)))
+    self.flush_notifies()
+    self.replace_watch(w_old, w)
+    self.send_msg([MSG_ID_ACK])
+    self._check_watch(w)
 
   def process_msg_WATCH_SET(self, msg):
+    # Keep message order as seen by the client the same as without batching.
+    self.flush_notifies()
     (_, mask) = msg
-    v = int.from_bytes(mask, 'little')
-
-    p = 1
-    for (i, w) in enumerate(self.watchs):
-      w.__active = bool(p & v)
-      p <<= 1
+    self._active = int.from_bytes(mask, 'little') & ((1 << len(self.watchs)) - 1)
+    self._update_armed()
+    self.catch_up()
 
   def process_msg_RESET(self, msg):
-    for w in self.watchs:
-      w.set = False
+    self.flush_notifies()
+    self._set = 0
+    self._update_armed()
 
   def get_watchs(self, fn):
     ws = self.fn2ws.get(fn)
     if (ws is None):
-      ws = []
-      for w in self.watches:
-        if w.fn_p.search(fn):
-          ws.append(w)
-      self.fn2ws[fn] = ws
-    
+      self.fidx.add_file(fn)
+      ws = self._map_file(fn)
     return ws
 
   def process_msg_CONFIG(self, msg):
-    self.c = Config.build_from_dict(dict(msg[1:]))
+    d = dict(msg[1:])
+    # Clients that don't offer a version only speak the first one.
+    version = min(d.get('proto_version', 1), PROTO_VERSION)
+    self.c = Config.build_from_dict(d)
+    self.c.proto_version = version
+    if (version != self.fmt_out.version):
+      self.set_version_out(version)
+
+  def process_msg_STATS_REQUEST(self, msg):
+    # Don't let the reply overtake notifies still waiting for their batch timer.
+    self.flush_notifies()
+    self.send_msg([MSG_ID_STATS] + self.get_stats())
+
+
+def _test_line_matcher():
+  ps = (br'(^|[^A-z0-9\.])mynick([^A-z0-9]|$)', b'foo', b'(?i)BAR', br'(a)\1', b'foo|baz')
+  ws = []
+  for (i, p) in enumerate(ps):
+    w = Watch(None, re.compile(p))
+    w.idx = i
+    ws.append(w)
+
+  for (lines, idxs) in (
+      ([], ()),
+      ([b'nothing here'], ()),
+      ([b'hi mynick', b'xx'], (0,)),
+      ([b'foo bar'], (1, 2, 4)),
+      ([b'x', b'aa', b'baz', b'mynick: foo'], (0, 1, 3, 4))):
+    fired = LineMatcher(ws).match(lines)
+    got = tuple(sorted(w.idx for (w, _) in fired))
+    if (got != idxs):
+      raise ValueError('Matcher mismatch on {!r}: {!r} != {!r}'.format(lines, got, idxs))
+    # With a zero budget, every evaluation is over it; the matches must be the same either way.
+    times = [[0, 0] for w in ws]
+    (fired_t, over) = LineMatcher(ws).match_timed(lines, [0] * len(ws), times, 0)
+    if (fired_t != fired) or (lines and not over):
+      raise ValueError('Timed matcher mismatch on {!r}: {!r} != {!r}, {!r}'.format(lines, fired_t, fired, over))
+
+  # Region matching has to agree with line matching, whichever way the lines are split into windows.
+  ps_r = ps + (br'^$', br'(?<![\s])x', br'mynick\s', br'\Aaa')
+  ws_r = []
+  for (i, p) in enumerate(ps_r):
+    w = Watch(None, re.compile(p))
+    w.idx = i
+    ws_r.append(w)
+  for lines in ([b''], [b'nothing', b'here'], [b'a', b'mynick', b'b'], [b'x foo', b'', b'baz', b'aa x', b'xx'],
+      [b'zz', b'x', b'hi.mynick', b'ok mynick bar']):
+    want = LineMatcher(ws_r).match(lines)
+    buf = b'\n'.join(lines) + b'\n'
+    for cut in range(len(lines) + 1):
+      off = len(b'\n'.join(lines[:cut]))
+      if cut:
+        windows = [(buf, 0, off), (buf, off + 1, len(buf) - 1)]
+      else:
+        windows = [(buf, 0, len(buf) - 1)]
+      if (cut == len(lines)):
+        windows = windows[:1]
+      evals = [0] * len(ws_r)
+      got = LineMatcher(ws_r).match_region(windows, evals)
+      if (sorted(got, key=lambda e: e[0].idx) != sorted(want, key=lambda e: e[0].idx)):
+        raise ValueError('Region matcher mismatch on {!r}/{}: {!r} != {!r}'.format(lines, cut, got, want))
+      # Likewise with lines cut short, and with every evaluation over a zero budget.
+      for cap in (2, 6):
+        want_c = LineMatcher(ws_r).match([line[:cap] for line in lines])
+        got_c = LineMatcher(ws_r).match_region(windows, None, cap)
+        if (sorted(got_c, key=lambda e: e[0].idx) != sorted(want_c, key=lambda e: e[0].idx)):
+          raise ValueError('Capped region mismatch on {!r}/{}/{}: {!r} != {!r}'.format(lines, cut, cap, got_c, want_c))
+      m = LineMatcher(ws_r)
+      got_t = m.match_region(windows, None, 0, [[0, 0] for w in ws_r], 0)
+      if (sorted(got_t, key=lambda e: e[0].idx) != sorted(want, key=lambda e: e[0].idx)) or not m.over:
+        raise ValueError('Timed region mismatch on {!r}/{}: {!r} != {!r}, {!r}'.format(lines, cut, got_t, want, m.over))
+
+  # Searches over budget have the lines they went through rerun one by one, whole.
+  class M(LineMatcher):
+    def _find_over(self, ws, lines, *args):
+      seen.extend(lines)
+  seen = []
+  buf = b'abcd\nefg\nxfoo\n'
+  M(ws[1:2]).match_region([(buf, 0, len(buf) - 1)], None, 0, [[0, 0] for w in ws], 1e-9)
+  if (seen != [b'abcd', b'efg']):
+    raise ValueError('Bad over-budget rerun lines: {!r}'.format(seen))
+
+  for (p, lit) in ((br'(^|[^A-z0-9\.])mynick([^A-z0-9]|$)', b'mynick'), (b'foo', b'foo'), (b'(?i)BAR', None),
+      (b'foo|baz', None), (br'ab*cd', b'cd'), (br'ab+cd', b'ab'), (br'x\.y', b'x.y'), (br'\x41bcd', b'bcd'),
+      (br'[(]abc(x)?', b'abc'), (br'(foo|bar)[0-9]+ .*hl1:', b'hl1:'), (br'\0123ab', b'3ab'), (br'\d+', None)):
+    if (required_literal(re.compile(p)) != lit):
+      raise ValueError('Literal mismatch on {!r}: {!r} != {!r}'.format(p, required_literal(re.compile(p)), lit))
+
+  for (p, nested) in ((b'(a+)+$', True), (b'(?:x|(.*y)*)z', True), (b'(.*x){20}', True), (b'(ab)+c*', False),
+      (b'a+b+.*', False), (b'(a+){2}', False), (b'(?=(b+)+)', True)):
+    if (nested_repeat(re.compile(p)) != nested):
+      raise ValueError('Nested repeat mismatch on {!r}: {!r}'.format(p, not nested))
+
+  # Per-watch evaluation counts stop at the line each watch fired on.
+  evals = [0] * len(ws)
+  m = LineMatcher(ws)
+  m.match([b'x', b'aa', b'baz', b'mynick: foo', b'y'], evals)
+  if (evals != [4, 4, 5, 2, 3]) or (m.lines_scanned != 5):
+    raise ValueError('Eval count mismatch: {!r}, {!r}'.format(evals, m.lines_scanned))
+
+
+def _test_filename_index():
+  for (p, prefix) in ((b'^network/chan0', b'network/chan0'), (b'^net\\.work/c+', b'net.work/c'),
+      (b'^network/chan?', b'network/cha'), (b'^a/b|c', None), (b'chan', None), (b'^\\w', None)):
+    if (literal_prefix(p) != prefix):
+      raise ValueError('Prefix mismatch on {!r}: {!r} != {!r}'.format(p, literal_prefix(p), prefix))
+
+  fns = (b'network/chan0', b'network/chan1', b'network/chan10', b'network/other', b'net2/chan0', b'top')
+  ps = (b'^network/chan1', b'^network/', b'chan0$', b'^net', b'(?i)^TOP', b'^n.*0$')
+  idx = FilenameIndex()
+  ws = []
+  for fn in fns[:3]:
+    idx.add_file(fn)
+  for (i, p) in enumerate(ps):
+    w = Watch(re.compile(p), None)
+    w.idx = i
+    idx.add_watch(w)
+    ws.append(w)
+  for fn in fns[3:]:
+    idx.add_file(fn)
+  idx.remove_file(b'network/chan1')
+  idx.add_file(b'network/chan1')
+
+  for w in ws:
+    got = sorted(idx.files_for_watch(w))
+    want = sorted(fn for fn in fns if w.fn_p.search(fn))
+    if (got != want):
+      raise ValueError('Index mismatch on {!r}: {!r} != {!r}'.format(w.fn_p, got, want))
+  for fn in fns:
+    got = idx.watchs_for_file(fn)
+    want = [w for w in ws if w.fn_p.search(fn)]
+    if (got != want):
+      raise ValueError('Index mismatch on {!r}: {!r} != {!r}'.format(fn, got, want))
+
+
+class _TestPipe:
+  # In-memory stand-in for one direction of a stream; data is delivered by calling pump().
+  def __init__(self):
+    self.buf = bytearray()
+    self.size_need = 0
+
+  def send_bytes(self, bufs):
+    for b in bufs:
+      self.buf += b
+
+  def discard_inbuf_data(self, n):
+    del(self.buf[:n])
+
+  def pump(self):
+    if (len(self.buf) >= max(self.size_need, 1)):
+      self.process_input(memoryview(bytes(self.buf)))
+
+def _test_negotiation():
+  @reg_es_parsers
+  class OldServer(EventStreamServer):
+    def process_msg_CONFIG(self, msg):
+      self.c = Config.build_from_dict(dict(msg[1:]))
+
+  for (server_cls, offer, want) in ((EventStreamServer, PROTO_VERSION, PROTO_VERSION), (EventStreamServer, None, 1),
+      (OldServer, PROTO_VERSION, 1)):
+    (p_cs, p_sc) = (_TestPipe(), _TestPipe())
+    c = EventStreamClient(p_sc, p_cs)
+    s = server_cls(p_cs, p_sc)
+    got = []
+    c.process_notify = got.append
+    conf = Config()
+    conf.auto_reset = True
+    if (offer is None):
+      del(conf.proto_version)
+    c.send_config(conf)
+    c.add_watch(b'^foo$', b'bar')
+    c.watch_set(b'\x01')
+    for i in range(3):
+      p_cs.pump()
+      p_sc.pump()
+    s.notify(b'foo', lambda: [b'a bar'])
+    p_sc.pump()
+    versions = (c.fmt_in.version, c.fmt_out.version, s.fmt_in.version, s.fmt_out.version)
+    if (versions != (want,) * 4) or (got != [0]):
+      raise ValueError('Negotiation mismatch for {}/{}: {!r}, {!r}'.format(server_cls.__name__, offer, versions, got))
+
+def _test_armed_index(direct=False):
+  # With direct, the streams are linked in-process; the pipes then just stay empty.
+  (p_cs, p_sc) = (_TestPipe(), _TestPipe())
+  if direct:
+    c = EventStreamClient(None, None)
+    s = EventStreamServer(None, None)
+    c.link(s)
+  else:
+    c = EventStreamClient(p_sc, p_cs)
+    s = EventStreamServer(p_cs, p_sc)
+  got = []
+  c.process_notify = got.append
+  c.send_config(Config())
+  for (fn_p, line_p) in ((b'^a$', b'x'), (b'^a$', b'y'), (b'^b$', b'x'), (b'.', b'z')):
+    c.add_watch(fn_p, line_p)
+  c.watch_set(b'\x0b')
+  p_cs.pump()
+  p_sc.pump()
+  s.add_watch(Watch(re.compile(b'^a$'), re.compile(b'x')))
+
+  def notify(fn, lines):
+    reads = []
+    s.notify(fn, lambda: reads.append(fn) or lines)
+    p_sc.pump()
+    return bool(reads)
+
+  for (fn, lines, want_read, want) in ((b'a', [b'xy', b'z'], True, [0, 1, 3]), (b'a', [b'xyz'], False, []),
+      (b'b', [b'x'], False, []), (b'c', [b'z'], False, []), (b'b', [b'x'], False, [])):
+    del(got[:])
+    if (notify(fn, lines) != want_read) or (sorted(got) != want):
+      raise ValueError('Armed index mismatch on {!r}: {!r} != {!r}'.format(fn, got, want))
+  if (s.get_armed_mask(b'a') != 0):
+    raise ValueError('Watches still armed: {!r}'.format(s.get_armed(b'a')))
+
+  c.reset()
+  p_cs.pump()
+  if ([w.idx for w in s.get_armed(b'a')] != [0, 1, 3]) or (s.get_armed_mask(b'b') != 8):
+    raise ValueError('Armed index mismatch after reset: {!r}'.format(s.get_armed(b'a')))
+  c.watch_set(b'\x1f')
+  p_cs.pump()
+  if ([w.idx for w in s.get_armed(b'a')] != [0, 1, 3, 4]) or ([w.idx for w in s.get_armed(b'b')] != [2, 3]):
+    raise ValueError('Armed index mismatch after watch set: {!r}'.format(s.get_armed(b'a')))
+
+  # Removed watches keep their ID taken; replacements take over the old one's, and its activation state.
+  c.remove_watch(1)
+  c.replace_watch(3, b'^b$', b'q')
+  p_cs.pump()
+  if ([w.idx for w in s.get_armed(b'a')] != [0, 4]) or ([w.idx for w in s.get_armed(b'b')] != [2, 3]):
+    raise ValueError('Armed index mismatch after replace: {!r}'.format(s.get_armed(b'a')))
+  del(got[:])
+  if not notify(b'b', [b'q x', b'y']) or (sorted(got) != [2, 3]):
+    raise ValueError('Notify mismatch after replace: {!r}'.format(got))
+  if (dict(s.get_stats())['watches'] != 4):
+    raise ValueError('Watch count mismatch: {!r}'.format(s.get_stats()))
+  # With a time budget, patterns that can backtrack past it get disabled as soon as they're set up.
+  s.c.watch_budget_us = 1000
+  warns = []
+  c.process_watch_warn = lambda idx, text: warns.append(idx)
+  c.replace_watch(2, b'^b$', b'(q+)+$')
+  p_cs.pump()
+  p_sc.pump()
+  if (warns != [2]) or (2 in [w.idx for w in s.get_armed(b'b')]) or not s.watchs[2].disabled:
+    raise ValueError('Nested repeat watch not disabled: {!r}, {!r}'.format(warns, s.get_armed(b'b')))
+  if direct:
+    c.unlink()
+    c.reset()
+    del(got[:])
+    if notify(b'b', [b'q x']) or got:
+      raise ValueError('Notify after unlink: {!r}'.format(got))
 
 
 if (__name__ == '__main__'):
   _test_serialization()
+  _test_negotiation()
+  _test_armed_index()
+  _test_armed_index(direct=True)
+  _test_line_matcher()
+  _test_filename_index()
   print('Tests done.')
@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+#Copyright 2015 Sebastian Hagen
+# This file is part of taf.
+#
+# taf is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# taf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Logfile tree watching: FileGazer feeds file changes to an EventStreamServer, which is either talking over stdio
+# (logs2stdout.py) or hosted in taf_ui directly, for local trees.
+
+import logging
+import os
+import stat
+import sys
+import time
+
+from taf.checkpoint import fits
+from taf.event_proto import EventStreamServer
+from taf.inotify import IN_CREATE, IN_DELETE, IN_EXCL_UNLINK, IN_IGNORED, IN_ISDIR, IN_MODIFY, IN_MOVED_FROM, \
+  IN_MOVED_TO, IN_ONLYDIR, IN_Q_OVERFLOW
+from taf.scan import TreeScanner
+from taf.tail import TailReader
+
+logger = logging.getLogger('gazer')
+log = logger.log
+
+
+def get_backend(name):
+  # Returns (ED class, data stream class, inotify watch class) for the named event loop implementation.
+  if (name == 'asyncio'):
+    from taf.aio import AioED, AioStream, InotifyWatch
+    return (AioED, AioStream, InotifyWatch)
+  from gonium.fdm import ED_get, AsyncDataStream
+  from gonium.linux.inotify import InotifyWatch
+  return (ED_get(), AsyncDataStream, InotifyWatch)
+
+def ed_shutdown(ed):
+  def shutdown(*args, **kwargs):
+    ed.shutdown()
+  return shutdown
+
+# Usage: start_stdio() or start_stream(), (scan_dir()*, watch_all()), close()
+class FileGazer:
+  # Inotify masks for per-directory watches: new and vanishing entries, plus modifications of the files within.
+  DIR_MASK = (IN_MODIFY | IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_ONLYDIR | IN_EXCL_UNLINK)
+  SCAN_POLL_INTERVAL = 0.02
+  SCAN_REPORT_INTERVAL = 5
+  LAG_PROBE_INTERVAL = 1
+
+  def __init__(self, ed, max_fds=256, watch_dirs=False, ckpt=None, ckpt_interval=5, max_backlog=1<<20,
+      mmap_threshold=1<<22, mmap_window=1<<24, match_workers=0, match_worker_threshold=1<<16, debounce=0,
+      max_latency=0.1, backend='gonium', root=None, *args, **kwargs):
+    self.ed = ed
+    (_, self.DataStream, self.InotifyWatch) = get_backend(backend)
+    self.stream = None
+    self.wd2pn = []
+    # Paths are relative to root (by default, the cwd); base is what makes them usable for filesystem calls.
+    self.base = b''
+    if root:
+      self.base = root.rstrip(b'/') + b'/'
+    self.reader = TailReader(max_fds, window=mmap_window, base=self.base)
+    # New data of at least this many octets is scanned through memory maps rather than read in; 0 to never do so.
+    self.mmap_threshold = mmap_threshold
+    # Matching on worker processes, for new data of at least match_worker_threshold octets. Files with a job in flight
+    # map to [future, more data pending] here, and are left alone until it's done.
+    self.match_workers = match_workers
+    self.match_worker_threshold = match_worker_threshold
+    self.pool = None
+    self._pool_fl = None
+    self._pool_busy = {}
+    # Modified files are collected here (in event order, as path: [first event time, last event time]) and each is
+    # processed once it has been quiet for debounce seconds, or max_latency seconds after its first event came in;
+    # busy files don't hold up quiet ones. With debounce 0, that's at the end of the current event loop iteration.
+    self.debounce = debounce
+    self.max_latency = max_latency
+    self._dirty = {}
+    self._dirty_timer = None
+    self.events_coalesced = 0
+    self.dirty_flushes = 0
+    self.dirty_batch_max = 0
+    self._out_paused = False
+    self.fp2sz = self.reader.offs
+    # In directory-watch mode, inotify watches are placed on directories only, and wd2pn maps to directory paths.
+    self.watch_dirs = watch_dirs
+    self.dp2wd = {}
+    self.scanner = None
+    # Offset checkpointing, for resuming where a previous instance left off. fp2id maps paths to (device, inode).
+    self.ckpt = ckpt
+    self.ckpt_interval = ckpt_interval
+    self.max_backlog = max_backlog
+    self.fp2id = {}
+    self._ckpt_dirty = set()
+    self._gap = set()
+    self._live = False
+    self.inotify_events = 0
+    self.loop_lag = 0
+    self.loop_lag_max = 0
+    self._t_probe = None
+    self._closed = False
+
+  def _start_watch(self):
+    self.iw = self.InotifyWatch(self.ed)
+    self.iw.process_event = self._process_inotify_event
+
+  def _process_inotify_event(self, wd, mask, cookie, name):
+    self.inotify_events += 1
+    if (mask & IN_Q_OVERFLOW):
+      log(30, 'Inotify event queue overflowed; some events were lost.')
+      return
+
+    pn = self.wd2pn[wd]
+    if (pn is None):
+      return
+
+    if self.watch_dirs:
+      if (mask & IN_IGNORED):
+        self._drop_dir_watch(pn)
+        return
+      pn = join_path(pn, name.rstrip(b'\x00'))
+      if (mask & IN_ISDIR):
+        if (mask & (IN_CREATE | IN_MOVED_TO)):
+          self.scan_dir(pn, new=bool(mask & IN_CREATE))
+        elif (mask & (IN_DELETE | IN_MOVED_FROM)):
+          self._forget_dir(pn)
+        return
+      if (mask & (IN_DELETE | IN_MOVED_FROM)):
+        self._forget_file(pn)
+        return
+      if (mask & (IN_CREATE | IN_MOVED_TO)):
+        # Freshly created files are read from the start; files moved in are treated as old news.
+        self._add_file(pn, new=bool(mask & IN_CREATE))
+        if (mask & IN_MOVED_TO):
+          return
+      elif not (pn in self.fp2sz):
+        self._add_file(pn, new=True)
+
+    self._mark_dirty(pn)
+
+  def _mark_dirty(self, pn):
+    now = time.monotonic()
+    t = self._dirty.get(pn)
+    if (t is None):
+      self._dirty[pn] = [now, now]
+    else:
+      self.events_coalesced += 1
+      t[1] = now
+    # Deadlines only ever move back, so a pending timer is never late for this one.
+    if (self._dirty_timer is None):
+      self._dirty_timer = self.ed.set_timer(min(self.debounce, self.max_latency), self._flush_dirty_timed)
+
+  def _flush_dirty_timed(self):
+    self._dirty_timer = None
+    if self._closed or self._out_paused:
+      return
+    now = time.monotonic()
+    due = []
+    t_next = None
+    for (pn, (t_first, t_last)) in self._dirty.items():
+      t = min(t_last + self.debounce, t_first + self.max_latency)
+      if (t <= now):
+        due.append(pn)
+      elif (t_next is None) or (t < t_next):
+        t_next = t
+    if not (t_next is None):
+      # Some are still busy; hold off on those some more.
+      self._dirty_timer = self.ed.set_timer(t_next - now, self._flush_dirty_timed)
+    self._flush_paths(due)
+
+  def flush_dirty(self):
+    # Processes all modified files now, whatever their deadlines.
+    if not (self._dirty_timer is None):
+      self._dirty_timer.cancel()
+      self._dirty_timer = None
+    if self._out_paused:
+      return
+    self._flush_paths(list(self._dirty))
+
+  def _flush_paths(self, pns):
+    if not pns:
+      return
+    self.dirty_flushes += 1
+    if (len(pns) > self.dirty_batch_max):
+      self.dirty_batch_max = len(pns)
+    dirty = self._dirty
+    for pn in pns:
+      del dirty[pn]
+    for pn in pns:
+      self._process_file(pn)
+
+  def _process_file(self, pn):
+    busy = self._pool_busy.get(pn)
+    if not (busy is None):
+      busy[1] = True
+      return
+
+    r = self.reader
+
+    def get_lines():
+      return r.read_lines(pn)
+
+    def get_windows():
+      return r.read_windows(pn)
+
+    try:
+      if not self.stream.get_armed_mask(pn):
+        # Nothing would look at the new lines.
+        r.skip(pn)
+        self._ckpt_dirty.add(pn)
+        return
+      pending = 0
+      if ((self.mmap_threshold > 0) or not (self.pool is None)) and r.may_be_big(pn):
+        # A burst arriving at a file that was keeping up is read in the usual way for its first event.
+        pending = r.get_pending(pn) or 0
+      if not (self.pool is None) and (pending >= self.match_worker_threshold) and self._submit_match(pn):
+        return
+      if (self.mmap_threshold > 0) and (pending >= self.mmap_threshold):
+        self.stream.notify_region(pn, get_windows)
+      else:
+        self.stream.notify(pn, get_lines)
+      r.finish(pn)
+    except OSError as exc:
+      log(30, 'Failed to read from {!a}: {!r}'.format(pn, exc))
+      r.forget(pn)
+      return
+    self._ckpt_dirty.add(pn)
+
+  def start_pool(self):
+    from taf.pool import MatchPool
+    try:
+      self.pool = pool = MatchPool(self.match_workers, self.base)
+    except (OSError, ValueError) as exc:
+      log(30, 'Failed to start matching pool, matching inline: {!r}'.format(exc))
+      return
+    self._pool_fl = fl = self.DataStream(self.ed, os.fdopen(pool.wake_fd, 'rb', 0))
+    def process_input(data):
+      fl.discard_inbuf_data(len(data))
+      self._process_pool_results()
+    fl.process_input = process_input
+
+  def _submit_match(self, pn):
+    ws = self.stream.get_armed(pn)
+    if not ws:
+      return False
+    try:
+      fut = self.pool.submit(pn, self.reader.get_line_offset(pn), ws, self.stream.c)
+    except RuntimeError as exc:
+      # Includes BrokenProcessPool.
+      log(40, 'Matching pool failed, matching inline from now on: {!r}'.format(exc))
+      self.pool = None
+      return False
+    self._pool_busy[pn] = [fut, False]
+    return True
+
+  def _process_pool_results(self):
+    if (self.pool is None):
+      return
+    for (pn, fut) in self.pool.drain():
+      busy = self._pool_busy.get(pn)
+      if (busy is None) or (busy[0] is not fut):
+        # File forgotten in the meantime.
+        continue
+      del(self._pool_busy[pn])
+      try:
+        (fired, lines_scanned, evals, times, over, off, nread) = fut.result()
+      except Exception as exc:
+        log(30, 'Matching {!a} on worker failed, matching inline: {!r}'.format(pn, exc))
+        if isinstance(exc, RuntimeError) and not (self.pool is None):
+          self.pool = None
+        self._process_file(pn)
+        continue
+      self.reader.set_offset(pn, off)
+      self.reader.bytes_read += nread
+      self.stream.apply_match_result(fired, lines_scanned, evals, times, over)
+      self._ckpt_dirty.add(pn)
+      if busy[1]:
+        self._process_file(pn)
+
+  def start_stdio(self):
+    fl_in = self.DataStream(self.ed, os.fdopen(sys.stdin.fileno(), 'rb', 0, closefd=False))
+    fl_out = self.DataStream(self.ed, os.fdopen(sys.stdout.fileno(), 'wb', 0, closefd=False), read_r=False)
+
+    sd = ed_shutdown(self.ed)
+    fl_in.process_close = sd
+    fl_out.process_close = sd
+    self.start_stream(fl_in, fl_out)
+
+  def start_stream(self, fl_in, fl_out):
+    # Serves over the given data streams; with both None, the caller is expected to link() self.stream to a client
+    # in this process.
+    if hasattr(fl_out, 'process_pause'):
+      # Backends with flow control: stop taking in requests and file changes while the client isn't keeping up.
+      fl_out.process_pause = self._set_out_paused
+
+    self.stream = EventStreamServer(fl_in, fl_out)
+    if not self.watch_dirs:
+      self.stream.watch_files = self._watch_files
+    self.stream.set_timer = self.ed.set_timer
+    self.stream.catch_up = self._catch_up
+    self.stream.get_driver_stats = self.get_stats
+    self._start_watch()
+    self._probe_lag()
+    if not (self.ckpt is None):
+      self.ed.set_timer(self.ckpt_interval, self._flush_checkpoints_timed)
+
+  def _set_out_paused(self, paused):
+    self._out_paused = paused
+    fl_in = self.stream.fl_in
+    if paused:
+      fl_in.pause_reading()
+    else:
+      fl_in.resume_reading()
+      self.flush_dirty()
+
+  def close(self):
+    # Stops watching, and lets go of files, workers and the inotify fd. Timers still pending find out and stop.
+    self._closed = True
+    if not (self.pool is None):
+      self._pool_fl.close()
+      self.pool.shutdown()
+      self.pool = None
+    self.flush_checkpoints()
+    self.reader.close_all()
+    close = getattr(self.iw, 'close', None)
+    if not (close is None):
+      close()
+
+  def _probe_lag(self):
+    # Event loop lag: how late our timer fires compared to when it was due.
+    if self._closed:
+      return
+    now = time.monotonic()
+    if not (self._t_probe is None):
+      self.loop_lag = lag = max(0, now - self._t_probe)
+      if (lag > self.loop_lag_max):
+        self.loop_lag_max = lag
+    self._t_probe = now + self.LAG_PROBE_INTERVAL
+    self.ed.set_timer(self.LAG_PROBE_INTERVAL, self._probe_lag)
+
+  def get_stats(self):
+    return [
+      ['inotify_events', self.inotify_events],
+      ['bytes_read', self.reader.bytes_read],
+      ['fds_open', self.reader.get_fd_count()],
+      ['pool_jobs', 0 if (self.pool is None) else self.pool.jobs],
+      ['events_coalesced', self.events_coalesced],
+      ['dirty_flushes', self.dirty_flushes],
+      ['dirty_batch_max', self.dirty_batch_max],
+      ['loop_lag_us', int(self.loop_lag * 1e6)],
+      ['loop_lag_max_us', int(self.loop_lag_max * 1e6)],
+    ]
+
+  def update_file_size(self, path):
+    sz_prev = self.reader.get_offset(path)
+    self._init_offset(path, os.stat(self.base + path))
+    return sz_prev
+
+  def _init_offset(self, path, st, new=False):
+    # Picks the offset to start reading a file at: the start for new files, the checkpointed offset for files known
+    # from a previous run (replaying no more than max_backlog octets), and the current end otherwise.
+    key = (st.st_dev, st.st_ino)
+    self.fp2id[path] = key
+    size = st.st_size
+    off = size
+    ck = self.ckpt
+    if new:
+      off = 0
+    elif not (ck is None):
+      rec = ck.get(key)
+      c_off = None
+      if (rec is None):
+        if not (ck.t_flush is None) and (st.st_mtime > ck.t_flush):
+          # Showed up while we weren't looking.
+          c_off = 0
+      elif fits(rec, st):
+        c_off = rec[0]
+      else:
+        # Truncated, rewritten or replaced while we weren't looking; as at runtime, start over.
+        log(20, 'File {!a} changed under its checkpoint; rereading from start.'.format(path))
+        c_off = 0
+      if not (c_off is None):
+        off = max(c_off, size - self.max_backlog)
+        if (off < size):
+          self._gap.add(path)
+
+    self.reader.set_offset(path, off)
+    self._ckpt_dirty.add(path)
+
+  def _is_known(self, path, st):
+    # Whether we're already following this very file under path; with directory watches, files can turn up through
+    # both IN_CREATE and a concurrent scan, and starting over on them would report their lines twice.
+    return (self.fp2id.get(path) == (st.st_dev, st.st_ino)) and not (self.reader.get_offset(path) is None)
+
+  def _add_file(self, path, new=False):
+    try:
+      st = os.stat(self.base + path)
+    except OSError as exc:
+      log(30, 'Failed to add {!a}: {!r}'.format(path, exc))
+      return
+    if self._is_known(path, st):
+      return
+    self._init_offset(path, st, new)
+    self.stream.add_file(path)
+
+  def _forget_file(self, path):
+    self._dirty.pop(path, None)
+    self._pool_busy.pop(path, None)
+    self.reader.forget(path)
+    self.stream.remove_file(path)
+    self._gap.discard(path)
+    self._ckpt_dirty.discard(path)
+    key = self.fp2id.pop(path, None)
+    if not (key is None) and not (self.ckpt is None):
+      self.ckpt.discard(key)
+
+  def _catch_up(self):
+    # Watches are live now; scan whatever was written to known files while no instance was running.
+    self._live = True
+    gap = self._gap
+    self._gap = set()
+    if gap:
+      log(20, 'Catching up on {} files.'.format(len(gap)))
+    for path in gap:
+      self._process_file(path)
+
+  def flush_checkpoints(self):
+    if (self.ckpt is None):
+      return
+    r = self.reader
+    for path in self._ckpt_dirty:
+      key = self.fp2id.get(path)
+      off = r.get_line_offset(path)
+      if (key is None) or (off is None):
+        continue
+      try:
+        st = os.fstat(r.get_fd(path))
+      except OSError:
+        continue
+      self.ckpt.set(key, off, st.st_size, st.st_mtime_ns)
+    self._ckpt_dirty.clear()
+    try:
+      self.ckpt.flush()
+    except OSError as exc:
+      log(40, 'Failed to write checkpoints to {!a}: {!r}'.format(self.ckpt.path, exc))
+
+  def _flush_checkpoints_timed(self):
+    if self._closed:
+      return
+    try:
+      self.flush_checkpoints()
+    finally:
+      # Whatever went wrong this time, keep trying.
+      self.ed.set_timer(self.ckpt_interval, self._flush_checkpoints_timed)
+
+  def _forget_dir(self, path):
+    prefix = path + b'/'
+    for fp in [fp for fp in self.fp2sz if fp.startswith(prefix)]:
+      self._forget_file(fp)
+    for dp in [dp for dp in self.dp2wd if (dp == path) or dp.startswith(prefix)]:
+      self._drop_dir_watch(dp)
+
+  def scan_dir(self, path, new=False):
+    for rv in TreeScanner(norm_path(path), base=self.base).run():
+      self._add_scanned(rv, new)
+
+  def scan_dir_async(self, path, threads):
+    # Scan on a thread pool, feeding results to the server as they come in.
+    self.scanner = sc = TreeScanner(norm_path(path), threads, self.base)
+    self._scan_t_report = 0
+    sc.start()
+    self._scan_poll()
+
+  def _scan_poll(self):
+    if self._closed:
+      return
+    sc = self.scanner
+    for rv in sc.drain():
+      self._add_scanned(rv)
+
+    if sc.is_done():
+      log(20, 'Scan done: {}.'.format(sc.format_progress()))
+      self.scanner = None
+      return
+
+    t = sc.elapsed()
+    if (t - self._scan_t_report >= self.SCAN_REPORT_INTERVAL):
+      self._scan_t_report = t
+      log(20, 'Scan progress: {}.'.format(sc.format_progress()))
+    self.ed.set_timer(self.SCAN_POLL_INTERVAL, self._scan_poll)
+
+  def _add_scanned(self, rv, new=False):
+    (dp, files, dirs) = rv
+    watched = self.watch_dirs and self._watch_dir(dp)
+    # Reuse the scanner's stat results rather than looking at each file again.
+    for (fp, st) in files:
+      if self._is_known(fp, st):
+        continue
+      self._init_offset(fp, st, new)
+      self.stream.add_file(fp)
+      if new or (self._live and (fp in self._gap)):
+        # Data written before we were watching; catch up on it.
+        self._gap.discard(fp)
+        self._process_file(fp)
+    if watched:
+      self._rescan_dir(dp, files, dirs)
+
+  def _rescan_dir(self, dp, files, dirs):
+    # The scanner listed dp before we got to watch it; pick up whatever was created in between. Things created since
+    # the watch went up may be reported by it as well, and are skipped by _is_known().
+    try:
+      names = os.listdir((self.base + dp) or b'.')
+    except OSError as exc:
+      log(30, 'Failed to rescan {!a}: {!r}'.format(dp, exc))
+      return
+    seen = set(fp for (fp, _) in files)
+    seen.update(dirs)
+    for name in names:
+      pn = join_path(dp, name)
+      if (pn in seen):
+        continue
+      try:
+        st = os.lstat(self.base + pn)
+        if stat.S_ISDIR(st.st_mode):
+          self.scan_dir(pn, new=True)
+          continue
+        st = os.stat(self.base + pn)
+      except OSError:
+        # Gone again.
+        continue
+      if not stat.S_ISREG(st.st_mode) or self._is_known(pn, st):
+        continue
+      self._init_offset(pn, st, True)
+      self.stream.add_file(pn)
+      self._mark_dirty(pn)
+
+  def watch_all(self):
+    self._watch_files(self.stream.get_watched_files())
+
+  def _add_watch_descriptor(self, wd, pn):
+    off = wd - len(self.wd2pn) + 1
+    if (off > 0):
+      from itertools import repeat
+      self.wd2pn.extend(repeat(None, off))
+
+    self.wd2pn[wd] = pn
+
+  def _watch_files(self, pns):
+    for pn in pns:
+      wd = self.iw.add_watch(self.base + pn, IN_MODIFY)
+      self._add_watch_descriptor(wd, pn)
+
+  def _watch_dir(self, dp):
+    try:
+      wd = self.iw.add_watch((self.base + dp) or b'.', self.DIR_MASK)
+    except OSError as exc:
+      log(30, 'Failed to watch directory {!a}: {!r}'.format(dp, exc))
+      return False
+    self._add_watch_descriptor(wd, dp)
+    self.dp2wd[dp] = wd
+    return True
+
+  def _drop_dir_watch(self, dp):
+    # The kernel drops watches on deleted directories by itself; those on directories moved elsewhere in the tree
+    # will be re-added for their new path, so we just stop listening under the old one.
+    wd = self.dp2wd.pop(dp, None)
+    if (wd is not None) and (self.wd2pn[wd] == dp):
+      self.wd2pn[wd] = None
+
+
+def norm_path(p):
+  # Paths are kept relative to the watched tree root, which is represented as b''.
+  if (p == b'.'):
+    return b''
+  if p.startswith(b'./'):
+    return p[2:]
+  return p
+
+def join_path(dp, fn):
+  if not dp:
+    return fn
+  return dp + b'/' + fn
@@ -15,64 +15,204 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import usb
+# blink(1) USB LED notifier.
+#
+# Blinker is a handle on one device, keeping track of what it shows (and has in its pattern RAM) so that writes that
+# wouldn't change anything are skipped. BlinkNotifier holds on to one across errors as far as it makes sense, and
+# looks for the device again (rate-limited) on later events when it has been unplugged.
+# Blinking and per-watch color sequences are played by the device itself from its pattern RAM.
+
+import errno
 import logging
+import time
 
 logger = logging.getLogger('notify_blink1')
 log = logger.log
 
+VENDOR_ID = 0x27b8
+PRODUCT_ID = 0x01ed
 REPORT_ID = 1
+# Host-to-device class request to the interface: usb.util.build_request_type(CTRL_OUT, CTRL_TYPE_CLASS,
+# CTRL_RECIPIENT_INTERFACE).
+REQ_TYPE = 0x21
+HID_SET_REPORT = 0x09
+# Pattern RAM lines on a mk2.
+PATTERN_LINES = 16
+
+
+def find_device():
+  import usb.core
+  return usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
+
+def _ms_to_ticks(ms):
+  # The device counts fade times in units of 10ms.
+  t = max(0, min(0xffff, int(ms) // 10))
+  return (t >> 8, t & 0xff)
 
 
 class Blinker:
-  REQ_TYPE = usb.util.build_request_type(usb.util.CTRL_OUT, usb.util.CTRL_TYPE_CLASS, usb.util.CTRL_RECIPIENT_INTERFACE)
   def __init__(self, dev):
     if (dev.is_kernel_driver_active(0)):
       dev.detach_kernel_driver(0)
 
     self.dev = dev
+    # What the device shows: ('color', (r, g, b)) or ('pattern', ((r, g, b, ms), ...)); None if we don't know.
+    self.shown = None
+    self.loaded = [None] * PATTERN_LINES
+    self.writes = 0
 
   def write_buf(self, buf):
-    return self.dev.ctrl_transfer(self.REQ_TYPE, 0x09, 768 | REPORT_ID, 0, buf)
+    rv = self.dev.ctrl_transfer(REQ_TYPE, HID_SET_REPORT, 768 | REPORT_ID, 0, buf)
+    self.writes += 1
+    return rv
 
   def set_color(self, r, g, b):
     self.write_buf([REPORT_ID, 0x6e, r, g, b, 0, 0, 0])
 
+  def fade_to(self, r, g, b, ms):
+    self.write_buf([REPORT_ID, 0x63, r, g, b] + list(_ms_to_ticks(ms)) + [0])
+
+  def write_pattern_line(self, pos, r, g, b, ms):
+    self.write_buf([REPORT_ID, 0x50, r, g, b] + list(_ms_to_ticks(ms)) + [pos])
+
+  def play(self, start=0, end=0, count=0):
+    # Loops over pattern lines start to end (inclusive), count times; forever with count 0.
+    self.write_buf([REPORT_ID, 0x70, 1, start, end, count, 0, 0])
+
+  def stop(self):
+    self.write_buf([REPORT_ID, 0x70, 0, 0, 0, 0, 0, 0])
+
   def off(self):
-    self.set_color(0,0,0)
+    self.show_color((0, 0, 0))
+
+  def show_color(self, rgb, fade_ms=0):
+    st = ('color', tuple(rgb))
+    if (st == self.shown):
+      return False
+    prev = self.shown
+    self.shown = None
+    if (prev is None) or (prev[0] == 'pattern'):
+      self.stop()
+    if (fade_ms > 0):
+      self.fade_to(*rgb, fade_ms)
+    else:
+      self.set_color(*rgb)
+    self.shown = st
+    return True
+
+  def show_pattern(self, lines):
+    st = ('pattern', tuple(lines))
+    if (st == self.shown):
+      return False
+    if not (0 < len(lines) <= PATTERN_LINES):
+      raise ValueError('Patterns take 1 to {} lines; got {}.'.format(PATTERN_LINES, len(lines)))
+    self.shown = None
+    for (i, line) in enumerate(lines):
+      if (self.loaded[i] == line):
+        continue
+      self.loaded[i] = None
+      self.write_pattern_line(i, *line)
+      self.loaded[i] = line
+    self.play(0, len(lines) - 1)
+    self.shown = st
+    return True
 
   def clear(self):
     # Prevent exception reporting through libusb destructors
+    ctx = getattr(self.dev, '_ctx', None)
+    if (ctx is None):
+      return
     try:
-      self.dev._ctx.dispose(self.dev)
+      ctx.dispose(self.dev)
     except Exception:
       pass
-    self.dev._ctx.dispose = lambda *a, **kw: None
+    ctx.dispose = lambda *a, **kw: None
 
   @classmethod
-  def build_auto(cls):
-    dev = usb.core.find(idVendor=0x27b8, idProduct=0x01ed)
+  def build_auto(cls, find=find_device):
+    dev = find()
+    if (dev is None):
+      return None
     return cls(dev)
 
 
+def _get_idx(w):
+  # Watches can be given as patterns from the config, or their indices.
+  return getattr(w, 'idx', w)
+
+def _norm_lines(lines):
+  lines = tuple((int(r), int(g), int(b), int(ms)) for (r, g, b, ms) in lines)
+  if not (0 < len(lines) <= PATTERN_LINES):
+    raise ValueError('Patterns take 1 to {} lines; got {}.'.format(PATTERN_LINES, len(lines)))
+  return lines
+
+
 class BlinkNotifier:
-  def __init__(self):
+  # Seconds to wait between looking for a device that isn't there.
+  REDISCOVER_INTERVAL = 5
+  # Consecutive failed writes to give up on a handle after, even if the device doesn't look gone.
+  MAX_FAILURES = 2
+
+  # find returns a pyusb device (or something that quacks like one), or None if there's none.
+  def __init__(self, find=find_device):
+    self.find = find
     self.blinker = None
-    self.color = None
-    self.signal_color = (0,0,0)
+    self.t_find = None
+    self.failures = 0
+    self.clear_looks()
+
+  def clear_looks(self):
+    # Back to defaults; for configs taking over a notifier from an earlier one, whose watch indices may differ.
+    self.fade_ms = 0
+    self.looks = {}
+    self.notify_look = ('color', (0, 0, 0))
 
   def set_notify_color(self, r, g, b):
-    self.signal_color = [int(x) for x in (r, g, b)]
+    self.notify_look = ('color', tuple(int(x) for x in (r, g, b)))
+
+  def set_notify_blink(self, r, g, b, period_ms=1000):
+    # Blink on notify, played by the device.
+    rgb = tuple(int(x) for x in (r, g, b))
+    self.set_notify_pattern((rgb + (period_ms // 2,), (0, 0, 0, period_ms // 2)))
+
+  def set_notify_pattern(self, lines):
+    # lines: [(r, g, b, fade ms)...], for the device to loop over on notify.
+    self.notify_look = ('pattern', _norm_lines(lines))
+
+  def set_watch_color(self, w, r, g, b):
+    self.looks[_get_idx(w)] = ('color', tuple(int(x) for x in (r, g, b)))
+
+  def set_watch_pattern(self, w, lines):
+    self.looks[_get_idx(w)] = ('pattern', _norm_lines(lines))
+
+  def set_fade(self, ms):
+    # Fade between plain colors over this long, rather than switching at once.
+    self.fade_ms = ms
 
   def add_menu_sep(self, *a, **k):
     pass
   def add_menu_item(self, *a, **k):
     pass
+  def clear_menu(self):
+    pass
 
   def get_blinker(self):
     rv = self.blinker
+    if not (rv is None):
+      return rv
+    now = time.monotonic()
+    if not (self.t_find is None) and (now - self.t_find < self.REDISCOVER_INTERVAL):
+      return None
+    rv = self.blinker = Blinker.build_auto(self.find)
     if (rv is None):
-      rv = self.blinker = Blinker.build_auto()
+      if (self.t_find is None):
+        log(30, 'No blink1 device found; looking again on later events.')
+      self.t_find = now
+    else:
+      if not (self.t_find is None):
+        log(20, 'Found blink1 device.')
+      self.t_find = None
+      self.failures = 0
     return rv
 
   def clear_blinker(self):
@@ -81,19 +221,105 @@ class BlinkNotifier:
     self.blinker.clear()
     self.blinker = None
 
-  def notify(self, idx):
+  def _show(self, look, what):
     try:
-      self.get_blinker().set_color(*self.signal_color)
+      bl = self.get_blinker()
+      if (bl is None):
+        return
+      if (look[0] == 'color'):
+        bl.show_color(look[1], self.fade_ms)
+      else:
+        bl.show_pattern(look[1])
     except Exception as exc:
-      self.clear_blinker()
-      log(30, 'Failed to blink1-notify(): {!r}'.format(str(exc)))
+      log(30, 'Failed to blink1-{}(): {!r}'.format(what, str(exc)))
+      self.failures += 1
+      if (getattr(exc, 'errno', None) == errno.ENODEV) or (self.failures >= self.MAX_FAILURES):
+        # Unplugged, or otherwise unusable; find it again next time.
+        self.clear_blinker()
+        self.t_find = None
+      return
+    self.failures = 0
+
+  def notify(self, idx):
+    self._show(self.looks.get(idx, self.notify_look), 'notify')
 
   def reset(self):
-    bl = self.blinker
-    if (bl is None):
-      return
-    try:
-      bl.off()
-    except Exception as exc:
-      self.clear_blinker()
-      log(30, 'Failed to blink1-reset(): {!r}'.format(str(exc)))
+    self._show(('color', (0, 0, 0)), 'reset')
+
+
+def _test_blinker():
+  class Dev:
+    def __init__(self):
+      self.bufs = []
+      self.fail = None
+    def is_kernel_driver_active(self, i):
+      return False
+    def ctrl_transfer(self, req_type, req, val, idx, buf):
+      if not (self.fail is None):
+        raise self.fail
+      if (req_type, req, val) != (REQ_TYPE, HID_SET_REPORT, 0x301):
+        raise ValueError('Bad request: {!r}'.format((req_type, req, val)))
+      self.bufs.append(bytes(buf))
+      return len(buf)
+
+  devs = [Dev()]
+  finds = []
+  def find():
+    finds.append(None)
+    return devs[0]
+
+  def cmds():
+    rv = bytes(b[1] for b in devs[0].bufs)
+    del(devs[0].bufs[:])
+    return rv
+
+  n = BlinkNotifier(find)
+  n.set_notify_color(0, 10, 0)
+  n.set_watch_pattern(3, [(255, 0, 0, 100), (0, 0, 0, 100)])
+  n.notify(0)
+  n.notify(1)
+  if (cmds() != b'pn'):
+    raise ValueError('Redundant color writes.')
+  n.notify(3)
+  n.notify(3)
+  if (cmds() != b'PPp'):
+    raise ValueError('Bad pattern writes.')
+  n.reset()
+  n.notify(3)
+  if (cmds() != b'pnp'):
+    raise ValueError('Pattern lines rewritten.')
+  n.set_fade(500)
+  n.reset()
+  if (cmds() != b'pc') or (devs[0].bufs or n.blinker.shown != ('color', (0, 0, 0))):
+    raise ValueError('Bad fade.')
+
+  # Errors keep the handle at first; an unplugged device gets looked for again on later events.
+  devs[0].fail = OSError('Timeout')
+  n.notify(0)
+  if (n.blinker is None) or (len(finds) != 1):
+    raise ValueError('Handle dropped on first error.')
+  e = OSError('No such device')
+  e.errno = errno.ENODEV
+  devs[0].fail = e
+  n.notify(0)
+  if not (n.blinker is None):
+    raise ValueError('Handle kept for unplugged device.')
+  devs[0] = None
+  n.notify(0)
+  n.notify(0)
+  if (len(finds) != 2):
+    raise ValueError('Rediscovery not rate-limited: {} lookups.'.format(len(finds)))
+  devs[0] = Dev()
+  n.t_find -= n.REDISCOVER_INTERVAL
+  n.notify(3)
+  if (len(finds) != 3) or (cmds() != b'PPp'):
+    raise ValueError('Bad rediscovery.')
+
+  n.clear_looks()
+  if n.looks or n.fade_ms or (n.notify_look != ('color', (0, 0, 0))):
+    raise ValueError('Looks not cleared.')
+
+
+if (__name__ == '__main__'):
+  _test_blinker()
+  print('Tests done.')
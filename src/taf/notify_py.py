@@ -16,17 +16,26 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 class PyNotifier:
-  def __init__(self, notify, reset):
+  def __init__(self, notify, reset, notify_context=None):
     self.n = notify
     self.r = reset
+    self.nc = notify_context
 
   def add_menu_sep(self, *a, **k):
     pass
   def add_menu_item(self, *a, **k):
     pass
+  def clear_menu(self):
+    pass
 
   def notify(self, *args, **kwargs):
     self.n(*args, **kwargs)
 
+  def notify_context(self, idx, lines):
+    if (self.nc is None):
+      self.n(idx)
+    else:
+      self.nc(idx, lines)
+
   def reset(self, *args, **kwargs):
     self.r(*args, **kwargs)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#Copyright 2015 Sebastian Hagen
+# This file is part of taf.
+#
+# taf is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# taf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Line matching on a pool of worker processes.
+#
+# Workers get (path, start offset, armed watch set, limits) work items, read and match the file from there to its
+# end, and return what fired. The event loop keeps ownership of all protocol and watch state: it applies results as
+# they come back, and drops fires for watches that were set or deactivated in the meantime.
+
+import logging
+import os
+import re
+from collections import deque
+
+from taf.event_proto import LineMatcher, Watch
+from taf.tail import TailReader
+
+logger = logging.getLogger('pool')
+log = logger.log
+
+# ================================ Worker side
+def _init_worker(ppid):
+  # Our stdio is the parent's protocol stream, which its client only sees EOF on once nobody holds it anymore; and we
+  # shouldn't outlive the parent, however it goes away.
+  null = os.open(os.devnull, os.O_RDWR)
+  for fd in (0, 1):
+    os.dup2(null, fd)
+  os.close(null)
+  try:
+    import ctypes
+    import signal
+    PR_SET_PDEATHSIG = 1
+    ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+  except (OSError, AttributeError):
+    pass
+  if (os.getppid() != ppid):
+    os._exit(0)
+
+_reader = None
+_matchers = {}
+MATCHER_CACHE_SIZE = 256
+
+def _get_matcher(spec):
+  m = _matchers.get(spec)
+  if (m is None):
+    if (len(_matchers) >= MATCHER_CACHE_SIZE):
+      _matchers.clear()
+    ws = []
+    for (idx, pattern, flags) in spec:
+      w = Watch(None, re.compile(pattern, flags))
+      w.idx = idx
+      ws.append(w)
+    m = _matchers[spec] = LineMatcher(ws)
+  return m
+
+def match_range(path, start, spec, max_line_len=0, budget=0):
+  # Runs in a worker. Returns (fired [(watch idx, line)...], lines scanned, {idx: evals}, {idx: [total time, max time]},
+  # [(idx, seconds)...] over budget, new line offset, octets read).
+  global _reader
+  if (_reader is None):
+    _reader = TailReader(max_fds=1)
+  r = _reader
+  m = _get_matcher(spec)
+  idxs = [idx for (idx, _, _) in spec]
+  evals = dict.fromkeys(idxs, 0)
+  times = {idx: [0, 0] for idx in idxs}
+  over = []
+  r.set_offset(path, start)
+  nread = r.bytes_read
+  try:
+    fired = m.match_region(r.read_windows(path), evals, max_line_len, (times if (budget > 0) else None), budget)
+    over = m.over
+    r.finish(path)
+    off = r.get_line_offset(path)
+  finally:
+    # The file may be rotated away before we get to see it again.
+    r.forget(path)
+
+  return ([(w.idx, line) for (w, line) in fired], m.lines_scanned, evals, times, [(w.idx, dt) for (w, dt) in over],
+    off, r.bytes_read - nread)
+
+
+# ================================ Event loop side
+class MatchPool:
+  # Finished (path, future) pairs are queued from the executor's callback thread, with a byte written to wake_fd for
+  # each; the owning event loop should watch that and call drain() when it becomes readable.
+  # base is prefixed to paths for the workers to open them by.
+  def __init__(self, workers, base=b''):
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    self._ex = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'), initializer=_init_worker,
+      initargs=(os.getpid(),))
+    # With fork, the executor starts all workers on the first submission; have that happen now, before the owner gets
+    # to start any threads.
+    self._ex.submit(int).result()
+    self.workers = workers
+    self.base = base
+    self.results = deque()
+    (self.wake_fd, self._wake_w) = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+    self.jobs = 0
+
+  def submit(self, path, start, ws, c):
+    spec = tuple((w.idx, w.line_p.pattern, w.line_p.flags) for w in ws)
+    fut = self._ex.submit(match_range, self.base + path, start, spec, c.max_line_len, c.watch_budget_us / 1e6)
+    fut.add_done_callback(lambda fut: self._done(path, fut))
+    self.jobs += 1
+    return fut
+
+  def _done(self, path, fut):
+    self.results.append((path, fut))
+    try:
+      os.write(self._wake_w, b'\x00')
+    except BlockingIOError:
+      # Plenty of wakeups pending already.
+      pass
+
+  def drain(self):
+    try:
+      while os.read(self.wake_fd, 4096):
+        pass
+    except BlockingIOError:
+      pass
+    rv = []
+    q = self.results
+    while q:
+      rv.append(q.popleft())
+    return rv
+
+  def shutdown(self):
+    self._ex.shutdown(wait=False, cancel_futures=True)
+    os.close(self._wake_w)
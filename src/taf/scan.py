@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#Copyright 2015 Sebastian Hagen
+# This file is part of taf.
+#
+# taf is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# taf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Logfile tree scanning.
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger('scan')
+log = logger.log
+
+
+def _join(dp, fn):
+  if not dp:
+    return fn
+  return dp + b'/' + fn
+
+def scan_one(dp, base=b''):
+  # Scans a single directory (b'' being the cwd, or base), returning (dp, [(file path, stat result)...], [subdir
+  # path...]). base is prefixed to paths for looking them up only.
+  files = []
+  dirs = []
+  try:
+    it = os.scandir((base + dp) or b'.')
+  except OSError as exc:
+    log(30, 'Failed to scan {!a}: {!r}'.format(dp, exc))
+    return (dp, files, dirs)
+
+  with it:
+    for e in it:
+      try:
+        if e.is_dir(follow_symlinks=False):
+          dirs.append(_join(dp, e.name))
+        elif e.is_file():
+          files.append((_join(dp, e.name), e.stat()))
+      except OSError as exc:
+        log(30, 'Failed to stat {!a}: {!r}'.format(e.path, exc))
+  return (dp, files, dirs)
+
+
+class TreeScanner:
+  # Walks a directory tree on a pool of threads, one directory per work item. Results are queued for the owner to
+  # pick up with drain(), so the event loop can start acting on the first directories while the rest of the tree is
+  # still being scanned.
+  def __init__(self, root, threads=4, base=b''):
+    self.root = root
+    self.base = base
+    self.threads = threads
+    self.results = deque()
+    self.dirs = 0
+    self.files = 0
+    self.t_start = None
+    self.t_done = None
+    self._pending = 0
+    self._lock = threading.Lock()
+    self._pool = None
+
+  def start(self):
+    from concurrent.futures import ThreadPoolExecutor
+    self.t_start = time.monotonic()
+    self._pool = ThreadPoolExecutor(self.threads, thread_name_prefix='scan')
+    self._submit(self.root)
+
+  def _submit(self, dp):
+    with self._lock:
+      self._pending += 1
+    self._pool.submit(self._scan, dp)
+
+  def _scan(self, dp):
+    try:
+      rv = scan_one(dp, self.base)
+      for sdp in rv[2]:
+        self._submit(sdp)
+      self.results.append(rv)
+    finally:
+      with self._lock:
+        self._pending -= 1
+        done = (self._pending == 0)
+      if done:
+        self.t_done = time.monotonic()
+        self._pool.shutdown(wait=False)
+
+  def run(self):
+    # Synchronous version; yields results as they come in.
+    self.t_start = time.monotonic()
+    todo = [self.root]
+    while todo:
+      rv = scan_one(todo.pop(), self.base)
+      todo.extend(rv[2])
+      self._count(rv)
+      yield rv
+    self.t_done = time.monotonic()
+
+  def _count(self, rv):
+    self.dirs += 1
+    self.files += len(rv[1])
+
+  def drain(self):
+    # Returns the results collected since the last call.
+    rv = []
+    q = self.results
+    while q:
+      r = q.popleft()
+      self._count(r)
+      rv.append(r)
+    return rv
+
+  def is_done(self):
+    return (self.t_done is not None) and not self.results
+
+  def elapsed(self):
+    if (self.t_start is None):
+      return 0
+    return (self.t_done or time.monotonic()) - self.t_start
+
+  def format_progress(self):
+    return '{} dirs, {} files in {:.3f}s'.format(self.dirs, self.files, self.elapsed())
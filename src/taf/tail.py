@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+#Copyright 2015 Sebastian Hagen
+# This file is part of taf.
+#
+# taf is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# taf is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Incremental reading of appended data from growing logfiles.
+
+import logging
+import mmap
+import os
+from collections import OrderedDict
+
+logger = logging.getLogger('tail')
+log = logger.log
+
+
+if hasattr(os, 'preadv'):
+  def _pread_into(fd, buf, off):
+    return os.preadv(fd, (buf,), off)
+else:
+  def _pread_into(fd, buf, off):
+    data = os.pread(fd, len(buf), off)
+    buf[:len(data)] = data
+    return len(data)
+
+
+class TailReader:
+  # Keeps per-file read offsets, an LRU-capped pool of open file descriptors and any trailing partial line, so
+  # that each modify event costs one positional read per chunk of new data instead of stat/open/seek/read/close.
+  # Paths are opened with base prefixed to them.
+  def __init__(self, max_fds=256, bufsize=65536, window=1<<24, base=b''):
+    self.base = base
+    self.max_fds = max_fds
+    self.bufsize = bufsize
+    self.window = window
+    self.offs = {}
+    self._fds = OrderedDict()
+    self._carry = {}
+    self._reading = {}
+    self._buf = bytearray(bufsize)
+    self._buf_busy = False
+    # Paths that may have more than a buffer's worth of data pending: ones just positioned with set_offset(), and
+    # ones whose last read filled its buffer. For others, it's not worth an fstat() to find out.
+    self._big = set()
+    self.bytes_read = 0
+
+  def get_fd(self, path):
+    fds = self._fds
+    fd = fds.get(path)
+    if (fd is None):
+      fd = os.open(self.base + path, os.O_RDONLY | os.O_CLOEXEC)
+      fds[path] = fd
+      while (len(fds) > self.max_fds):
+        (_, fd_old) = fds.popitem(last=False)
+        os.close(fd_old)
+    else:
+      fds.move_to_end(path)
+    return fd
+
+  def get_fd_count(self):
+    return len(self._fds)
+
+  def _stop_reading(self, path):
+    # A read left suspended (e.g. by an exception in its consumer) still holds the shared buffer and our fd.
+    gen = self._reading.pop(path, None)
+    if not ((gen is None) or (gen is False)):
+      gen.close()
+
+  def close(self, path):
+    self._stop_reading(path)
+    fd = self._fds.pop(path, None)
+    if not (fd is None):
+      os.close(fd)
+
+  def close_all(self):
+    for path in list(self._reading):
+      self._stop_reading(path)
+    for fd in self._fds.values():
+      os.close(fd)
+    self._fds.clear()
+
+  def forget(self, path):
+    self.close(path)
+    self.offs.pop(path, None)
+    self._carry.pop(path, None)
+    self._big.discard(path)
+
+  def get_offset(self, path):
+    return self.offs.get(path)
+
+  def get_line_offset(self, path):
+    # Offset just past the last complete line read.
+    off = self.offs.get(path)
+    if (off is None):
+      return None
+    return off - len(self._carry.get(path, b''))
+
+  def set_offset(self, path, off):
+    self.offs[path] = off
+    self._carry.pop(path, None)
+    self._big.add(path)
+
+  def get_size(self, path):
+    return os.fstat(self.get_fd(path)).st_size
+
+  def skip(self, path):
+    # Move the read offset to the current end of file without looking at the data in between.
+    self.set_offset(path, self.get_size(path))
+    self._big.discard(path)
+
+  def finish(self, path):
+    # To be called after each event: if the new data wasn't read to the end (because nobody asked for lines, or the
+    # consumer stopped early), skip the rest.
+    gen = self._reading.pop(path, False)
+    if (gen is None):
+      return
+    if not (gen is False):
+      gen.close()
+    self.skip(path)
+
+  def read_lines(self, path):
+    # Returns an iterator over the complete lines appended since the last call; a trailing partial line is held
+    # back until its terminating newline shows up.
+    gen = self._reading[path] = self._read_lines(path)
+    return gen
+
+  def _read_lines(self, path):
+    fd = self.get_fd(path)
+    off = self.offs.get(path, 0)
+    carry = self._carry.pop(path, b'')
+
+    if self._buf_busy:
+      buf = bytearray(self.bufsize)
+    else:
+      buf = self._buf
+      self._buf_busy = True
+
+    filled = False
+    try:
+      mv = memoryview(buf)
+      first = True
+      while True:
+        n = _pread_into(fd, buf, off)
+        if (n == 0):
+          if first and (os.fstat(fd).st_size < off):
+            # Truncated; start over from the beginning.
+            log(20, 'File {!a} was truncated; rereading from start.'.format(path))
+            off = self.offs[path] = 0
+            carry = b''
+            first = False
+            continue
+          break
+        first = False
+        off += n
+        self.offs[path] = off
+        self.bytes_read += n
+
+        start = 0
+        i = buf.find(b'\n', 0, n)
+        while (i >= 0):
+          line = mv[start:i].tobytes()
+          if carry:
+            line = carry + line
+            carry = b''
+          yield line
+          start = i + 1
+          i = buf.find(b'\n', start, n)
+
+        carry += mv[start:n].tobytes()
+        if (n < len(buf)):
+          break
+        filled = True
+    finally:
+      mv.release()
+      if (buf is self._buf):
+        self._buf_busy = False
+
+    self._carry[path] = carry
+    if filled:
+      self._big.add(path)
+    else:
+      self._big.discard(path)
+    # Mark as read to the end.
+    self._reading[path] = None
+
+  def get_pending(self, path):
+    # Octets between the last complete line read and the end of file.
+    off = self.get_line_offset(path)
+    if (off is None):
+      return None
+    return self.get_size(path) - off
+
+  def may_be_big(self, path):
+    # Whether get_pending() might come out at more than a buffer's worth; without calling fstat().
+    return (path in self._big) or not (path in self.offs)
+
+  def read_windows(self, path):
+    # Like read_lines(), but memory-maps the new data a window at a time instead of copying it. Yields
+    # (buffer, start, end) tuples, where buffer[start:end] is a run of complete lines separated by (but not ending
+    # in) newlines. Lines longer than a window are split at window boundaries.
+    gen = self._reading[path] = self._read_windows(path)
+    return gen
+
+  def _read_windows(self, path):
+    fd = self.get_fd(path)
+    size = os.fstat(fd).st_size
+    off = self.get_line_offset(path) or 0
+    if (size < off):
+      log(20, 'File {!a} was truncated; rereading from start.'.format(path))
+      off = 0
+    self.set_offset(path, off)
+    gran = mmap.ALLOCATIONGRANULARITY
+
+    while (off < size):
+      base = off - off % gran
+      w_end = min(size, off + self.window)
+      # Note that a file truncated while mapped gets us SIGBUS; logs don't usually shrink under us.
+      mm = mmap.mmap(fd, w_end - base, mmap.MAP_SHARED, mmap.PROT_READ, offset=base)
+      try:
+        start = off - base
+        end = mm.rfind(b'\n', start)
+        if (end >= 0):
+          off_next = base + end + 1
+        elif (w_end < size):
+          end = w_end - base
+          off_next = w_end
+        else:
+          # Partial line at EOF; hold it back as usual.
+          break
+        yield (mm, start, end)
+        self.bytes_read += off_next - off
+        off = self.offs[path] = off_next
+      finally:
+        mm.close()
+
+    if (off < size):
+      carry = os.pread(fd, size - off, off)
+      self.bytes_read += len(carry)
+      self.offs[path] = off + len(carry)
+      self._carry[path] = carry
+    self._big.discard(path)
+    # Mark as read to the end.
+    self._reading[path] = None
+
+
+
+def _test_tail_reader():
+  import shutil
+  import tempfile
+  d = tempfile.mkdtemp()
+  try:
+    r = TailReader(bufsize=8, base=os.fsencode(d) + b'/')
+    path = b'log'
+    with open(os.path.join(d, 'log'), 'wb') as f:
+      def append(data):
+        f.write(data)
+        f.flush()
+
+      def read(windows=False):
+        if windows:
+          rv = [bytes(buf[start:end]) for (buf, start, end) in r.read_windows(path)]
+        else:
+          rv = list(r.read_lines(path))
+        r.finish(path)
+        return rv
+
+      # Partial lines are held back until their newline turns up, across reads and buffer boundaries.
+      r.set_offset(path, 0)
+      append(b'one\ntwo and more')
+      if (read() != [b'one']) or (r.get_offset(path) != 16) or (r.get_line_offset(path) != 4):
+        raise ValueError('Bad partial read: {!r}'.format(r.offs))
+      append(b' still\nthree')
+      if (read() != [b'two and more still']) or (r.get_line_offset(path) != 23) or (r.get_pending(path) != 5):
+        raise ValueError('Bad carried line: {!r}'.format(r.offs))
+
+      # Truncation starts over from the beginning.
+      f.truncate(0)
+      f.seek(0)
+      append(b'new\n')
+      if (read() != [b'new']) or (r.get_offset(path) != 4):
+        raise ValueError('Bad read after truncation: {!r}'.format(r.offs))
+
+      # Stopping early skips to the end of file.
+      append(b'a\nb\nc\n')
+      it = r.read_lines(path)
+      next(it)
+      r.finish(path)
+      if (r.get_offset(path) != 10) or (r.get_line_offset(path) != 10) or read():
+        raise ValueError('Bad finish(): {!r}'.format(r.offs))
+
+      # Windows see the same lines, with the same carry.
+      append(b'x\ny\nz')
+      if (read(True) != [b'x\ny']) or (r.get_line_offset(path) != 14):
+        raise ValueError('Bad window read: {!r}'.format(r.offs))
+      append(b'z\n')
+      if (read() != [b'zz']):
+        raise ValueError('Bad carry after window read: {!r}'.format(r.offs))
+
+      # Forgetting a path in the middle of a read lets go of the shared buffer.
+      append(b'p\nq\n')
+      it = r.read_lines(path)
+      next(it)
+      r.forget(path)
+      if r._buf_busy or r._reading or (r.get_offset(path) is not None):
+        raise ValueError('Suspended read survived forget().')
+    r.close_all()
+  finally:
+    shutil.rmtree(d)
+
+
+if (__name__ == '__main__'):
+  _test_tail_reader()
+  print('Tests done.')
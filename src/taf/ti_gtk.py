@@ -19,6 +19,7 @@ from threading import Thread
 
 import gi; gi.require_version('Gtk', '3.0'); gi.require_version('AppIndicator3', '0.1')
 from gi.repository import AppIndicator3 as app_indicator
+from gi.repository import GLib as glib
 from gi.repository import Gtk as gtk
 
 def init():
@@ -45,29 +46,50 @@ class GtkTrayIcon:
       sa.ed.shutdown()
       sa.bump_ml()
 
-    self.add_menu_item('Quit', sd)
-    self.add_menu_sep()
+    self._add_menu_item('Quit', sd)
+    self._add_menu_sep()
+    # Items from here on are ours to replace on config reload.
+    self._menu_base = len(menu.get_children())
 
     ai.connect('scroll-event', sd)
 
     menu.show_all()
     ai.set_menu(menu)
 
+  # Menu changes can come in while gtk.main() is running in the UI thread, so they're queued up for that; idle
+  # callbacks run in the order they were added.
   def add_menu_sep(self):
+    glib.idle_add(self._add_menu_sep)
+
+  def add_menu_item(self, title, callback):
+    glib.idle_add(self._add_menu_item, title, callback)
+
+  def clear_menu(self):
+    glib.idle_add(self._clear_menu)
+
+  def _add_menu_sep(self):
     sep = gtk.SeparatorMenuItem()
+    sep.show()
     self.menu.append(sep)
 
-  def add_menu_item(self, title, callback):
+  def _add_menu_item(self, title, callback):
     item = gtk.MenuItem(title)
     item.connect('activate', callback)
     item.show()
     self.menu.append(item)
-    return item
+
+  def _clear_menu(self):
+    for item in self.menu.get_children()[self._menu_base:]:
+      self.menu.remove(item)
+
+  def run_soon(self, f):
+    # For the dispatcher: notify() and reset() get run in the UI thread too.
+    glib.idle_add(f)
 
   def set_icons(self, ip_inactive, ip_active):
     self.ip_inactive = ip_inactive
     self.ip_active = ip_active
-    self.reset()
+    glib.idle_add(self.reset)
 
   def notify(self, *args, **kwargs):
     self.ai.set_status(self.IS_ATTENTION)